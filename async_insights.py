@@ -0,0 +1,219 @@
+"""
+Asynchronous insights report runs with adaptive date-window sharding.
+
+Large ad-level insight queries (publisher_platform / platform_position breakdowns,
+time_increment=1) are what Meta times out or throttles on big accounts when asked
+synchronously. Here the requested range is split into date shards, each shard is
+submitted as an async AdReportRun, all in-flight runs are polled with backoff, and
+the result pages of finished runs are streamed back as they complete.
+
+When a shard fails, times out or Meta answers "too much data", that window is split
+in half and resubmitted, down to a single day. A submission that hits one of Meta's
+generic transient errors is retried as it is, with backoff.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+from facebook_business.adobjects.adreportrun import AdReportRun
+from facebook_business.exceptions import FacebookRequestError
+
+from rate_limiter import CALL_TYPE_INSIGHTS, account_scope
+from run_metrics import METRICS
+
+ASYNC_INSIGHTS_CONFIG = {
+    'shard_days': 7,               # Initial size of each date window
+    'max_inflight_jobs': 4,        # Report runs submitted per level at the same time
+    'poll_initial_seconds': 2,
+    'poll_max_seconds': 30,
+    'poll_backoff': 1.5,
+    'job_timeout_seconds': 1800,   # A run still pending after this is split and resubmitted
+    'page_limit': 500,
+    'transient_retries': 3,        # Resubmissions of a window after a transient error
+    'transient_backoff_seconds': 5,  # Doubled on every retry of the same window
+}
+
+JOB_COMPLETED = 'Job Completed'
+JOB_FAILED_STATUSES = ('Job Failed', 'Job Skipped')
+
+# Error signatures Meta uses for queries that are too large to compute in time
+TOO_MUCH_DATA_SUBCODES = {1487534, 1504018}
+# "An unknown error occurred" / "Service temporarily unavailable": says nothing about the query's size
+TRANSIENT_ERROR_CODES = {1, 2}
+
+
+def split_date_range(since, until, shard_days):
+    """Splits an inclusive 'YYYY-MM-DD' range into windows of at most shard_days days."""
+    start = datetime.strptime(since, '%Y-%m-%d').date()
+    end = datetime.strptime(until, '%Y-%m-%d').date()
+    windows = []
+    while start <= end:
+        window_end = min(end, start + timedelta(days=shard_days - 1))
+        windows.append((start.strftime('%Y-%m-%d'), window_end.strftime('%Y-%m-%d')))
+        start = window_end + timedelta(days=1)
+    return windows
+
+
+def _halve_window(window):
+    """Splits a window in two, or returns None if it is a single day."""
+    start = datetime.strptime(window[0], '%Y-%m-%d').date()
+    end = datetime.strptime(window[1], '%Y-%m-%d').date()
+    if start >= end:
+        return None
+    middle = start + timedelta(days=(end - start).days // 2)
+    return [
+        (window[0], middle.strftime('%Y-%m-%d')),
+        ((middle + timedelta(days=1)).strftime('%Y-%m-%d'), window[1]),
+    ]
+
+
+def is_too_much_data_error(error):
+    """True if Meta rejected or timed out a query because of its size."""
+    if not isinstance(error, FacebookRequestError):
+        return False
+    message = (error.api_error_message() or '').lower()
+    return error.api_error_subcode() in TOO_MUCH_DATA_SUBCODES or 'reduce the amount of data' in message
+
+
+def is_transient_error(error):
+    """True if Meta failed a call for reasons of its own, so the same call may succeed when retried."""
+    if not isinstance(error, FacebookRequestError):
+        return False
+    return error.api_error_code() in TRANSIENT_ERROR_CODES or bool(error.api_transient_error())
+
+
+def iter_cursor_pages(cursor):
+    """Yields the SDK cursor's results one page (list of dicts) at a time."""
+    page = []
+    for obj in cursor:
+        page.append(obj.export_all_data())
+        # The cursor's queue is empty once the last object of the loaded page is popped
+        if len(cursor) == 0:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def _scoped_pages(cursor, account_id):
+    """Like iter_cursor_pages, but attributes each page request to the ad account's insights budget."""
+    pages = iter_cursor_pages(cursor)
+    while True:
+        with account_scope(account_id, CALL_TYPE_INSIGHTS):
+            page = next(pages, None)
+        if page is None:
+            return
+        yield page
+
+
+class _Job(object):
+    """One submitted report run and its polling state."""
+
+    def __init__(self, window, report_run, config):
+        self.window = window
+        self.report_run = report_run
+        self.submitted_at = time.monotonic()
+        self.poll_interval = config['poll_initial_seconds']
+        self.next_poll_at = self.submitted_at + self.poll_interval
+
+
+def fetch_insights_async(ad_account, fields, params, since, until, label='Insights', config=None,
+                         windows=None, on_window_done=None):
+    """
+    Fetches insights for [since, until] through sharded async report runs.
+
+    Args:
+        ad_account (AdAccount): Account to query.
+        fields (list): Insight fields.
+        params (dict): Insight params (level, breakdowns, time_increment, ...), without time_range.
+        since, until (str): Inclusive 'YYYY-MM-DD' range.
+        label (str): Name used for logging.
+        windows (list): Date windows to fetch instead of [since, until], e.g. the ones
+            a checkpoint says are still missing.
+        on_window_done (callable): Called with (since, until) once every page of a
+            window has been yielded.
+
+    Yields:
+        list: One page of insight rows (dicts) at a time, as runs complete.
+    """
+    config = {**ASYNC_INSIGHTS_CONFIG, **(config or {})}
+    account_id = ad_account.get_id()
+    windows = windows if windows is not None else [(since, until)]
+    pending = [shard for window in windows for shard in split_date_range(window[0], window[1], config['shard_days'])]
+    inflight = []
+    transient_attempts = {}
+
+    def split_or_fail(window, reason):
+        halves = _halve_window(window)
+        if halves is None:
+            raise RuntimeError(f"{label} report for {window[0]} failed and cannot be split further: {reason}")
+        print(f"  ✂️ {label} window {window[0]}..{window[1]} failed ({reason}). Splitting into smaller windows...")
+        pending[:0] = halves
+
+    print(f"  -> Starting async {label} fetch: {len(pending)} windows from {windows[0][0]} to {windows[-1][1]}"
+          if windows else f"  -> Nothing left to fetch for {label} between {since} and {until}")
+
+    while pending or inflight:
+        # Submit new runs up to the in-flight cap
+        while pending and len(inflight) < config['max_inflight_jobs']:
+            window = pending.pop(0)
+            run_params = {**params, 'time_range': {'since': window[0], 'until': window[1]}}
+            try:
+                report_run = ad_account.get_insights(fields=list(fields), params=run_params, is_async=True)
+            except FacebookRequestError as e:
+                if is_too_much_data_error(e):
+                    split_or_fail(window, e.api_error_message())
+                    continue
+                attempt = transient_attempts.get(window, 0)
+                if not is_transient_error(e) or attempt >= config['transient_retries']:
+                    raise
+                transient_attempts[window] = attempt + 1
+                backoff = config['transient_backoff_seconds'] * (2 ** attempt)
+                print(f"  🔁 {label} window {window[0]}..{window[1]} hit a transient error "
+                      f"({e.api_error_message()}). Retrying in {backoff}s (attempt {attempt + 1})...")
+                METRICS.record(retries=1)
+                time.sleep(backoff)
+                pending.insert(0, window)
+                continue
+            inflight.append(_Job(window, report_run, config))
+
+        if not inflight:
+            continue
+
+        # Sleep until the earliest run is due for a poll
+        now = time.monotonic()
+        next_poll_at = min(job.next_poll_at for job in inflight)
+        if next_poll_at > now:
+            time.sleep(next_poll_at - now)
+            METRICS.record(poll_wait_seconds=next_poll_at - now)
+
+        for job in list(inflight):
+            now = time.monotonic()
+            if job.next_poll_at > now:
+                continue
+
+            with account_scope(account_id, CALL_TYPE_INSIGHTS):
+                job.report_run.api_get(fields=[AdReportRun.Field.async_status,
+                                               AdReportRun.Field.async_percent_completion])
+            status = job.report_run[AdReportRun.Field.async_status]
+
+            if status == JOB_COMPLETED:
+                inflight.remove(job)
+                with account_scope(account_id, CALL_TYPE_INSIGHTS):
+                    # The SDK loads the first result page right away
+                    result = job.report_run.get_result(params={'limit': config['page_limit']})
+                for page in _scoped_pages(result, account_id):
+                    yield page
+                if on_window_done:
+                    on_window_done(job.window)
+            elif status in JOB_FAILED_STATUSES:
+                inflight.remove(job)
+                split_or_fail(job.window, status)
+            elif now - job.submitted_at > config['job_timeout_seconds']:
+                inflight.remove(job)
+                split_or_fail(job.window, 'timed out')
+            else:
+                job.poll_interval = min(config['poll_max_seconds'], job.poll_interval * config['poll_backoff'])
+                job.next_poll_at = now + job.poll_interval
+
+    print(f"  -> Completed async {label} fetch.")
@@ -0,0 +1,201 @@
+"""
+Buffered, batched writer for the etl_audit_log table.
+
+Audit rows are collected in memory during the run and written with a single
+BigQuery load job per flush (at the end of the run, or every
+`flush_interval_seconds`), instead of one pandas-gbq load job per row.
+
+If a flush fails, the rows are written to an NDJSON spill file; at exit
+(atexit) the buffer is flushed, and on SIGTERM from Cloud Run it is spilled
+straight away. A later run that sees the spill file loads it together with its
+own rows, and only deletes it once they are loaded.
+
+The spill file is only durable where its directory is: on Cloud Run /tmp is
+in-memory and lost with the instance, so point AUDIT_SPILL_DIR at a mounted
+volume (e.g. a Cloud Storage FUSE mount) to carry spilled rows over to the next
+execution. Every spilled row is also logged as an ERROR entry (jsonPayload
+audit_entry), so it can be recovered from Cloud Logging either way.
+"""
+
+import atexit
+import glob
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+
+from google.cloud import bigquery
+
+from run_metrics import METRICS
+
+AUDIT_CONFIG = {
+    'flush_interval_seconds': 300,   # Flush at most this often during the run (None: only at the end)
+    'spill_path': os.path.join(os.environ.get('AUDIT_SPILL_DIR') or os.environ.get('TMPDIR', '/tmp'),
+                               'etl_audit_log.spill.ndjson'),
+}
+
+
+def _to_json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class AuditLogWriter(object):
+    """Thread-safe buffer of audit rows, flushed to BigQuery in batches."""
+
+    def __init__(self, client, table_id, schema, config=None):
+        self.client = client
+        self.table_id = table_id
+        self.schema = schema
+        self.config = {**AUDIT_CONFIG, **(config or {})}
+        self._rows = []
+        self._inflight = []
+        self._claimed = []
+        # Re-entrant: the SIGTERM handler takes it in the main thread, which may already hold it
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._closed = False
+        self._recover_spill_file()
+
+    def _recover_spill_file(self):
+        """
+        Buffers rows a previous run could not write, so they go out with this run's rows.
+
+        The spill file is claimed by renaming it (so concurrent runs don't load it twice)
+        and only deleted once the rows are loaded or spilled again. Claimed files left by
+        a run that died before that are recovered too.
+        """
+        path = self.config['spill_path']
+        candidates = [p for p in glob.glob(f"{glob.escape(path)}.*.recovering") if _orphaned(p)]
+        if os.path.exists(path):
+            claimed = f"{path}.{os.getpid()}.{time.time_ns()}.recovering"
+            try:
+                os.rename(path, claimed)
+                candidates.append(claimed)
+            except FileNotFoundError:
+                pass    # Claimed by another run
+        recovered = []
+        for candidate in candidates:
+            with open(candidate) as f:
+                recovered.extend(json.loads(line) for line in f if line.strip())
+        self._claimed = candidates
+        if recovered:
+            print(f"♻️ Recovered {len(recovered)} audit entries from spill file {path}.")
+            self._rows.extend(recovered)
+
+    def _release_claimed(self):
+        """Deletes the claimed spill files once their rows are loaded or spilled again."""
+        with self._lock:
+            claimed, self._claimed = self._claimed, []
+        for path in claimed:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def add(self, row):
+        """Buffers one audit row; flushes if the flush interval has elapsed."""
+        with self._lock:
+            self._rows.append({k: _to_json_value(v) for k, v in row.items()})
+        interval = self.config['flush_interval_seconds']
+        if interval is not None and time.monotonic() - self._last_flush >= interval:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered rows with one load job; spills them locally if that fails."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                self._inflight = rows
+            self._last_flush = time.monotonic()
+            if not rows:
+                return
+
+            job_config = bigquery.LoadJobConfig(
+                schema=self.schema,
+                write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            )
+            try:
+                with METRICS.stage('audit_flush') as stage:
+                    job = self.client.load_table_from_json(rows, self.table_id, job_config=job_config)
+                    job.result()
+                    stage.add(rows=len(rows))
+                print(f"✅ Logged {len(rows)} audit entries to {self.table_id} in one load job.")
+            except Exception as e:
+                sys.stderr.write(f"🔴 ERROR: Failed to write {len(rows)} audit entries. Error: {e}\n")
+                self._spill(rows)
+            finally:
+                with self._lock:
+                    self._inflight = []
+            # Recovered rows went out with the first flush, loaded or spilled again
+            self._release_claimed()
+
+    def _spill(self, rows):
+        """Logs the rows (the copy that survives the instance) and appends them to the spill file."""
+        path = self.config['spill_path']
+        for row in rows:
+            sys.stderr.write(json.dumps({
+                'severity': 'ERROR',
+                'message': f"audit entry not written to {self.table_id}, spilled to {path}",
+                'audit_entry': row,
+            }) + '\n')
+        try:
+            with open(path, 'a') as f:
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
+        except OSError as e:
+            sys.stderr.write(f"🔴 ERROR: Could not spill {len(rows)} audit entries to {path}: {e}. "
+                             f"They are only in the ERROR log entries above.\n")
+            return
+        sys.stderr.write(f"💾 Spilled {len(rows)} audit entries to {path}; a later run on the same volume "
+                         f"loads them (they are also in the ERROR log entries above).\n")
+
+    def close(self):
+        """Final flush. Safe to call more than once (main() and atexit both call it)."""
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+
+    def _on_sigterm(self, signum, frame):
+        """
+        Spills the buffered (and in-flight) rows and exits right away.
+
+        Cloud Run kills the container ~10s after SIGTERM, long before the account
+        pools would drain, so there is no time for a final load job.
+        """
+        with self._lock:
+            rows, self._rows = self._inflight + self._rows, []
+            self._closed = True
+        if rows:
+            self._spill(rows)
+        self._release_claimed()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(128 + signum)
+
+    def install_exit_handlers(self):
+        """Flushes on interpreter exit, and spills the buffer on SIGTERM."""
+        atexit.register(self.close)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._on_sigterm)
+
+
+def _orphaned(path):
+    """True if a claimed spill file (<spill_path>.<pid>.<ns>.recovering) belongs to a run that is gone."""
+    try:
+        pid = int(path.rsplit('.', 3)[1])
+    except (IndexError, ValueError):
+        return False
+    if pid == os.getpid():
+        return True     # A previous run in a container that reuses pids
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
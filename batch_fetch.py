@@ -0,0 +1,256 @@
+"""
+Graph API batch requests for the structure fetches (campaigns, adsets, ads).
+
+Fetching structure the plain way costs one HTTP round trip per page, per entity
+type, per account. Here every (account, edge) fetch is registered up front as a
+stream, and a single background thread packs the pending page requests of all
+streams, across entity types and accounts, into Graph API batch calls of up to
+50 sub-requests. Paging cursors are followed the same way: the next page of a
+stream is requested in a later batch.
+
+Requests are demand driven: a stream holds at most one page its consumer has not
+taken yet, so accounts that are not being loaded yet only cost their first page
+in memory, and the fetcher never blocks on a slow consumer.
+
+Every sub-request still goes through the rate limit governor of the default api
+(per account), and throttled sub-requests are retried after the wait Meta reports.
+"""
+
+import threading
+import time
+from collections import deque
+
+from rate_limiter import CALL_TYPE_MANAGEMENT, is_throttle_error
+
+BATCH_FETCH_CONFIG = {
+    'max_batch_size': 50,       # Graph API limit on sub-requests per batch call
+    'linger_seconds': 0.05,     # Wait this long for more requests before sending a partial batch
+    'page_limit': 100,          # Objects per page (sub-request)
+    'max_batch_retries': 3,     # Resends of sub-requests that got no response (e.g. timed out)
+}
+
+
+class _EdgeStream(object):
+    """Paging state of one (ad account, edge) fetch."""
+
+    def __init__(self, ad_account_id, edge, fields, params):
+        self.ad_account_id = ad_account_id
+        self.edge = edge
+        self.params = {**(params or {}), 'fields': ','.join(fields)}
+        self.after = None
+        self.pages = deque()
+        self.wanted = True          # The consumer needs (or will soon need) the next page
+        self.inflight = False
+        self.done = False
+        self.error = None
+        self.not_before = 0.0
+        self.throttle_attempts = 0
+        self.rows_fetched = 0
+        self.consumed = False
+
+    def waiting(self):
+        return self.wanted and not self.inflight and not self.done and self.error is None
+
+    def ready(self, now):
+        return self.waiting() and self.not_before <= now
+
+
+class BatchedEdgeFetcher(object):
+    """
+    Fetches many paged Graph API edges through shared batch calls.
+
+    Usage: register() every (account, edge), start(), then iter_pages() from any
+    thread; close() when done.
+    """
+
+    def __init__(self, api, config=None):
+        self.api = api
+        self.governor = getattr(api, 'governor', None)
+        self.config = {**BATCH_FETCH_CONFIG, **(config or {})}
+        self._streams = {}
+        self._registrations = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._fatal = None          # Why the fetcher thread stopped, if it died
+        self.batches_sent = 0
+        self.requests_sent = 0
+
+    def register(self, ad_account_id, edge, fields, params=None):
+        """Registers the fetch of an edge (e.g. 'campaigns') of an ad account."""
+        with self._cond:
+            self._registrations[(ad_account_id, edge)] = (fields, params)
+            self._streams[(ad_account_id, edge)] = _EdgeStream(ad_account_id, edge, fields, params)
+            self._cond.notify_all()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='batched-edge-fetcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def iter_pages(self, ad_account_id, edge):
+        """
+        Yields the pages (lists of dicts) of a registered edge; raises the fetch error if it failed.
+
+        Iterating an edge again (a retry) fetches it again from its first page.
+        """
+        with self._cond:
+            stream = self._streams[(ad_account_id, edge)]
+            if stream.consumed:
+                # A request still in flight for the old stream updates that object only
+                stream = _EdgeStream(ad_account_id, edge, *self._registrations[(ad_account_id, edge)])
+                self._streams[(ad_account_id, edge)] = stream
+            stream.consumed = True
+        print(f"  -> Starting batched fetch for {edge}...")
+        while True:
+            with self._cond:
+                while not stream.pages and not stream.done and stream.error is None:
+                    stream.wanted = True
+                    self._cond.notify_all()
+                    self._check_fetcher()
+                    self._cond.wait(1.0)
+                if stream.pages:
+                    page = stream.pages.popleft()
+                    if not stream.done:
+                        # Ask for the next page now so it arrives while this one is loaded
+                        stream.wanted = True
+                        self._cond.notify_all()
+                elif stream.error is not None:
+                    raise stream.error
+                else:
+                    print(f"  -> Completed batched fetch for {edge}. Total entities: {stream.rows_fetched}")
+                    return
+            yield page
+
+    def _check_fetcher(self):
+        """Raises in a waiting consumer if the fetcher thread died (nothing would wake it up otherwise)."""
+        if self._fatal is not None:
+            raise RuntimeError(f"Batched structure fetcher stopped: {self._fatal}") from self._fatal
+        if self._thread is not None and not self._thread.is_alive() and not self._closed:
+            raise RuntimeError("Batched structure fetcher stopped unexpectedly")
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    picked = self._pick_requests()
+                    if picked is None:
+                        return
+                if picked:
+                    self._execute(picked)
+        except BaseException as e:
+            with self._cond:
+                self._fatal = e
+                self._cond.notify_all()
+            raise
+
+    def _pick_requests(self):
+        """Waits for requests to send and returns up to max_batch_size streams (None once closed)."""
+        max_batch_size = self.config['max_batch_size']
+        while True:
+            if self._closed:
+                return None
+            now = time.monotonic()
+            ready = [s for s in self._streams.values() if s.ready(now)]
+            if ready:
+                break
+            delays = [s.not_before - now for s in self._streams.values() if s.waiting()]
+            self._cond.wait(min(delays) if delays else None)
+
+        if len(ready) < max_batch_size and self.config['linger_seconds']:
+            # Let consumers that are about to ask for their next page join this batch
+            self._cond.wait(self.config['linger_seconds'])
+            now = time.monotonic()
+            ready = [s for s in self._streams.values() if s.ready(now)]
+
+        picked = []
+        for stream in ready:
+            if len(picked) >= max_batch_size:
+                break
+            wait = self.governor.try_acquire(stream.ad_account_id, CALL_TYPE_MANAGEMENT) if self.governor else 0
+            if wait > 0:
+                stream.not_before = now + wait
+                continue
+            stream.inflight = True
+            picked.append(stream)
+        return picked
+
+    def _execute(self, streams):
+        batch = self.api.new_batch()
+        for stream in streams:
+            params = {**stream.params, 'limit': self.config['page_limit']}
+            if stream.after:
+                params['after'] = stream.after
+            batch.add(
+                'GET', (stream.ad_account_id, stream.edge), params=params,
+                success=lambda response, stream=stream: self._on_success(stream, response),
+                failure=lambda response, stream=stream: self._on_failure(stream, response),
+            )
+
+        with self._cond:
+            self.batches_sent += 1
+            self.requests_sent += len(streams)
+
+        try:
+            retries = 0
+            # execute() returns a batch of the sub-requests that got no response
+            while batch is not None:
+                batch = batch.execute()
+                if batch is not None:
+                    retries += 1
+                    if retries > self.config['max_batch_retries']:
+                        raise RuntimeError(f"{len(batch)} batched requests got no response after {retries - 1} retries")
+        except Exception as e:
+            with self._cond:
+                for stream in streams:
+                    if stream.inflight:
+                        stream.inflight = False
+                        stream.error = e
+                self._cond.notify_all()
+
+    def _on_success(self, stream, response):
+        if self.governor:
+            self.governor.observe(stream.ad_account_id, CALL_TYPE_MANAGEMENT, response.headers())
+        body = response.json()
+        page = body.get('data', [])
+        paging = body.get('paging') or {}
+        after = (paging.get('cursors') or {}).get('after')
+
+        with self._cond:
+            stream.inflight = False
+            stream.throttle_attempts = 0
+            stream.rows_fetched += len(page)
+            if page:
+                stream.pages.append(page)
+            stream.after = after
+            stream.done = not (paging.get('next') and after)
+            # An empty page with a next cursor (possible with filtering) is followed straight away
+            stream.wanted = not stream.pages and not stream.done
+            self._cond.notify_all()
+
+    def _on_failure(self, stream, response):
+        error = response.error()
+        if (self.governor and is_throttle_error(error)
+                and stream.throttle_attempts < self.governor.config['max_throttle_retries']):
+            wait = self.governor.on_throttled(stream.ad_account_id, CALL_TYPE_MANAGEMENT, error,
+                                              stream.throttle_attempts)
+            print(f"  🛑 Meta rate limit hit for {stream.ad_account_id} ({stream.edge}, batched). "
+                  f"Backing off {wait:.0f}s as reported (attempt {stream.throttle_attempts + 1})...")
+            with self._cond:
+                stream.inflight = False
+                stream.throttle_attempts += 1
+                stream.not_before = time.monotonic() + wait
+                self._cond.notify_all()
+            return
+
+        with self._cond:
+            stream.inflight = False
+            stream.error = error
+            self._cond.notify_all()
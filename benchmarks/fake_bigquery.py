@@ -0,0 +1,141 @@
+"""
+In-memory stand-in for google.cloud.bigquery.Client, for benchmarking.
+
+Implements the calls the ETL makes (datasets, tables, queries, load jobs and
+streaming inserts). Loads are parsed, so their cost on our side (Parquet/JSON
+serialization) is real, and only row counts and schemas are kept. Queries
+(MERGE, DELETE, state reads) return no rows. load_latency_seconds and
+query_latency_seconds stand in for BigQuery's job latency.
+"""
+
+import io
+import threading
+import time
+
+import pyarrow.parquet as pq
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+_ARROW_TO_BIGQUERY = [
+    ('timestamp', 'TIMESTAMP'), ('date', 'DATE'), ('int', 'INT64'), ('double', 'FLOAT64'),
+    ('float', 'FLOAT64'), ('bool', 'BOOL'), ('list', 'STRING'), ('struct', 'RECORD'),
+]
+
+
+def _schema_from_arrow(arrow_schema):
+    fields = []
+    for field in arrow_schema:
+        type_name = str(field.type)
+        field_type = next((bq for prefix, bq in _ARROW_TO_BIGQUERY if type_name.startswith(prefix)), 'STRING')
+        fields.append(bigquery.SchemaField(field.name, field_type))
+    return fields
+
+
+class _Job(object):
+    def __init__(self, rows=None):
+        self._rows = rows or []
+
+    def result(self):
+        return self._rows
+
+
+class FakeBigQueryClient(object):
+    """Records what would be written to BigQuery; stats counts jobs, rows and bytes."""
+
+    def __init__(self, project='benchmark-project', load_latency_seconds=0.0, query_latency_seconds=0.0):
+        self.project = project
+        self.load_latency_seconds = load_latency_seconds
+        self.query_latency_seconds = query_latency_seconds
+        self._datasets = {}
+        self._tables = {}
+        self._lock = threading.Lock()
+        self.stats = {'load_jobs': 0, 'rows_loaded': 0, 'bytes_loaded': 0, 'queries': 0, 'rows_inserted': 0}
+        self.rows_by_table = {}
+
+    def _count(self, **counts):
+        with self._lock:
+            for key, n in counts.items():
+                self.stats[key] += n
+
+    @staticmethod
+    def _table_id(table):
+        return table if isinstance(table, str) else f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+    # --- Datasets and tables ---
+
+    def dataset(self, dataset_id):
+        return bigquery.DatasetReference(self.project, dataset_id)
+
+    def get_dataset(self, dataset_ref):
+        if dataset_ref.dataset_id not in self._datasets:
+            raise NotFound(f"Not found: Dataset {self.project}:{dataset_ref.dataset_id}")
+        dataset = bigquery.Dataset(dataset_ref)
+        dataset.labels = dict(self._datasets[dataset_ref.dataset_id])
+        return dataset
+
+    def create_dataset(self, dataset, exists_ok=False):
+        self._datasets.setdefault(dataset.dataset_id, {})
+        return dataset
+
+    def update_dataset(self, dataset, fields):
+        with self._lock:
+            self._datasets[dataset.dataset_id].update(dataset.labels or {})
+        return dataset
+
+    def get_table(self, table):
+        table_id = self._table_id(table)
+        with self._lock:
+            if table_id not in self._tables:
+                raise NotFound(f"Not found: Table {table_id}")
+            return self._tables[table_id]
+
+    def create_table(self, table, exists_ok=False):
+        table = bigquery.Table(table) if isinstance(table, str) else table
+        with self._lock:
+            return self._tables.setdefault(self._table_id(table), table)
+
+    def update_table(self, table, fields):
+        with self._lock:
+            self._tables[self._table_id(table)] = table
+        return table
+
+    def delete_table(self, table, not_found_ok=False):
+        with self._lock:
+            self._tables.pop(self._table_id(table), None)
+
+    # --- Jobs ---
+
+    def query(self, sql, job_config=None):
+        time.sleep(self.query_latency_seconds)
+        self._count(queries=1)
+        return _Job()
+
+    def _loaded(self, table_id, rows, num_bytes, schema):
+        time.sleep(self.load_latency_seconds)
+        self._count(load_jobs=1, rows_loaded=rows, bytes_loaded=num_bytes)
+        with self._lock:
+            self.rows_by_table[table_id] = self.rows_by_table.get(table_id, 0) + rows
+            if table_id not in self._tables:
+                self._tables[table_id] = bigquery.Table(table_id, schema=schema)
+        return _Job()
+
+    def load_table_from_file(self, file_obj, destination, job_config=None):
+        data = file_obj.read()
+        table = pq.read_table(io.BytesIO(data))
+        schema = (job_config and job_config.schema) or _schema_from_arrow(table.schema)
+        return self._loaded(self._table_id(destination), table.num_rows, len(data), schema)
+
+    def load_table_from_dataframe(self, dataframe, destination, job_config=None):
+        buffer = io.BytesIO()
+        dataframe.to_parquet(buffer)
+        schema = (job_config and job_config.schema) or [bigquery.SchemaField(c, 'STRING') for c in dataframe.columns]
+        return self._loaded(self._table_id(destination), len(dataframe), buffer.tell(), schema)
+
+    def load_table_from_json(self, rows, destination, job_config=None):
+        rows = list(rows)
+        schema = (job_config and job_config.schema) or []
+        return self._loaded(self._table_id(destination), len(rows), 0, schema)
+
+    def insert_rows_json(self, table, rows):
+        self._count(rows_inserted=len(rows))
+        return []
@@ -0,0 +1,375 @@
+"""
+Local stand-in for the Graph API endpoints the ETL uses, for benchmarking.
+
+Serves, for synthetic ad accounts:
+
+- GET  act_<id>/campaigns|adsets|ads        cursor paging, `filtering` on updated_time
+- GET  act_<id>/insights                    synchronous insights (time_range, level, breakdowns)
+- POST act_<id>/insights                    creates an async report run
+- GET  <report_run_id>                      report status (completes after report_seconds)
+- GET  <report_run_id>/insights             report result pages
+- POST /  (batch=[...])                     Graph API batch requests
+
+Every response carries the X-Business-Use-Case-Usage, X-Ad-Account-Usage and
+X-FB-Ads-Insights-Throttle headers, computed from the calls made to the account
+within a sliding window. Once an account's call_budget is used up, calls fail
+with error 17 and the time until the window frees up, like Meta does.
+
+Field values are generated from the kinds in schemas.py, so pages look like
+Meta's (numbers as strings, action lists, JSON objects, ...).
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from schemas import FIELD_KINDS, INSIGHT_FIELD_KINDS, STRUCTURE_FIELD_KINDS
+
+ACCOUNT_DEFAULTS = {
+    'campaigns': 10,
+    'adsets_per_campaign': 4,
+    'ads_per_adset': 5,
+    'latency_ms': 30,               # Added to every HTTP request (once per batch call)
+    'report_seconds': 1.0,          # Time until an async report run completes
+    'max_report_days': None,        # Report runs over more days than this fail (forces window splits)
+    'call_budget': None,            # Calls allowed per budget_window_seconds (None: unlimited)
+    'budget_window_seconds': 60,
+}
+
+PLACEMENTS = [('facebook', 'feed'), ('facebook', 'story'), ('instagram', 'stream'), ('instagram', 'reels')]
+STRUCTURE_EDGES = ('campaigns', 'adsets', 'ads')
+UPDATED_TIME_BASE = datetime(2026, 1, 1, tzinfo=timezone.utc)
+_VERSION = re.compile(r'^v\d+(\.\d+)?$')
+
+
+class GraphError(Exception):
+    def __init__(self, status, code, message, headers=None, subcode=None):
+        super(GraphError, self).__init__(message)
+        self.status = status
+        self.body = {'error': {'message': message, 'type': 'OAuthException', 'code': code,
+                               'error_subcode': subcode, 'fbtrace_id': 'benchmark'}}
+        self.headers = headers or {}
+
+
+class _Account(object):
+    """Synthetic account: its entity counts, latency and call budget."""
+
+    def __init__(self, ad_account_id, profile):
+        self.id = ad_account_id
+        self.profile = {**ACCOUNT_DEFAULTS, **(profile or {})}
+        self.number = ad_account_id.replace('act_', '')
+        campaigns = self.profile['campaigns']
+        self.counts = {
+            'campaign': campaigns,
+            'adset': campaigns * self.profile['adsets_per_campaign'],
+            'ad': campaigns * self.profile['adsets_per_campaign'] * self.profile['ads_per_adset'],
+        }
+        self.calls = deque()
+        self.lock = threading.Lock()
+
+    def entity_id(self, level, index):
+        return f"{self.number}{'cva'.index(level[0]) + 1}{index:07d}"
+
+    def parents(self, level, index):
+        """ids of the campaign / adset an entity belongs to."""
+        ids = {f'{level}_id': self.entity_id(level, index)}
+        if level == 'ad':
+            index //= self.profile['ads_per_adset']
+            ids['adset_id'] = self.entity_id('adset', index)
+        if level in ('ad', 'adset'):
+            index //= self.profile['adsets_per_campaign']
+            ids['campaign_id'] = self.entity_id('campaign', index)
+        return ids
+
+    def updated_time(self, index):
+        # Spread over the 30 days before UPDATED_TIME_BASE, so updated_time filters select a share
+        return UPDATED_TIME_BASE - timedelta(seconds=(index * 7919) % (30 * 86400))
+
+    def record_call(self, call_type):
+        """Counts a call against the budget; returns its throttle headers or raises the throttle error."""
+        budget = self.profile['call_budget']
+        window = self.profile['budget_window_seconds']
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and self.calls[0] <= now - window:
+                self.calls.popleft()
+            if budget and len(self.calls) >= budget:
+                reset = max(1, int(self.calls[0] + window - now + 1))
+                raise GraphError(400, 17, 'User request limit reached',
+                                 self._usage_headers(100.0, reset, call_type), subcode=2446079)
+            self.calls.append(now)
+            pct = 100.0 * len(self.calls) / budget if budget else 1.0
+        return self._usage_headers(pct, window, call_type)
+
+    def _usage_headers(self, pct, reset_seconds, call_type):
+        headers = {
+            'X-Business-Use-Case-Usage': json.dumps({self.number: [{
+                'type': call_type, 'call_count': pct, 'total_cputime': pct / 2, 'total_time': pct / 2,
+                'estimated_time_to_regain_access': 0,
+            }]}),
+            'X-Ad-Account-Usage': json.dumps({'acc_id_util_pct': pct, 'reset_time_duration': reset_seconds}),
+        }
+        if call_type == 'ads_insights':
+            headers['X-FB-Ads-Insights-Throttle'] = json.dumps({'app_id_util_pct': 0, 'acc_id_util_pct': pct})
+        return headers
+
+
+def _fields(params, default=''):
+    """The requested fields, sent either comma separated or JSON encoded."""
+    fields = params.get('fields', default)
+    fields = json.loads(fields) if fields.startswith('[') else fields.split(',')
+    return [f.strip() for f in fields if f.strip()]
+
+
+def _value(field, kind, rng, index):
+    if kind == 'int':
+        return str(rng.randint(0, 10000))
+    if kind == 'float':
+        return f"{rng.random() * 100:.2f}"
+    if kind == 'bool':
+        return rng.random() < 0.5
+    if kind == 'timestamp':
+        return '2025-06-01T12:00:00+0000'
+    if kind == 'date':
+        return '2025-06-01'
+    if kind == 'json':
+        return {'id': str(index), 'name': f'{field} {index}'}
+    if kind == 'strings':
+        return ['A', 'B']
+    if kind == 'actions':
+        return [{'action_type': t, 'value': str(rng.randint(1, 50))}
+                for t in ('link_click', 'landing_page_view', 'offsite_conversion.fb_pixel_purchase')]
+    if kind == 'results':
+        return [{'indicator': 'actions:link_click',
+                 'values': [{'value': str(rng.randint(1, 50)), 'attribution_windows': ['default']}]}]
+    return f'{field} {index}'
+
+
+class FakeGraphApi(object):
+    """
+    The fake Graph API server.
+
+    accounts maps ad account ids to profiles (see ACCOUNT_DEFAULTS). Use start()
+    and point FacebookSession.GRAPH at url; stats counts the requests served.
+    """
+
+    def __init__(self, accounts, host='127.0.0.1', port=0):
+        self.accounts = {account_id: _Account(account_id, profile) for account_id, profile in accounts.items()}
+        self._reports = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                api._serve(self, 'GET')
+
+            def do_POST(self):
+                api._serve(self, 'POST')
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.url = f"http://{host}:{self._server.server_address[1]}"
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-graph-api', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {'http_requests': 0, 'batch_calls': 0, 'graph_calls': 0, 'throttled': 0,
+                          'rows_served': 0, 'calls_by_endpoint': {}}
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    # --- HTTP ---
+
+    def _serve(self, handler, method):
+        url = urlsplit(handler.path)
+        if url.path == '/__benchmark/stats':
+            with self._lock:
+                return self._respond(handler, 200, json.loads(json.dumps(self.stats)), {})
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if method == 'POST':
+            length = int(handler.headers.get('Content-Length') or 0)
+            params.update({k: v[0] for k, v in parse_qs(handler.rfile.read(length).decode()).items()})
+
+        self._count('http_requests')
+        tokens = self._path_tokens(url.path)
+        account = self.accounts.get(tokens[0]) if tokens else None
+        latency_ms = account.profile['latency_ms'] if account else max(
+            [a.profile['latency_ms'] for a in self.accounts.values()] or [0])
+        time.sleep(latency_ms / 1000.0)
+
+        if method == 'POST' and not tokens and 'batch' in params:
+            self._count('batch_calls')
+            status, body, headers = 200, self._batch(json.loads(params['batch'])), {}
+        else:
+            status, body, headers = self._call(method, tokens, params)
+
+        self._respond(handler, status, body, headers)
+
+    def _respond(self, handler, status, body, headers):
+        data = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _path_tokens(self, path):
+        tokens = [t for t in path.split('/') if t]
+        return tokens[1:] if tokens and _VERSION.match(tokens[0]) else tokens
+
+    def _batch(self, requests):
+        responses = []
+        for request in requests:
+            url = urlsplit('/' + request['relative_url'].lstrip('/'))
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            params.update({k: v[0] for k, v in parse_qs(request.get('body') or '').items()})
+            status, body, headers = self._call(request['method'], self._path_tokens(url.path), params)
+            responses.append({'code': status, 'body': json.dumps(body),
+                              'headers': [{'name': k, 'value': v} for k, v in headers.items()]})
+        return responses
+
+    def _call(self, method, tokens, params):
+        """Serves one Graph API call; returns (status, body, headers)."""
+        self._count('graph_calls')
+        try:
+            if len(tokens) == 2 and tokens[0] in self.accounts:
+                account, edge = self.accounts[tokens[0]], tokens[1]
+                endpoint = f"{method} {edge}"
+                call_type = 'ads_insights' if edge == 'insights' else 'ads_management'
+                headers = account.record_call(call_type)
+                if edge in STRUCTURE_EDGES and method == 'GET':
+                    body = self._structure_page(account, edge, params)
+                elif edge == 'insights' and method == 'GET':
+                    body = self._insights_page(account, params, f'act_{account.number}/insights')
+                elif edge == 'insights' and method == 'POST':
+                    body = self._create_report(account, params)
+                else:
+                    raise GraphError(400, 100, f'Unsupported request: {method} {edge}')
+            elif tokens and tokens[0] in self._reports:
+                report = self._reports[tokens[0]]
+                account = self.accounts[report['account']]
+                headers = account.record_call('ads_insights')
+                if len(tokens) == 1:
+                    endpoint, body = 'GET report_run', self._report_status(tokens[0], report)
+                else:
+                    endpoint = 'GET report_run/insights'
+                    body = self._insights_page(account, {**report['params'], **params}, f'{tokens[0]}/insights')
+            else:
+                raise GraphError(404, 803, f"Unknown object: {'/'.join(tokens)}")
+        except GraphError as e:
+            if e.body['error']['code'] == 17:
+                self._count('throttled')
+            return e.status, e.body, e.headers
+
+        with self._lock:
+            by_endpoint = self.stats['calls_by_endpoint']
+            by_endpoint[endpoint] = by_endpoint.get(endpoint, 0) + 1
+            self.stats['rows_served'] += len(body.get('data', []))
+        return 200, body, headers
+
+    # --- Endpoints ---
+
+    def _paged(self, total, params, path, make_rows):
+        start = int(params.get('after') or 0)
+        end = min(total, start + int(params.get('limit') or 25))
+        body = {'data': make_rows(start, end)}
+        if total:
+            body['paging'] = {'cursors': {'before': str(start), 'after': str(end)}}
+            if end < total:
+                body['paging']['next'] = f"{self.url}/{path}?after={end}"
+        return body
+
+    def _structure_page(self, account, edge, params):
+        level = edge[:-1]
+        fields = _fields(params, 'id')
+        kinds = {**FIELD_KINDS, **STRUCTURE_FIELD_KINDS}
+        indexes = range(account.counts[level])
+        for condition in json.loads(params.get('filtering') or '[]'):
+            if condition.get('field') == 'updated_time' and condition.get('operator') == 'GREATER_THAN':
+                since = datetime.fromtimestamp(int(condition['value']), timezone.utc)
+                indexes = [i for i in indexes if account.updated_time(i) > since]
+
+        def make_rows(start, end):
+            rows = []
+            for i in list(indexes)[start:end]:
+                rng = random.Random(f"{account.id}{edge}{i}")
+                row = {f: _value(f, kinds.get(f, 'string'), rng, i) for f in fields}
+                row.update({k: v for k, v in account.parents(level, i).items() if k in fields or k == f'{level}_id'})
+                row['id'] = row.pop(f'{level}_id')
+                row['account_id'] = account.number
+                row['updated_time'] = account.updated_time(i).strftime('%Y-%m-%dT%H:%M:%S+0000')
+                rows.append(row)
+            return rows
+
+        return self._paged(len(indexes), params, f'act_{account.number}/{edge}', make_rows)
+
+    def _insights_page(self, account, params, path):
+        level = params.get('level', 'ad')
+        time_range = params['time_range']
+        time_range = json.loads(time_range) if isinstance(time_range, str) else time_range
+        since = date.fromisoformat(time_range['since'])
+        days = (date.fromisoformat(time_range['until']) - since).days + 1
+        fields = _fields(params)
+        kinds = {**FIELD_KINDS, **INSIGHT_FIELD_KINDS}
+        entities = account.counts[level]
+        per_day = entities * len(PLACEMENTS)
+
+        def make_rows(start, end):
+            rows = []
+            for r in range(start, end):
+                day = since + timedelta(days=r // per_day)
+                entity, placement = (r % per_day) // len(PLACEMENTS), PLACEMENTS[r % len(PLACEMENTS)]
+                rng = random.Random(f"{account.id}{level}{r}{day}")
+                row = {f: _value(f, kinds.get(f, 'string'), rng, entity) for f in fields}
+                row.update(account.parents(level, entity))
+                row.update({'account_id': account.number, 'date_start': day.isoformat(), 'date_stop': day.isoformat(),
+                            'publisher_platform': placement[0], 'platform_position': placement[1]})
+                rows.append(row)
+            return rows
+
+        return self._paged(days * per_day, params, path, make_rows)
+
+    def _create_report(self, account, params):
+        with self._lock:
+            report_run_id = f"9{len(self._reports) + 1:09d}"
+            self._reports[report_run_id] = {'account': account.id, 'params': params, 'created': time.monotonic()}
+        return {'report_run_id': report_run_id}
+
+    def _report_status(self, report_run_id, report):
+        account = self.accounts[report['account']]
+        time_range = json.loads(report['params']['time_range'])
+        days = (date.fromisoformat(time_range['until']) - date.fromisoformat(time_range['since'])).days + 1
+        elapsed = time.monotonic() - report['created']
+        max_days = account.profile['max_report_days']
+        if max_days and days > max_days:
+            status, percent = 'Job Failed', 0
+        elif elapsed >= account.profile['report_seconds']:
+            status, percent = 'Job Completed', 100
+        else:
+            status, percent = 'Job Running', int(100 * elapsed / account.profile['report_seconds'])
+        return {'id': report_run_id, 'async_status': status, 'async_percent_completion': percent}
@@ -0,0 +1,308 @@
+"""
+Offline benchmark of the ETL against a fake Graph API and a fake BigQuery client.
+
+    python benchmarks/run_benchmark.py --profile small
+    python benchmarks/run_benchmark.py --profile medium --stages main --run-config streaming=false
+    python benchmarks/run_benchmark.py --profile throttled --set latency_ms=100 --output bench.json
+    python benchmarks/run_benchmark.py --profile small --stages main --raw-archive
+
+Nothing leaves the machine: this process serves the synthetic accounts of the
+profile (see fake_graph_api.py) and runs every stage in a fresh child process,
+so memory peaks, the rate limiter and module state do not leak between stages.
+
+Stages:
+- fetch: fetch_meta_data() for every account, as main() runs it in batch mode
+- load:  build_dataframes() + load_data_to_bigquery() of every table (the data
+         is fetched first, outside the measurement)
+- main:  main() end to end, with RUN_CONFIG (plus --run-config overrides)
+
+Per stage the JSON report has wall_seconds, rows, rows_per_second, api (HTTP
+requests, batch calls, Graph calls, throttled calls), sleep_seconds (every
+time.sleep, summed over threads), pacing_seconds (rate limiter sleeps),
+peak_rss_mb and the fake BigQuery's job counts. The ETL's own output goes to a
+log file per stage (log in the report).
+
+The raw archive (raw_archive.py) is off, as in production without
+RAW_ARCHIVE_DIR; --raw-archive writes it to a temporary directory to measure it.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(BENCHMARK_DIR), BENCHMARK_DIR]
+
+from fake_graph_api import FakeGraphApi  # noqa: E402
+
+STAGES = ['fetch', 'load', 'main']
+
+BENCHMARK_PROFILES = {
+    'small': {'accounts': 3, 'account': {
+        'campaigns': 5, 'adsets_per_campaign': 3, 'ads_per_adset': 4, 'latency_ms': 20, 'report_seconds': 0.5,
+    }},
+    'medium': {'accounts': 10, 'account': {
+        'campaigns': 20, 'adsets_per_campaign': 5, 'ads_per_adset': 5, 'latency_ms': 50, 'report_seconds': 2.0,
+    }},
+    'throttled': {'accounts': 3, 'account': {
+        'campaigns': 10, 'adsets_per_campaign': 4, 'ads_per_adset': 5, 'latency_ms': 30, 'report_seconds': 1.0,
+        'call_budget': 12, 'budget_window_seconds': 10,
+    }},
+}
+
+STATE_TABLES = ('etl_audit_log', 'etl_watermarks', 'etl_checkpoints', 'etl_run_metrics')
+
+
+def _parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _parse_assignments(assignments):
+    return {key: _parse_value(value) for key, value in (a.split('=', 1) for a in assignments or [])}
+
+
+def build_accounts(profile_name, overrides, config_path=None):
+    """Synthetic accounts {ad_account_id: profile} from a named profile, --set overrides or a JSON file."""
+    if config_path:
+        with open(config_path) as f:
+            return json.load(f)['accounts']
+    profile = BENCHMARK_PROFILES[profile_name]
+    return {f"act_{1000000 + i}": {**profile['account'], **overrides} for i in range(profile['accounts'])}
+
+
+# --- Child process: runs one stage and measures it ---
+
+class _SleepCounter(object):
+    """Replaces time.sleep to add up the time every thread spends sleeping."""
+
+    def __init__(self):
+        self.total = 0.0
+        self._lock = threading.Lock()
+        self._sleep = time.sleep
+        time.sleep = self.sleep
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.total += max(0.0, seconds)
+        self._sleep(seconds)
+
+
+class _RssSampler(object):
+    """Samples the resident set size while a stage runs and keeps the peak."""
+
+    def __init__(self, current_rss_mb, interval=0.02):
+        self.current_rss_mb = current_rss_mb
+        self.interval = interval
+        self.peak = current_rss_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current_rss_mb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start_mb = self.peak
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current_rss_mb())
+
+
+def _server_stats(graph_url):
+    with urllib.request.urlopen(f"{graph_url}/__benchmark/stats") as response:
+        return json.loads(response.read())
+
+
+def _stats_delta(before, after):
+    delta = {k: after[k] - before[k] for k in after if isinstance(after[k], (int, float))}
+    delta['calls_by_endpoint'] = {
+        endpoint: n - before['calls_by_endpoint'].get(endpoint, 0)
+        for endpoint, n in after['calls_by_endpoint'].items()
+        if n - before['calls_by_endpoint'].get(endpoint, 0)
+    }
+    return delta
+
+
+def run_stage(stage, graph_url, ad_account_ids, run_config, bq_config, log_path):
+    sleeps = _SleepCounter()
+    # The SDK warns about synthetic values outside its enums (e.g. status)
+    warnings.filterwarnings('ignore', module='facebook_business')
+
+    import main
+    from facebook_business.session import FacebookSession
+    from fake_bigquery import FakeBigQueryClient
+    from streaming import current_rss_mb
+
+    FacebookSession.GRAPH = graph_url
+    client = FakeBigQueryClient(**bq_config)
+    main.initialize_bigquery_client = lambda: client
+    main.META_CONFIG['ad_account_ids'] = ad_account_ids
+    main.RUN_CONFIG.update(run_config)
+    from rate_limiter import ThrottledFacebookAdsApi
+    governor = ThrottledFacebookAdsApi.governor
+
+    def new_run(structure_fetcher=True):
+        main.create_bigquery_dataset(client)
+        watermarks = main.WatermarkStore(client, main.BQ_CONFIG['dataset_id'], main.AUDIT_LOG_TABLE,
+                                         main.INSIGHT_TABLES, ad_account_ids).load()
+        checkpoints = main.CheckpointStore(client, main.BQ_CONFIG['dataset_id']).load()
+        run = main.EtlRun(client, datetime.now(), None, watermarks, checkpoints)
+        if structure_fetcher and main.RUN_CONFIG['batch_structure_fetch']:
+            run.start_structure_fetcher(ad_account_ids)
+        return run
+
+    def fetch_all(run):
+        def fetch(ad_account_id):
+            return main.fetch_meta_data(ad_account_id, run.insight_ranges(ad_account_id),
+                                        run.structure_syncs(ad_account_id), run.structure_fetcher)
+        with ThreadPoolExecutor(max_workers=main.RUN_CONFIG['max_concurrent_accounts']) as pool:
+            data = dict(zip(ad_account_ids, pool.map(fetch, ad_account_ids)))
+        if run.structure_fetcher is not None:
+            run.structure_fetcher.close()
+        return data
+
+    def load_all(run, data):
+        def load(ad_account_id):
+            meta_data_py = json.loads(json.dumps(data[ad_account_id]))
+            dataframes = main.build_dataframes(meta_data_py, ad_account_id, run.run_timestamp_dt)
+            for table_name, df in dataframes.items():
+                if not df.empty:
+                    main.load_data_to_bigquery(client, df, table_name)
+        with ThreadPoolExecutor(max_workers=main.RUN_CONFIG['max_concurrent_loads']) as pool:
+            list(pool.map(load, ad_account_ids))
+
+    with open(log_path, 'w') as log, contextlib.redirect_stdout(log):
+        main.initialize_meta_api()
+        data = None
+        if stage == 'load':
+            data = fetch_all(new_run())
+
+        bigquery_before = dict(client.stats)
+        api_before = _server_stats(graph_url)
+        sleep_before, pacing_before, throttle_before = sleeps.total, governor.total_sleep_seconds, governor.throttle_events
+        started = time.perf_counter()
+        with _RssSampler(current_rss_mb) as rss:
+            if stage == 'fetch':
+                data = fetch_all(new_run())
+                rows = sum(len(rows) for account in data.values() for rows in account.values())
+            elif stage == 'load':
+                load_all(new_run(structure_fetcher=False), data)
+                rows = client.stats['rows_loaded'] - bigquery_before['rows_loaded']
+            else:
+                main.main()
+                rows = sum(n for table_id, n in client.rows_by_table.items()
+                           if not table_id.endswith(STATE_TABLES))
+        wall = time.perf_counter() - started
+
+    return {
+        'wall_seconds': round(wall, 3),
+        'rows': rows,
+        'rows_per_second': round(rows / wall, 1) if wall else None,
+        'api': _stats_delta(api_before, _server_stats(graph_url)),
+        'sleep_seconds': round(sleeps.total - sleep_before, 3),
+        'pacing_seconds': round(governor.total_sleep_seconds - pacing_before, 3),
+        'throttle_events': governor.throttle_events - throttle_before,
+        'rss_start_mb': round(rss.start_mb, 1),
+        'peak_rss_mb': round(rss.peak, 1),
+        'bigquery': {k: v - bigquery_before[k] for k, v in client.stats.items()},
+        'log': log_path,
+    }
+
+
+# --- Parent process: serves the fake Graph API and runs the stages ---
+
+def run_benchmark(accounts, stages, run_config, bq_config, raw_archive=False):
+    server = FakeGraphApi(accounts).start()
+    # The children read RAW_ARCHIVE_DIR like the ETL does in production
+    child_env = {k: v for k, v in os.environ.items() if k != 'RAW_ARCHIVE_DIR'}
+    if raw_archive:
+        child_env['RAW_ARCHIVE_DIR'] = tempfile.mkdtemp(prefix='raw_archive_')
+    report = {
+        'started_at': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'accounts': accounts,
+        'run_config': run_config,
+        'bigquery': bq_config,
+        'raw_archive': child_env.get('RAW_ARCHIVE_DIR'),
+        'stages': {},
+    }
+    try:
+        for stage in stages:
+            with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+                result_path = f.name
+            log_path = os.path.join(tempfile.gettempdir(), f"benchmark_{stage}_{os.getpid()}.log")
+            print(f"⏱️ Running stage '{stage}'...", file=sys.stderr)
+            subprocess.run([
+                sys.executable, os.path.abspath(__file__), '--child', stage,
+                '--graph-url', server.url, '--child-accounts', json.dumps(list(accounts)),
+                '--child-run-config', json.dumps(run_config), '--child-bigquery', json.dumps(bq_config),
+                '--child-log', log_path, '--child-result', result_path,
+            ], env=child_env, check=True)
+            with open(result_path) as f:
+                result = json.load(f)
+            os.remove(result_path)
+            report['stages'][stage] = result
+            print(f"   {stage}: {result['wall_seconds']}s, {result['rows']} rows ({result['rows_per_second']}/s), "
+                  f"{result['api']['graph_calls']} Graph calls in {result['api']['http_requests']} requests, "
+                  f"{result['sleep_seconds']}s sleeping, peak {result['peak_rss_mb']} MB", file=sys.stderr)
+    finally:
+        server.stop()
+    return report
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Offline benchmark of the Meta to BigQuery ETL.')
+    parser.add_argument('--profile', choices=list(BENCHMARK_PROFILES), default='small')
+    parser.add_argument('--set', nargs='*', metavar='KEY=VALUE',
+                        help='Override account profile settings (see fake_graph_api.ACCOUNT_DEFAULTS)')
+    parser.add_argument('--config', help='JSON file with {"accounts": {ad_account_id: profile}} instead of --profile')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--run-config', nargs='*', metavar='KEY=VALUE', help='RUN_CONFIG overrides for the ETL')
+    parser.add_argument('--bq-load-latency', type=float, default=0.0, help='Seconds per fake BigQuery load job')
+    parser.add_argument('--bq-query-latency', type=float, default=0.0, help='Seconds per fake BigQuery query')
+    parser.add_argument('--raw-archive', action='store_true', help='Also write the raw archive (to a temporary directory)')
+    parser.add_argument('--output', help='Write the JSON report here (default: stdout)')
+    for name in ('child', 'graph-url', 'child-accounts', 'child-run-config', 'child-bigquery', 'child-log',
+                 'child-result'):
+        parser.add_argument(f'--{name}', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if args.child:
+        result = run_stage(args.child, args.graph_url, json.loads(args.child_accounts),
+                           json.loads(args.child_run_config), json.loads(args.child_bigquery), args.child_log)
+        with open(args.child_result, 'w') as f:
+            json.dump(result, f)
+    else:
+        report = run_benchmark(
+            build_accounts(args.profile, _parse_assignments(args.set), args.config),
+            args.stages, _parse_assignments(args.run_config),
+            {'load_latency_seconds': args.bq_load_latency, 'query_latency_seconds': args.bq_query_latency},
+            args.raw_archive,
+        )
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
@@ -0,0 +1,116 @@
+"""
+Peak-memory measurement for the streaming loader (streaming.py).
+
+Pushes synthetic ad-level insight pages through both load paths, each size in a
+fresh subprocess so ru_maxrss is the peak of that run alone:
+
+- batch:     list of dicts -> json round-trip -> DataFrame -> Parquet (the old path)
+- streaming: page -> Arrow record batch -> ArrowChunkLoader flushes (the new path)
+
+BigQuery is replaced by a stub that just drains the Parquet buffer.
+
+Usage:
+    python benchmarks/streaming_memory.py [rows ...]
+
+Prints one JSON object per (mode, rows) with peak RSS in MB.
+"""
+
+import io
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+DEFAULT_SIZES = [25000, 100000, 400000]
+PAGE_SIZE = 500
+
+
+def synthetic_pages(total_rows):
+    """Yields pages of insight rows shaped like Meta's ad-level insights."""
+    for start in range(0, total_rows, PAGE_SIZE):
+        page = []
+        for i in range(start, min(start + PAGE_SIZE, total_rows)):
+            row = {
+                'account_id': '1401816280975925', 'campaign_id': str(1000 + i % 50),
+                'adset_id': str(2000 + i % 200), 'ad_id': str(3000 + i),
+                'ad_name': f'Ad {i} - summer sale creative', 'campaign_name': 'Summer sale',
+                'date_start': '2026-10-%02d' % (1 + i % 28), 'date_stop': '2026-10-%02d' % (1 + i % 28),
+                'publisher_platform': 'facebook', 'platform_position': 'feed',
+                'impressions': str(i * 7), 'reach': str(i * 5), 'clicks': str(i % 97),
+                'spend': '%.2f' % (i * 0.13), 'cpc': '0.42', 'cpm': '3.1', 'ctr': '1.2',
+                'actions': [{'action_type': t, 'value': str(i % 13)}
+                            for t in ('link_click', 'landing_page_view', 'purchase', 'add_to_cart')],
+                'cost_per_action_type': [{'action_type': 'purchase', 'value': '12.5'}],
+            }
+            page.append(row)
+        yield page
+
+
+class _StubJob(object):
+    def result(self):
+        return None
+
+
+class _StubClient(object):
+    """Stands in for bigquery.Client: consumes the uploaded file and returns a finished job."""
+
+    def load_table_from_file(self, file_obj, table_id, job_config=None):
+        file_obj.read()
+        return _StubJob()
+
+
+def run_batch(total_rows):
+    import pandas as pd
+    rows = [row for page in synthetic_pages(total_rows) for row in page]
+    rows = json.loads(json.dumps(rows))
+    df = pd.DataFrame(rows)
+    df['ad_account_id'] = 'act_1'
+    df['last_run_timestamp'] = datetime.now()
+    df['date_start'] = pd.to_datetime(df['date_start'])
+    df.to_parquet(io.BytesIO())
+    return len(df)
+
+
+def run_streaming(total_rows):
+    from google.cloud import bigquery
+    from streaming import ArrowChunkLoader, page_to_record_batch
+
+    loader = ArrowChunkLoader(_StubClient(), 'p.d.ad_insights', lambda first: bigquery.LoadJobConfig())
+    extra = {'ad_account_id': 'act_1', 'last_run_timestamp': datetime.now()}
+    for page in synthetic_pages(total_rows):
+        loader.add_batch(page_to_record_batch(page, extra, ('date_start',)))
+    return loader.close()
+
+
+def measure(mode, total_rows):
+    """Runs one mode in this process and returns its result record."""
+    import contextlib
+    from streaming import peak_rss_mb
+
+    runner = run_batch if mode == 'batch' else run_streaming
+    # Silence the per-flush progress prints
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = runner(total_rows)
+    return {'mode': mode, 'rows': rows, 'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+
+def main(argv):
+    if argv and argv[0] == '--child':
+        print(json.dumps(measure(argv[1], int(argv[2]))))
+        return
+
+    sizes = [int(a) for a in argv] or DEFAULT_SIZES
+    for mode in ('batch', 'streaming'):
+        for total_rows in sizes:
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', mode, str(total_rows)],
+                check=True, capture_output=True, text=True,
+            )
+            print(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,130 @@
+"""
+Bootstrap manifest: skipping the table checks of a fast start.
+
+Every run used to check that the dataset, the audit and state tables and (in
+merge mode) every MERGE target exist with the expected schema: a get or create
+call per table, and two per MERGE. Once a table has been checked, its manifest
+entry records a fingerprint of the schema (with partitioning and clustering) it
+was verified against, and while the fingerprint still matches the check is
+skipped.
+
+The manifest is kept as labels of the dataset (etl_<table>: <fingerprint>-<date>),
+so the get_dataset call every run makes anyway returns it and nothing needs to
+survive between containers. Entries older than max_age_days are verified again,
+which also recreates a table that was deleted by hand; set enabled=False to
+verify everything on every run.
+"""
+
+import hashlib
+import json
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+
+BOOTSTRAP_CONFIG = {
+    'enabled': True,
+    'max_age_days': 7,          # Checks older than this are done again
+    'label_prefix': 'etl_',
+}
+
+
+def table_fingerprint(schema, time_partitioning=None, clustering_fields=None):
+    """Short hash of the schema, partitioning and clustering a table is expected to have."""
+    spec = {
+        'schema': [field.to_api_repr() for field in schema],
+        'partitioning': time_partitioning.field if time_partitioning is not None else None,
+        'clustering': list(clustering_fields or []),
+    }
+    payload = json.dumps(spec, sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(payload.encode(), digest_size=8).hexdigest()
+
+
+class BootstrapManifest(object):
+    """The tables known to exist with their expected schemas, read from and saved to the dataset labels."""
+
+    def __init__(self, config=None):
+        self.config = {**BOOTSTRAP_CONFIG, **(config or {})}
+        self._dataset = None
+        self._entries = {}
+        self._pending = {}
+        self._skipped = set()
+        self._lock = threading.Lock()
+
+    def _label(self, table_id):
+        name = table_id.split('.')[-1].lower()
+        return re.sub(r'[^a-z0-9_-]', '_', f"{self.config['label_prefix']}{name}")[:63]
+
+    def start(self, dataset):
+        """Reads the manifest from the dataset (as returned by get_dataset or create_dataset)."""
+        with self._lock:
+            self._dataset = dataset
+            self._entries = dict(dataset.labels or {}) if self.config['enabled'] else {}
+            self._pending = {}
+            self._skipped = set()
+        return self
+
+    @property
+    def checks_skipped(self):
+        """Number of tables whose checks were skipped this run."""
+        with self._lock:
+            return len(self._skipped)
+
+    def is_current(self, table_id, schema, time_partitioning=None, clustering_fields=None):
+        """True if the table was recently verified against this schema (its check can be skipped)."""
+        if self._dataset is None or not self.config['enabled']:
+            return False
+        with self._lock:
+            entry = self._pending.get(self._label(table_id)) or self._entries.get(self._label(table_id))
+        if not entry or '-' not in entry:
+            return False
+        fingerprint, verified_on = entry.rsplit('-', 1)
+        if fingerprint != table_fingerprint(schema, time_partitioning, clustering_fields):
+            return False
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.config['max_age_days'])
+        if verified_on < cutoff.strftime('%Y%m%d'):
+            return False
+        with self._lock:
+            self._skipped.add(self._label(table_id))
+        return True
+
+    def record(self, table_id, schema, time_partitioning=None, clustering_fields=None):
+        """Records that the table now exists with this schema (saved with save())."""
+        if self._dataset is None or not self.config['enabled']:
+            return
+        entry = f"{table_fingerprint(schema, time_partitioning, clustering_fields)}-" \
+                f"{datetime.now(timezone.utc).strftime('%Y%m%d')}"
+        with self._lock:
+            self._pending[self._label(table_id)] = entry
+
+    def ensure_table(self, client, table):
+        """
+        create_table(table, exists_ok=True), unless the manifest already has the table.
+        Returns the table from BigQuery, or None if the check was skipped.
+        """
+        if self.is_current(table.table_id, table.schema, table.time_partitioning, table.clustering_fields):
+            return None
+        existing = client.create_table(table, exists_ok=True)
+        self.record(table.table_id, table.schema, table.time_partitioning, table.clustering_fields)
+        return existing
+
+    def save(self, client):
+        """Writes the new manifest entries to the dataset labels with one update."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            dataset = self._dataset
+        if not pending or dataset is None:
+            return
+        try:
+            dataset.labels = {**(dataset.labels or {}), **pending}
+            dataset = client.update_dataset(dataset, ['labels'])
+            with self._lock:
+                self._dataset = dataset
+                self._entries.update(pending)
+            print(f"🧾 Recorded {len(pending)} verified tables in the bootstrap manifest.")
+        except Exception as e:
+            # The tables are only checked again next run
+            print(f"⚠️ Could not save the bootstrap manifest: {e}")
+
+
+# The run's manifest, shared by every module (like run_metrics.METRICS)
+BOOTSTRAP = BootstrapManifest()
@@ -0,0 +1,190 @@
+"""
+Checkpoints for resumable insight loads.
+
+The unit of work is one ad account, insight table (level) and date window. A
+window is recorded as completed once all of its rows have been flushed to
+BigQuery, so a retry (in the same run, or the next run) only fetches the
+windows that are still missing instead of the level's whole date range.
+
+Structure tables need no checkpoints of their own: each entity is one unit
+whose progress is kept by its updated_through watermark (see structure_sync.py).
+
+Checkpoints live in a small BigQuery table (etl_checkpoints, partitioned by
+completion time so old entries expire) or, with backend='local', in an NDJSON
+file, e.g. for running locally.
+"""
+
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import bigquery
+from google.cloud.bigquery import SchemaField, Table
+
+from bootstrap import BOOTSTRAP
+
+CHECKPOINT_CONFIG = {
+    'backend': 'bigquery',      # 'bigquery': etl_checkpoints table; 'local': NDJSON file at local_path
+    'local_path': os.path.join(os.environ.get('TMPDIR', '/tmp'), 'etl_checkpoints.ndjson'),
+    'retention_days': 30,       # Checkpoints older than this are ignored (and expire in BigQuery)
+}
+
+CHECKPOINT_TABLE = 'etl_checkpoints'
+CHECKPOINT_SCHEMA = [
+    SchemaField("ad_account_id", "STRING", mode="REQUIRED"),
+    SchemaField("table_name", "STRING", mode="REQUIRED"),
+    SchemaField("window_start", "DATE", mode="REQUIRED"),
+    SchemaField("window_end", "DATE", mode="REQUIRED"),
+    SchemaField("completed_at", "TIMESTAMP", mode="REQUIRED"),
+]
+
+
+def _to_date(value):
+    return value if not isinstance(value, str) else datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def subtract_windows(since, until, completed):
+    """
+    Returns the contiguous ('YYYY-MM-DD', 'YYYY-MM-DD') gaps of [since, until] that no
+    completed (start, end) window covers.
+    """
+    start, end = _to_date(since), _to_date(until)
+    gaps = []
+    cursor = start
+    for done_start, done_end in sorted(completed):
+        if done_end < cursor or done_start > end:
+            continue
+        if done_start > cursor:
+            gaps.append((cursor, done_start - timedelta(days=1)))
+        cursor = max(cursor, done_end + timedelta(days=1))
+        if cursor > end:
+            break
+    if cursor <= end:
+        gaps.append((cursor, end))
+    return [(a.strftime('%Y-%m-%d'), b.strftime('%Y-%m-%d')) for a, b in gaps]
+
+
+class CheckpointStore(object):
+    """Completed (account, table, date window) units, loaded once per run and appended as they finish."""
+
+    def __init__(self, client, dataset_id, config=None):
+        self.client = client
+        self.config = {**CHECKPOINT_CONFIG, **(config or {})}
+        self.table_id = f"{client.project}.{dataset_id}.{CHECKPOINT_TABLE}"
+        self._completed = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Reads every recent checkpoint with one query (or one file read)."""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.config['retention_days'])
+        if self.config['backend'] == 'local':
+            entries = self._read_local_file(cutoff)
+        else:
+            table = Table(self.table_id, schema=CHECKPOINT_SCHEMA)
+            table.time_partitioning = bigquery.TimePartitioning(
+                field="completed_at",
+                type_=bigquery.TimePartitioningType.DAY,
+                expiration_ms=self.config['retention_days'] * 24 * 3600 * 1000,
+            )
+            BOOTSTRAP.ensure_table(self.client, table)
+            job_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ScalarQueryParameter("cutoff", "TIMESTAMP", cutoff)
+            ])
+            entries = [dict(row.items()) for row in self.client.query(
+                f"SELECT ad_account_id, table_name, window_start, window_end FROM `{self.table_id}` "
+                f"WHERE completed_at >= @cutoff", job_config=job_config
+            ).result()]
+
+        with self._lock:
+            for entry in entries:
+                key = (entry['ad_account_id'], entry['table_name'])
+                self._completed.setdefault(key, []).append(
+                    (_to_date(entry['window_start']), _to_date(entry['window_end']))
+                )
+        print(f"✓ Loaded {len(entries)} checkpoints ({self.config['backend']}).")
+        return self
+
+    def _read_local_file(self, cutoff):
+        path = self.config['local_path']
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        return [e for e in entries if datetime.fromisoformat(e['completed_at']) >= cutoff]
+
+    def remaining_windows(self, ad_account_id, table_name, since, until):
+        """The parts of [since, until] not yet completed for this account and table."""
+        with self._lock:
+            completed = list(self._completed.get((ad_account_id, table_name), []))
+        return subtract_windows(since, until, completed)
+
+    def mark_done(self, ad_account_id, table_name, windows):
+        """Records completed ('YYYY-MM-DD', 'YYYY-MM-DD') windows durably."""
+        if not windows:
+            return
+        completed_at = datetime.now(timezone.utc).isoformat()
+        rows = [{
+            'ad_account_id': ad_account_id,
+            'table_name': table_name,
+            'window_start': window[0],
+            'window_end': window[1],
+            'completed_at': completed_at,
+        } for window in windows]
+
+        if self.config['backend'] == 'local':
+            with self._lock, open(self.config['local_path'], 'a') as f:
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            errors = self.client.insert_rows_json(self.table_id, rows)
+            if errors:
+                raise RuntimeError(f"Failed to record checkpoints for {ad_account_id} {table_name}: {errors}")
+
+        with self._lock:
+            self._completed.setdefault((ad_account_id, table_name), []).extend(
+                (_to_date(w[0]), _to_date(w[1])) for w in windows
+            )
+
+
+class WindowProgress(object):
+    """
+    Checkpointing of one insight table of one account over its date range.
+
+    Windows reported through window_done() are held until their rows have been
+    flushed to BigQuery, then recorded with commit().
+    """
+
+    def __init__(self, store, ad_account_id, table_name, since, until):
+        self.store = store
+        self.ad_account_id = ad_account_id
+        self.table_name = table_name
+        self.since = since
+        self.until = until
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def remaining_windows(self):
+        return self.store.remaining_windows(self.ad_account_id, self.table_name, self.since, self.until)
+
+    def window_done(self, window):
+        """Called once every page of the window has been handed to the loader."""
+        with self._lock:
+            self._pending.append(window)
+
+    def commit(self):
+        """Records the pending windows; call only after the loader has flushed their rows."""
+        with self._lock:
+            windows, self._pending = self._pending, []
+        try:
+            self.store.mark_done(self.ad_account_id, self.table_name, windows)
+        except Exception as e:
+            # The rows are loaded; losing the checkpoint only means a rerun fetches these windows again
+            print(f"⚠️ Could not record checkpoints for {self.ad_account_id} {self.table_name}: {e}")
+
+    def discard_pending(self):
+        """Forgets windows whose rows were dropped with the loader's buffer (they will be refetched)."""
+        with self._lock:
+            self._pending = []
@@ -0,0 +1,36 @@
+"""
+DML statements on tables shared by accounts, tasks and executions.
+
+MERGEs (and DELETEs) of other accounts, or of other tasks of a sharded
+execution, into the same table make BigQuery abort one of them with "Could not
+serialize access to table ... due to concurrent update". run_dml retries those
+with jitter; any other error is raised at once.
+"""
+
+import random
+import time
+
+DML_CONFIG = {
+    'conflict_retries': 5,          # Retries of a statement that hit a concurrent update
+}
+
+
+def _is_concurrent_update(error):
+    return 'concurrent update' in str(error).lower() or 'could not serialize' in str(error).lower()
+
+
+def run_dml(client, sql, job_config=None, retries=None):
+    """
+    Runs a DML statement (or script) and waits for it, retrying with jitter when it
+    collides with a concurrent update of the same table. Returns the finished job.
+    """
+    retries = DML_CONFIG['conflict_retries'] if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            job = client.query(sql, job_config=job_config)
+            job.result()
+            return job
+        except Exception as e:
+            if not _is_concurrent_update(e) or attempt >= retries:
+                raise
+            time.sleep(random.uniform(0.5, 2.0) * (attempt + 1))
@@ -0,0 +1,179 @@
+"""
+Idempotent (MERGE) loads of the insight tables.
+
+In the default 'append' load mode insight rows are appended to tables partitioned
+on last_run_timestamp, so a rerun or an overlapping date window adds the same
+rows again. In 'merge' mode (RUN_CONFIG['insight_load_mode']) every chunk of an
+account's insights is loaded into a per-account staging table and MERGEd into
+the target table, keyed on
+
+    ad_account_id, <level entity id>, date_start, publisher_platform, platform_position
+
+for every profile's table of a level (e.g. ad_insights and ad_insights_expensive)
+
+so loading a date twice updates its rows instead of duplicating them.
+
+Merged tables are partitioned by date_start and clustered on ad_account_id,
+campaign_id and ad_id, and each MERGE is restricted to the date partitions
+present in its chunk. Tables created by the append mode cannot be re-partitioned
+in place: rebuild them once with `python main.py migrate-insights`, which keeps
+the latest row of every key.
+"""
+
+from google.cloud import bigquery
+
+from bootstrap import BOOTSTRAP
+from dml import run_dml
+from run_metrics import METRICS
+from structure_sync import ensure_target_columns, table_exists
+
+INSIGHT_MERGE_CONFIG = {
+    'partition_field': 'date_start',
+    'clustering_fields': ['ad_account_id', 'campaign_id', 'ad_id'],
+    'breakdown_keys': ['publisher_platform', 'platform_position'],  # Part of the key (NULL when not requested)
+}
+
+# The entity an insight row belongs to, per level (tables are named <level>_insights[_<profile>])
+ENTITY_ID_COLUMNS = {'ad': 'ad_id', 'adset': 'adset_id', 'campaign': 'campaign_id'}
+
+
+def merge_key(table_name, config=None):
+    """Columns identifying one row of an insight table."""
+    config = {**INSIGHT_MERGE_CONFIG, **(config or {})}
+    level = table_name[:table_name.index('_insights')]
+    return ['ad_account_id', ENTITY_ID_COLUMNS[level], config['partition_field']] + config['breakdown_keys']
+
+
+def date_expression(column, field_type):
+    # date_start is a DATE with typed schemas and a TIMESTAMP without them
+    return column if field_type == 'DATE' else f"DATE({column})"
+
+
+# Legacy type names returned by the API, as used in CAST
+_CAST_TYPES = {'INTEGER': 'INT64', 'FLOAT': 'FLOAT64', 'BOOLEAN': 'BOOL'}
+
+
+def _source_value(column, staging_type, target_type):
+    """S.<column>, cast to the target's type when a table created before typed schemas has another one."""
+    if staging_type == target_type or 'RECORD' in (staging_type, target_type) or 'STRUCT' in (staging_type, target_type):
+        return f"S.`{column}`"
+    return f"CAST(S.`{column}` AS {_CAST_TYPES.get(target_type, target_type)})"
+
+
+class InsightMerge(object):
+    """MERGEs the staged chunks of one insight table of one account into the target table."""
+
+    def __init__(self, table_name, ad_account_id, config=None):
+        self.config = {**INSIGHT_MERGE_CONFIG, **(config or {})}
+        self.table_name = table_name
+        self.ad_account_id = ad_account_id
+        self.key = merge_key(table_name, self.config)
+
+    def staging_table_id(self, client, dataset_id):
+        return f"{client.project}.{dataset_id}._staging_{self.table_name}_{self.ad_account_id}"
+
+    def ensure_target(self, client, target_id, staging_schema):
+        """Creates the partitioned and clustered target table, or checks that an existing one is."""
+        partition_field = self.config['partition_field']
+        time_partitioning = bigquery.TimePartitioning(field=partition_field, type_=bigquery.TimePartitioningType.DAY)
+        # Campaign and account level tables have no ad_id to cluster on
+        columns = {f.name for f in staging_schema}
+        clustering_fields = [c for c in self.config['clustering_fields'] if c in columns] or None
+        # The manifest only has targets that passed this check (see bootstrap.py)
+        if (not BOOTSTRAP.is_current(target_id, staging_schema, time_partitioning, clustering_fields)
+                and table_exists(client, target_id)):
+            partitioning = client.get_table(target_id).time_partitioning
+            if partitioning is None or partitioning.field != partition_field:
+                raise RuntimeError(
+                    f"{target_id} is not partitioned by {partition_field}; "
+                    f"rebuild it once with `python main.py migrate-insights` before loading it in merge mode."
+                )
+        return ensure_target_columns(client, target_id, staging_schema, time_partitioning, clustering_fields)
+
+    def apply(self, client, dataset_id):
+        """MERGEs the staging table into the target table, then drops the staging table."""
+        target_id = f"{client.project}.{dataset_id}.{self.table_name}"
+        staging_id = self.staging_table_id(client, dataset_id)
+        partition_field = self.config['partition_field']
+        try:
+            staging = client.get_table(staging_id)
+            target = self.ensure_target(client, target_id, staging.schema)
+            staging_types = {f.name: f.field_type for f in staging.schema}
+            target_types = {f.name: f.field_type for f in target.schema}
+            columns = [f.name for f in staging.schema if f.name in target_types]
+            values = {c: _source_value(c, staging_types[c], target_types[c]) for c in columns}
+            # The target's date_start may be a TIMESTAMP (created or migrated before typed schemas)
+            staging_type = staging_types.get(partition_field, 'DATE')
+            target_date = date_expression(f'T.`{partition_field}`', target_types.get(partition_field, 'DATE'))
+
+            # Breakdown columns are NULL when not requested, and NULL = NULL is not true
+            conditions = [
+                f"{target_date} = {date_expression(f'S.`{c}`', staging_type)}" if c == partition_field
+                else f"T.`{c}` IS NOT DISTINCT FROM {values.get(c, f'S.`{c}`')}" if c in self.config['breakdown_keys']
+                else f"T.`{c}` = {values.get(c, f'S.`{c}`')}"
+                for c in self.key
+            ]
+            # A constant list of dates on the target prunes the MERGE to the chunk's partitions
+            with METRICS.stage('merge', self.ad_account_id, self.table_name, log=False):
+                run_dml(client, f"""
+                    DECLARE dates ARRAY<DATE> DEFAULT (
+                      SELECT ARRAY_AGG(DISTINCT {date_expression(partition_field, staging_type)} IGNORE NULLS)
+                      FROM `{staging_id}`
+                    );
+                    MERGE `{target_id}` T
+                    USING (
+                      SELECT * FROM `{staging_id}`
+                      WHERE TRUE
+                      QUALIFY ROW_NUMBER() OVER (
+                        PARTITION BY {', '.join(f'`{c}`' for c in self.key)} ORDER BY last_run_timestamp DESC
+                      ) = 1
+                    ) S
+                    ON {target_date} IN UNNEST(dates)
+                      AND {' AND '.join(conditions)}
+                    WHEN MATCHED THEN
+                      UPDATE SET {', '.join(f'`{c}` = {values[c]}' for c in columns if c not in self.key)}
+                    WHEN NOT MATCHED THEN
+                      INSERT ({', '.join(f'`{c}`' for c in columns)})
+                      VALUES ({', '.join(values[c] for c in columns)})
+                """)
+        finally:
+            client.delete_table(staging_id, not_found_ok=True)
+
+
+def migrate_insight_table(client, dataset_id, table_name, config=None):
+    """
+    Rebuilds an append-mode insight table for merge mode: partitioned by date_start,
+    clustered, and with the latest row of every key only. The old table is kept as
+    <table>__by_run_time.
+    """
+    config = {**INSIGHT_MERGE_CONFIG, **(config or {})}
+    table_id = f"{client.project}.{dataset_id}.{table_name}"
+    rebuilt_id = f"{table_id}__by_date"
+    if not table_exists(client, table_id):
+        print(f"Nothing to migrate for {table_id}: the table does not exist yet.")
+        return
+    table = client.get_table(table_id)
+    partition_field = config['partition_field']
+    if table.time_partitioning is not None and table.time_partitioning.field == partition_field:
+        print(f"✓ {table_id} is already partitioned by {partition_field}.")
+        return
+
+    partition_type = next((f.field_type for f in table.schema if f.name == partition_field), 'DATE')
+    existing = {f.name for f in table.schema}
+    # campaign and adset tables autodetected from Meta rows have no ad_id (or adset_id) column
+    key = [c for c in merge_key(table_name, config) if c in existing]
+    clustering_fields = [c for c in config['clustering_fields'] if c in existing]
+    cluster_clause = f"CLUSTER BY {', '.join(clustering_fields)}" if clustering_fields else ""
+    print(f"🛠️ Rebuilding {table_id} partitioned by {partition_field}...")
+    client.query(f"""
+        CREATE TABLE `{rebuilt_id}`
+        PARTITION BY {date_expression(partition_field, partition_type)}
+        {cluster_clause}
+        AS
+        SELECT * FROM `{table_id}`
+        WHERE TRUE
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY {', '.join(f'`{c}`' for c in key)} ORDER BY last_run_timestamp DESC) = 1
+    """).result()
+    client.query(f"ALTER TABLE `{table_id}` RENAME TO `{table_name}__by_run_time`").result()
+    client.query(f"ALTER TABLE `{rebuilt_id}` RENAME TO `{table_name}`").result()
+    print(f"✨ Migrated {table_id}; the previous table is kept as {table_name}__by_run_time.")
@@ -0,0 +1,219 @@
+"""
+Attribution lookback: re-syncing recent insight days, loading only changed rows.
+
+Meta keeps revising the conversions and spend of recent days for as long as
+their attribution window is open (up to 28 days). With lookback enabled, every
+run also re-fetches the last LOOKBACK_CONFIG['days'] days already loaded for
+each insight table, and only rows whose payload changed since they were last
+loaded are MERGEd again (insight_load_mode 'merge', see insight_merge.py).
+
+Changes are detected with a hash index: for each account, insight table and row
+key (entity id, date_start and breakdowns, see insight_merge.merge_key) it keeps
+a 64-bit hash of the row's fields. The index lives in a small BigQuery table
+(etl_insight_hashes, partitioned by date_start so days past the lookback expire)
+or, with backend='local', in one JSON file per account and table. Every loaded
+row is recorded once its load has succeeded, new days included, so the first
+lookback over them already skips unchanged rows.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import bigquery
+from google.cloud.bigquery import SchemaField, Table
+
+from bootstrap import BOOTSTRAP
+from insight_merge import merge_key
+
+LOOKBACK_CONFIG = {
+    'enabled': False,
+    'days': 28,                     # Trailing days re-fetched each run (Meta's longest attribution window)
+    'backend': 'bigquery',          # 'bigquery': etl_insight_hashes table; 'local': JSON files under local_dir
+    'local_dir': os.path.join(os.environ.get('TMPDIR', '/tmp'), 'etl_insight_hashes'),
+    'ignored_fields': ['date_stop', 'updated_time'],    # Not part of the hashed payload
+}
+
+HASH_TABLE = 'etl_insight_hashes'
+HASH_SCHEMA = [
+    SchemaField("ad_account_id", "STRING", mode="REQUIRED"),
+    SchemaField("table_name", "STRING", mode="REQUIRED"),
+    SchemaField("date_start", "DATE", mode="REQUIRED"),
+    SchemaField("row_key", "STRING", mode="REQUIRED"),
+    SchemaField("row_hash", "INT64", mode="REQUIRED"),
+    SchemaField("updated_at", "TIMESTAMP", mode="REQUIRED"),
+]
+
+
+def lookback_date_range(loaded_through, run_timestamp_dt, days):
+    """
+    Returns the ('YYYY-MM-DD', 'YYYY-MM-DD') range of already loaded days to re-sync,
+    or None if nothing within the last `days` days has been loaded yet.
+    """
+    if loaded_through is None or days <= 0:
+        return None
+    end_date = min(loaded_through, (run_timestamp_dt - timedelta(days=1)).date())
+    start_date = (run_timestamp_dt - timedelta(days=days)).date()
+    if start_date > end_date:
+        return None
+    return start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+
+
+def row_hash(row, excluded):
+    """64-bit hash of a raw insight row, without the excluded (key and ignored) fields."""
+    payload = json.dumps({k: v for k, v in row.items() if k not in excluded}, sort_keys=True, separators=(',', ':'))
+    return int.from_bytes(hashlib.blake2b(payload.encode(), digest_size=8).digest(), 'big', signed=True)
+
+
+class HashStore(object):
+    """Reads and appends the row hashes of the lookback window (BigQuery table or local files)."""
+
+    def __init__(self, client, dataset_id, config=None):
+        self.client = client
+        self.config = {**LOOKBACK_CONFIG, **(config or {})}
+        self.table_id = f"{client.project}.{dataset_id}.{HASH_TABLE}"
+        self._lock = threading.Lock()
+
+    def prepare(self):
+        """Creates the hash table (or directory) once per run."""
+        if self.config['backend'] == 'local':
+            os.makedirs(self.config['local_dir'], exist_ok=True)
+            return self
+        table = Table(self.table_id, schema=HASH_SCHEMA)
+        table.time_partitioning = bigquery.TimePartitioning(
+            field="date_start",
+            type_=bigquery.TimePartitioningType.DAY,
+            # Days that left the lookback window are never read again
+            expiration_ms=(self.config['days'] + 7) * 24 * 3600 * 1000,
+        )
+        table.clustering_fields = ['ad_account_id', 'table_name']
+        BOOTSTRAP.ensure_table(self.client, table)
+        return self
+
+    def index(self, ad_account_id, table_name, since):
+        return RowHashIndex(self, ad_account_id, table_name, since)
+
+    def _local_path(self, ad_account_id, table_name):
+        return os.path.join(self.config['local_dir'], f"{ad_account_id}__{table_name}.json")
+
+    def read(self, ad_account_id, table_name, since):
+        """{row_key: (date_start, hash)} of the account's table from `since` ('YYYY-MM-DD') on."""
+        if self.config['backend'] == 'local':
+            path = self._local_path(ad_account_id, table_name)
+            if not os.path.exists(path):
+                return {}
+            with open(path) as f:
+                entries = json.load(f)
+            return {key: (date, value) for key, (date, value) in entries.items() if date >= since}
+
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("ad_account_id", "STRING", ad_account_id),
+            bigquery.ScalarQueryParameter("table_name", "STRING", table_name),
+            bigquery.ScalarQueryParameter("since", "DATE", since),
+        ])
+        rows = self.client.query(f"""
+            SELECT row_key, date_start, row_hash FROM `{self.table_id}`
+            WHERE date_start >= @since AND ad_account_id = @ad_account_id AND table_name = @table_name
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY row_key ORDER BY updated_at DESC) = 1
+        """, job_config=job_config).result()
+        return {row.row_key: (str(row.date_start), row.row_hash) for row in rows}
+
+    def write(self, ad_account_id, table_name, since, hashes):
+        """Records {row_key: (date_start, hash)} for the account's table."""
+        if not hashes:
+            return
+        if self.config['backend'] == 'local':
+            path = self._local_path(ad_account_id, table_name)
+            with self._lock:
+                entries = self.read(ad_account_id, table_name, since)
+                entries.update(hashes)
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, path)
+            return
+
+        updated_at = datetime.now(timezone.utc).isoformat()
+        rows = [{
+            'ad_account_id': ad_account_id,
+            'table_name': table_name,
+            'date_start': date,
+            'row_key': key,
+            'row_hash': value,
+            'updated_at': updated_at,
+        } for key, (date, value) in hashes.items()]
+        job_config = bigquery.LoadJobConfig(
+            schema=HASH_SCHEMA, write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+        self.client.load_table_from_json(rows, self.table_id, job_config=job_config).result()
+
+
+class RowHashIndex(object):
+    """
+    Row hashes of one insight table of one account, from `since` on.
+
+    changed() filters pages down to new or changed rows; record() keeps every row.
+    Either way the hashes are only written with commit(), once the rows are loaded.
+    """
+
+    def __init__(self, store, ad_account_id, table_name, since):
+        self.store = store
+        self.ad_account_id = ad_account_id
+        self.table_name = table_name
+        self.since = since
+        # The account is implied by the index; the rest of the MERGE key identifies a row
+        self.key_columns = [c for c in merge_key(table_name) if c != 'ad_account_id']
+        self.excluded = set(self.key_columns) | set(store.config['ignored_fields'])
+        self.rows_seen = 0
+        self.rows_changed = 0
+        self._hashes = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _key(self, row):
+        return '|'.join(str(row.get(c) or '') for c in self.key_columns)
+
+    def _hash_page(self, page):
+        return [(row, self._key(row), row.get('date_start'), row_hash(row, self.excluded)) for row in page]
+
+    def changed(self, page):
+        """The rows of a page that are new or changed since they were last loaded."""
+        with self._lock:
+            if self._hashes is None:
+                self._hashes = self.store.read(self.ad_account_id, self.table_name, self.since)
+        changed = []
+        for row, key, date, value in self._hash_page(page):
+            known = self._hashes.get(key)
+            if known is None or known[1] != value:
+                changed.append(row)
+                with self._lock:
+                    self._pending[key] = (date, value)
+        with self._lock:
+            self.rows_seen += len(page)
+            self.rows_changed += len(changed)
+        return changed
+
+    def record(self, page):
+        """Passes a page through, recording the hashes of all of its rows."""
+        hashed = self._hash_page(page)
+        with self._lock:
+            for _, key, date, value in hashed:
+                if date and date >= self.since:
+                    self._pending[key] = (date, value)
+        return page
+
+    def commit(self):
+        """Writes the pending hashes; call only once their rows have been loaded."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        try:
+            self.store.write(self.ad_account_id, self.table_name, self.since, pending)
+        except Exception as e:
+            # The rows are loaded; a lost hash only means the row is loaded again next time
+            print(f"⚠️ Could not record row hashes for {self.ad_account_id} {self.table_name}: {e}")
+            return
+        with self._lock:
+            if self._hashes is not None:
+                self._hashes.update(pending)
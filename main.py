@@ -1,31 +1,71 @@
 """
 Meta Marketing API to BigQuery ETL Pipeline
-Fetches Facebook and Instagram ad data, logging audit entries using pandas-gbq
+Fetches Facebook and Instagram ad data, logging audit entries in batches (audit_writer.py)
 
 FIXED:
-1. CRITICAL: Implements PAGING for fetching Campaigns, Adsets, and Ads (structure data) 
-   with a 2-second sleep between each page request to avoid "User request limit reached" 
-   for high-volume accounts.
-2. Insight fetching logic uses date strings (confirmed stable).
-3. Stricter global rate limit handling (30s rest, 180s backoff) is maintained.
+1. CRITICAL: Implements PAGING for fetching Campaigns, Adsets, and Ads (structure data).
+2. Insight fetching logic uses date strings; the range per account and level comes from
+   the etl_watermarks state table (see watermarks.py), read once per run.
+3. Rate limiting is driven by Meta's throttle headers (see rate_limiter.py): calls are
+   only paced as usage nears the cap, and throttled calls wait exactly the time Meta
+   reports instead of fixed 2s / 30s / 180s sleeps.
+4. Campaigns, Adsets and Ads are synced incrementally by updated_time and MERGEd on id
+   (see structure_sync.py), instead of WRITE_TRUNCATE per account. Their pages are
+   fetched for all accounts together through Graph API batch calls (batch_fetch.py).
+5. Every table has an explicit typed schema (TABLE_SCHEMAS, see schemas.py): metrics are
+   numbers, dates are DATEs and action lists are REPEATED RECORDs, with no autodetection.
+   Off (RUN_CONFIG['typed_schemas']) until the autodetected tables are recreated.
+6. Insight loads are checkpointed per account, level and date window (see checkpoints.py):
+   a failed table is retried, and reruns resume, from the last completed window.
+7. Every stage is timed and counted (Meta calls, bytes, rows, throttle waits, retries,
+   memory; see run_metrics.py), logged as structured JSON for Cloud Logging and written
+   to the etl_run_metrics table once per run.
+8. Insight tables can be loaded idempotently (RUN_CONFIG['insight_load_mode'] = 'merge'):
+   chunks are staged and MERGEd into tables partitioned by date_start (see insight_merge.py).
+9. Recent insight days are re-synced for late attribution (see lookback.py): the trailing
+   window is re-fetched and only rows whose hash changed are MERGEd again.
+10. Insight fields are split into profiles (INSIGHT_PROFILES) with their own tables and
+    refresh cadence: spend, impressions and clicks every run, unique / reach metrics daily
+    and rankings weekly, scheduled per account and table by the fetched_at watermark.
+11. A Cloud Run Job with several tasks splits the accounts between them (see sharding.py),
+    weighted by recent runtime, with a lease per account so no two tasks process the same one.
+12. Fast start: tables already verified are not checked again (see bootstrap.py), and the
+    facebook_business SDK is only imported by the stages that call Meta. Most of the import
+    time is google-cloud-bigquery, which imports pandas itself, so both stay eager. The
+    startup time (imports, bootstrap, state loads) is reported and kept in etl_run_metrics.
 """
 
+import time
+# Imports are timed from here (see report_startup)
+_MODULE_STARTED = time.perf_counter()
+
+import argparse
 import json
+import os
+import subprocess
 import sys
-from datetime import datetime, timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
 import pandas as pd
-import time 
 from google.cloud import bigquery
 from google.cloud.bigquery import SchemaField, Table
-import pandas_gbq 
+from audit_writer import AuditLogWriter
+from streaming import ArrowChunkLoader, page_to_record_batch
+from structure_sync import STRUCTURE_TABLES, StructureSync, migrate_structure_table
+from insight_merge import InsightMerge, date_expression, migrate_insight_table
+from lookback import LOOKBACK_CONFIG, HashStore, lookback_date_range
+from schemas import INSIGHT_FIELD_KINDS, STRUCTURE_FIELD_KINDS, TableSchema, encode_json
+from watermarks import WatermarkStore, insight_date_range
+from checkpoints import CheckpointStore, WindowProgress
+from raw_archive import RAW_ARCHIVE_CONFIG, RawArchive
+from run_metrics import METRICS
+from sharding import AccountLeases, Shard, plan_accounts
+from bootstrap import BOOTSTRAP
 
-# Ensure the Facebook library is present
-try:
-    from facebook_business.api import FacebookAdsApi
-    from facebook_business.adobjects.adaccount import AdAccount
-except ImportError:
-    print("The 'facebook-business' library is not installed.")
-    sys.exit()
+# The facebook_business SDK (rate_limiter, async_insights, batch_fetch) is imported where
+# Meta is called, so replay and migrate-* don't load it
+_IMPORT_SECONDS = time.perf_counter() - _MODULE_STARTED
 
 # --- Configuration (Kept the same) ---
 META_CONFIG = {
@@ -49,6 +89,163 @@ BQ_CONFIG = {
 #    'service_account_path': 'ourshopee.json', 
 }
 
+# Concurrency caps for the multi-account runner in main()
+RUN_CONFIG = {
+    'max_concurrent_accounts': 3,      # Accounts being fetched from Meta at the same time
+    'max_fetches_per_account': 3,      # Datasets fetched in parallel within one account
+    'max_concurrent_meta_fetches': 6,  # Global cap on dataset fetches in flight across all accounts
+    'max_concurrent_loads': 4,         # BigQuery load jobs in flight across all accounts
+    'insights_mode': 'async',          # 'async': sharded AdReportRun jobs (async_insights.py); 'sync': get_insights
+    'streaming': True,                 # Stream pages to BigQuery in bounded chunks (streaming.py, see STREAMING_CONFIG)
+    'batch_structure_fetch': True,     # Fetch structure pages of all accounts through Graph API batch calls (batch_fetch.py)
+    'typed_schemas': False,            # Convert pages to the typed TABLE_SCHEMAS instead of inferring types (schemas.py);
+                                       # only once the existing tables are recreated with them (spend, date_start, ...
+                                       # change type, which appends and MERGEs into the old tables cannot do)
+    'unit_retries': 2,                 # Retries of a failed table of an account, resuming from its checkpoints (checkpoints.py)
+    'retry_backoff_seconds': 30,       # Wait before such a retry
+    'insight_load_mode': 'append',     # 'merge': stage insight chunks and MERGE them, once per key (insight_merge.py;
+                                       # run `main.py migrate-insights` first); 'append': WRITE_APPEND
+    'profile_schedule_slack_minutes': 10,  # An insight profile counts as due this much before its every_hours are up
+}
+
+_meta_fetch_slots = threading.BoundedSemaphore(RUN_CONFIG['max_concurrent_meta_fetches'])
+
+
+# --- Structure Fields (Campaigns, Adsets, Ads) ---
+# campaign_fields = ['id', 'name', 'objective', 'status', 'start_time', 'stop_time']
+CAMPAIGN_FIELDS = ['account_id', 'adlabels', 'advantage_state_info', 'bid_strategy', 'boosted_object_id', 'brand_lift_studies', 'budget_rebalance_flag', 'budget_remaining', 'buying_type', 'campaign_group_active_time', 'can_create_brand_lift_study', 'can_use_spend_cap', 'configured_status', 'created_time', 'daily_budget', 'effective_status', 'has_secondary_skadnetwork_reporting', 'id', 'is_adset_budget_sharing_enabled', 'is_budget_schedule_enabled', 'is_direct_send_campaign', 'is_message_campaign', 'is_skadnetwork_attribution', 'issues_info', 'last_budget_toggling_time', 'lifetime_budget', 'name', 'objective', 'pacing_type', 'primary_attribution', 'promoted_object', 'recommendations', 'smart_promotion_type', 'source_campaign', 'source_campaign_id', 'source_recommendation_type', 'special_ad_categories', 'special_ad_category', 'special_ad_category_country', 'spend_cap', 'start_time', 'status', 'stop_time', 'topline_id', 'updated_time', 'adbatch', 'budget_schedule_specs', 'execution_options', 'iterative_split_test_configs']
+
+# adset_fields = ['id', 'name', 'campaign_id', 'status', 'targeting']
+# adset_fields = ['account_id', 'adlabels', 'adset_schedule', 'asset_feed_id', 'attribution_spec', 'automatic_manual_state', 'bid_adjustments', 'bid_amount', 'bid_constraints', 'bid_info', 'bid_strategy', 'billing_event', 'brand_safety_config', 'budget_remaining', 'campaign', 'campaign_active_time', 'campaign_attribution', 'campaign_id', 'configured_status', 'created_time', 'creative_sequence', 'creative_sequence_repetition_pattern', 'daily_budget', 'daily_min_spend_target', 'daily_spend_cap', 'destination_type', 'dsa_beneficiary', 'dsa_payor', 'effective_status', 'end_time', 'existing_customer_budget_percentage', 'frequency_control_specs', 'full_funnel_exploration_mode', 'id', 'instagram_user_id', 'is_ba_skip_delayed_eligible', 'is_budget_schedule_enabled', 'is_dynamic_creative', 'is_incremental_attribution_enabled', 'issues_info', 'learning_stage_info', 'lifetime_budget', 'lifetime_imps', 'lifetime_min_spend_target', 'lifetime_spend_cap', 'max_budget_spend_percentage', 'min_budget_spend_percentage', 'multi_optimization_goal_weight', 'name', 'optimization_goal', 'optimization_sub_event', 'pacing_type', 'placement_soft_opt_out', 'promoted_object', 'recommendations', 'recurring_budget_semantics', 'regional_regulated_categories', 'regional_regulation_identities', 'review_feedback', 'rf_prediction_id', 'source_adset', 'source_adset_id', 'start_time', 'status', 'targeting', 'targeting_optimization_types', 'time_based_ad_rotation_id_blocks', 'time_based_ad_rotation_intervals', 'trending_topics_spec', 'updated_time', 'use_new_app_click', 'value_rule_set_id', 'value_rules_applied', 'budget_schedule_specs', 'budget_source', 'budget_split_set_id', 'campaign_spec', 'daily_imps', 'date_format', 'execution_options', 'is_sac_cfca_terms_certified', 'line_number', 'rb_prediction_id', 'time_start', 'time_stop', 'topline_id', 'tune_for_category']
+ADSET_FIELDS = ['id', 'name', 'campaign_id', 'account_id', 'status', 'effective_status', 'configured_status', 'created_time', 'updated_time', 'start_time', 'end_time', 'daily_budget', 'lifetime_budget', 'budget_remaining', 'bid_strategy', 'bid_amount', 'billing_event', 'pacing_type', 'optimization_goal', 'optimization_sub_event', 'learning_stage_info', 'destination_type', 'is_dynamic_creative', 'review_feedback']
+
+# ad_fields = ['id', 'name', 'adset_id', 'campaign_id', 'status', 'creative']
+# ad_fields = ['account_id', 'ad_active_time', 'ad_review_feedback', 'ad_schedule_end_time', 'ad_schedule_start_time', 'adlabels', 'adset', 'adset_id', 'bid_amount', 'bid_info', 'bid_type', 'campaign', 'campaign_id', 'configured_status', 'conversion_domain', 'conversion_specs', 'created_time', 'creative', 'creative_asset_groups_spec', 'demolink_hash', 'display_sequence', 'effective_status', 'engagement_audience', 'failed_delivery_checks', 'id', 'issues_info', 'last_updated_by_app_id', 'name', 'placement', 'preview_shareable_link', 'priority', 'recommendations', 'source_ad', 'source_ad_id', 'status', 'targeting', 'tracking_and_conversion_with_defaults', 'tracking_specs', 'updated_time', 'adset_spec', 'audience_id', 'date_format', 'draft_adgroup_id', 'execution_options', 'include_demolink_hashes', 'filename']
+AD_FIELDS = ['id', 'name', 'adset_id', 'campaign_id', 'status', 'creative', 'account_id', 'effective_status', 'configured_status', 'created_time', 'updated_time', 'bid_amount', 'bid_type', 'call_to_action_type', 'conversion_domain','ad_review_feedback','targeting ','adlabels','issues_info']
+
+STRUCTURE_FIELDS = {'campaigns': CAMPAIGN_FIELDS, 'adsets': ADSET_FIELDS, 'ads': AD_FIELDS}
+
+# --- Insight Fields (all three levels) ---
+# insight_fields = ['account_currency', 'account_id', 'account_name', 'action_values', 'actions', 'ad_click_actions', 'ad_id', 'ad_impression_actions', 'ad_name', 'adset_end', 'adset_id', 'adset_name', 'adset_start', 'age_targeting', 'attribution_setting', 'auction_bid', 'auction_competitiveness', 'auction_max_competitor_bid', 'average_purchases_conversion_value', 'buying_type', 'campaign_id', 'campaign_name', 'canvas_avg_view_percent', 'canvas_avg_view_time', 'catalog_segment_actions', 'catalog_segment_value', 'catalog_segment_value_mobile_purchase_roas', 'catalog_segment_value_omni_purchase_roas', 'catalog_segment_value_website_purchase_roas', 'clicks', 'conversion_lead_rate', 'conversion_leads', 'conversion_rate_ranking', 'conversion_values', 'conversions', 'converted_product_app_custom_event_fb_mobile_purchase', 'converted_product_app_custom_event_fb_mobile_purchase_value', 'converted_product_offline_purchase', 'converted_product_offline_purchase_value', 'converted_product_omni_purchase', 'converted_product_omni_purchase_values', 'converted_product_quantity', 'converted_product_value', 'converted_product_website_pixel_purchase', 'converted_product_website_pixel_purchase_value', 'converted_promoted_product_app_custom_event_fb_mobile_purchase', 'converted_promoted_product_app_custom_event_fb_mobile_purchase_value', 'converted_promoted_product_offline_purchase', 'converted_promoted_product_offline_purchase_value', 'converted_promoted_product_omni_purchase', 'converted_promoted_product_omni_purchase_values', 'converted_promoted_product_quantity', 'converted_promoted_product_value', 'converted_promoted_product_website_pixel_purchase', 'converted_promoted_product_website_pixel_purchase_value', 'cost_per_15_sec_video_view', 'cost_per_2_sec_continuous_video_view', 'cost_per_action_type', 'cost_per_ad_click', 'cost_per_conversion', 'cost_per_conversion_lead', 'cost_per_dda_countby_convs', 'cost_per_estimated_ad_recallers', 'cost_per_inline_link_click', 'cost_per_inline_post_engagement', 'cost_per_objective_result', 'cost_per_one_thousand_ad_impression', 'cost_per_outbound_click', 'cost_per_result', 'cost_per_thruplay', 'cost_per_unique_action_type', 'cost_per_unique_click', 'cost_per_unique_conversion', 'cost_per_unique_inline_link_click', 'cost_per_unique_outbound_click', 'cpc', 'cpm', 'cpp', 'created_time', 'creative_media_type', 'ctr', 'date_start', 'date_stop', 'dda_countby_convs', 'dda_results', 'engagement_rate_ranking', 'estimated_ad_recall_rate', 'estimated_ad_recall_rate_lower_bound', 'estimated_ad_recall_rate_upper_bound', 'estimated_ad_recallers', 'estimated_ad_recallers_lower_bound', 'estimated_ad_recallers_upper_bound', 'frequency', 'full_view_impressions', 'full_view_reach', 'gender_targeting', 'impressions', 'inline_link_click_ctr', 'inline_link_clicks', 'inline_post_engagement', 'instagram_upcoming_event_reminders_set', 'instant_experience_clicks_to_open', 'instant_experience_clicks_to_start', 'instant_experience_outbound_clicks', 'interactive_component_tap', 'labels', 'landing_page_view_actions_per_link_click', 'landing_page_view_per_link_click', 'landing_page_view_per_purchase_rate', 'link_clicks_per_results', 'location', 'marketing_messages_click_rate_benchmark', 'marketing_messages_cost_per_delivered', 'marketing_messages_cost_per_link_btn_click', 'marketing_messages_delivered', 'marketing_messages_delivery_rate', 'marketing_messages_link_btn_click', 'marketing_messages_link_btn_click_rate', 'marketing_messages_media_view_rate', 'marketing_messages_phone_call_btn_click_rate', 'marketing_messages_quick_reply_btn_click', 'marketing_messages_quick_reply_btn_click_rate', 'marketing_messages_read', 'marketing_messages_read_rate', 'marketing_messages_read_rate_benchmark', 'marketing_messages_sent', 'marketing_messages_spend', 'marketing_messages_spend_currency', 'marketing_messages_website_add_to_cart', 'marketing_messages_website_initiate_checkout', 'marketing_messages_website_purchase', 'marketing_messages_website_purchase_values', 'mobile_app_purchase_roas', 'objective', 'objective_result_rate', 'objective_results', 'onsite_conversion_messaging_detected_purchase_deduped', 'optimization_goal', 'outbound_clicks', 'outbound_clicks_ctr', 'place_page_name', 'product_group_retailer_id', 'product_retailer_id', 'product_views', 'purchase_per_landing_page_view', 'purchase_roas', 'purchases_per_link_click', 'qualifying_question_qualify_answer_rate', 'quality_ranking', 'reach', 'result_rate', 'result_values_performance_indicator', 'results', 'shops_assisted_purchases', 'social_spend', 'spend', 'total_card_view', 'total_postbacks', 'total_postbacks_detailed', 'total_postbacks_detailed_v4', 'unique_actions', 'unique_clicks', 'unique_conversions', 'unique_ctr', 'unique_inline_link_click_ctr', 'unique_inline_link_clicks', 'unique_link_clicks_ctr', 'unique_outbound_clicks', 'unique_outbound_clicks_ctr', 'unique_video_continuous_2_sec_watched_actions', 'unique_video_view_15_sec', 'updated_time', 'video_15_sec_watched_actions', 'video_30_sec_watched_actions', 'video_avg_time_watched_actions', 'video_continuous_2_sec_watched_actions', 'video_p100_watched_actions', 'video_p25_watched_actions', 'video_p50_watched_actions', 'video_p75_watched_actions', 'video_p95_watched_actions', 'video_play_actions', 'video_play_curve_actions', 'video_play_retention_0_to_15s_actions', 'video_play_retention_20_to_60s_actions', 'video_play_retention_graph_actions', 'video_thruplay_watched_actions', 'video_time_watched_actions', 'video_view_per_impression', 'website_ctr', 'website_purchase_roas', 'wish_bid']
+# insight_fields = ['account_currency', 'account_id', 'account_name', 'action_values', 'actions','ad_click_actions', 'ad_id', 'ad_impression_actions', 'ad_name', 'adset_end','adset_id', 'adset_name', 'adset_start', 'attribution_setting', 'auction_bid','auction_competitiveness', 'auction_max_competitor_bid', 'average_purchases_conversion_value','buying_type', 'campaign_id', 'campaign_name', 'canvas_avg_view_percent','canvas_avg_view_time', 'catalog_segment_actions', 'catalog_segment_value','catalog_segment_value_mobile_purchase_roas', 'catalog_segment_value_omni_purchase_roas','catalog_segment_value_website_purchase_roas', 'clicks', 'conversion_lead_rate','conversion_leads', 'conversion_rate_ranking', 'conversion_values', 'conversions','cost_per_15_sec_video_view', 'cost_per_2_sec_continuous_video_view','cost_per_action_type', 'cost_per_ad_click', 'cost_per_conversion', 'cost_per_conversion_lead','cost_per_dda_countby_convs', 'cost_per_estimated_ad_recallers','cost_per_inline_link_click', 'cost_per_inline_post_engagement', 'cost_per_objective_result','cost_per_one_thousand_ad_impression', 'cost_per_outbound_click', 'cost_per_result','cost_per_thruplay', 'cost_per_unique_action_type', 'cost_per_unique_click','cost_per_unique_conversion', 'cost_per_unique_inline_link_click', 'cost_per_unique_outbound_click','cpc', 'cpm', 'cpp', 'created_time', 'creative_media_type', 'ctr', 'date_start','date_stop', 'dda_countby_convs', 'dda_results', 'engagement_rate_ranking','estimated_ad_recall_rate', 'estimated_ad_recallers', 'frequency', 'full_view_impressions','full_view_reach', 'impressions', 'inline_link_click_ctr', 'inline_link_clicks','inline_post_engagement', 'instagram_upcoming_event_reminders_set','instant_experience_clicks_to_open', 'instant_experience_clicks_to_start','instant_experience_outbound_clicks', 'interactive_component_tap','landing_page_view_actions_per_link_click', 'landing_page_view_per_link_click','landing_page_view_per_purchase_rate', 'link_clicks_per_results','marketing_messages_click_rate_benchmark', 'marketing_messages_cost_per_delivered','marketing_messages_cost_per_link_btn_click', 'marketing_messages_delivered','marketing_messages_delivery_rate', 'marketing_messages_link_btn_click','marketing_messages_link_btn_click_rate', 'marketing_messages_media_view_rate','marketing_messages_phone_call_btn_click_rate', 'marketing_messages_quick_reply_btn_click','marketing_messages_quick_reply_btn_click_rate', 'marketing_messages_read','marketing_messages_read_rate', 'marketing_messages_read_rate_benchmark','marketing_messages_sent', 'marketing_messages_spend', 'marketing_messages_spend_currency','marketing_messages_website_add_to_cart', 'marketing_messages_website_initiate_checkout','marketing_messages_website_purchase', 'marketing_messages_website_purchase_values','mobile_app_purchase_roas', 'objective', 'objective_result_rate', 'objective_results','onsite_conversion_messaging_detected_purchase_deduped', 'optimization_goal','outbound_clicks', 'outbound_clicks_ctr', 'place_page_name', 'product_group_retailer_id','product_retailer_id', 'product_views', 'purchase_per_landing_page_view', 'purchase_roas','purchases_per_link_click', 'qualifying_question_qualify_answer_rate', 'quality_ranking','reach', 'result_rate', 'result_values_performance_indicator', 'results','shops_assisted_purchases', 'social_spend', 'spend', 'total_card_view','unique_actions', 'unique_clicks', 'unique_conversions', 'unique_ctr','unique_inline_link_click_ctr', 'unique_inline_link_clicks', 'unique_link_clicks_ctr','unique_outbound_clicks', 'unique_outbound_clicks_ctr', 'unique_video_continuous_2_sec_watched_actions','unique_video_view_15_sec', 'updated_time', 'video_15_sec_watched_actions','video_30_sec_watched_actions', 'video_avg_time_watched_actions','video_continuous_2_sec_watched_actions', 'video_p100_watched_actions','video_p25_watched_actions', 'video_p50_watched_actions', 'video_p75_watched_actions','video_p95_watched_actions', 'video_play_actions', 'video_play_curve_actions','video_play_retention_0_to_15s_actions', 'video_play_retention_20_to_60s_actions','video_play_retention_graph_actions', 'video_thruplay_watched_actions','video_time_watched_actions', 'video_view_per_impression', 'website_ctr','website_purchase_roas', 'wish_bid']
+# --- Insight Field Profiles ---
+# Dimensions of every insight row (names, objective and the reporting day)
+INSIGHT_DIMENSION_FIELDS = [
+'account_currency', 'account_id', 'account_name', 'ad_id', 'ad_name', 
+'adset_id', 'adset_name', 'campaign_id', 'campaign_name', 'buying_type', 
+'objective', 'date_start', 'date_stop', ]
+
+# The insight fields split by how costly they are for Meta to compute. Each profile is
+# fetched into its own table per level (<level>_insights<table_suffix>) and only once
+# every_hours have passed since its last fetch for the account (0: on every run), so the
+# frequent runs only ask for the cheap metrics.
+INSIGHT_PROFILES = {
+    'core': {
+        'every_hours': 0,
+        'table_suffix': '',
+        'fields': INSIGHT_DIMENSION_FIELDS + [
+            # Core Metrics
+            'impressions', 'spend', 'social_spend',
+
+            # Clicks & CTR
+            'clicks', 'cpc', 'cpm', 'ctr',
+            'inline_link_clicks', 'inline_link_click_ctr', 'outbound_clicks', 'outbound_clicks_ctr',
+
+            # Post Engagement
+            'inline_post_engagement', 'cost_per_inline_post_engagement',
+
+            # Results & Conversions (Summary fields)
+            'results', 'result_rate', 'cost_per_result', 'optimization_goal',
+            'conversions', 'conversion_values', 'cost_per_conversion',
+            'actions', 'action_values', 'cost_per_action_type',
+
+            # Video & Canvas
+            'video_thruplay_watched_actions',
+            'canvas_avg_view_percent', 'canvas_avg_view_time',
+
+            # Times
+            'created_time', 'updated_time',
+        ],
+    },
+    # Unique and reach-based metrics (de-duplicated over people, slow to compute)
+    'expensive': {
+        'every_hours': 24,
+        'table_suffix': '_expensive',
+        'fields': ['account_id', 'date_start', 'date_stop',
+                   'reach', 'frequency',
+                   'unique_clicks', 'unique_ctr', 'unique_inline_link_clicks', 'unique_inline_link_click_ctr',
+                   'unique_outbound_clicks', 'unique_outbound_clicks_ctr',
+                   'unique_actions', 'cost_per_unique_action_type'],
+    },
+    # Quality, engagement and conversion rankings
+    'rankings': {
+        'every_hours': 24 * 7,
+        'table_suffix': '_rankings',
+        'fields': ['account_id', 'date_start', 'date_stop',
+                   'quality_ranking', 'conversion_rate_ranking', 'engagement_rate_ranking'],
+    },
+}
+
+INSIGHT_BREAKDOWNS = ['publisher_platform', 'platform_position']
+
+# Entity id fields requested at each insight level
+INSIGHT_LEVELS = {
+    'ad': ['campaign_id', 'adset_id', 'ad_id'],
+    'adset': ['campaign_id', 'adset_id'],
+    'campaign': ['campaign_id'],
+}
+
+# (level, profile) of every insight table; the core profile keeps the original table names
+INSIGHT_TABLE_PROFILES = {
+    f"{level}_insights{profile['table_suffix']}": (level, profile_name)
+    for profile_name, profile in INSIGHT_PROFILES.items()
+    for level in INSIGHT_LEVELS
+}
+INSIGHT_TABLES = list(INSIGHT_TABLE_PROFILES)
+
+def insight_fields(table_name):
+    """Fields requested for an insight table: its profile's fields and the ids of its level."""
+    level, profile_name = INSIGHT_TABLE_PROFILES[table_name]
+    return list(dict.fromkeys(INSIGHT_PROFILES[profile_name]['fields'] + INSIGHT_LEVELS[level]))
+
+# --- Table Schemas (typed; see schemas.py) ---
+# Columns added by the pipeline to every table
+PIPELINE_FIELDS = ['ad_account_id', 'last_run_timestamp']
+# Every profile's tables carry all entity ids, which merge-mode tables are clustered on
+INSIGHT_SCHEMAS = {
+    profile_name: TableSchema(
+        list(dict.fromkeys(profile['fields'] + INSIGHT_LEVELS['ad'])) + INSIGHT_BREAKDOWNS + PIPELINE_FIELDS,
+        INSIGHT_FIELD_KINDS,
+    )
+    for profile_name, profile in INSIGHT_PROFILES.items()
+}
+TABLE_SCHEMAS = {
+    'campaigns': TableSchema(CAMPAIGN_FIELDS + PIPELINE_FIELDS, STRUCTURE_FIELD_KINDS),
+    'adsets': TableSchema(ADSET_FIELDS + PIPELINE_FIELDS, STRUCTURE_FIELD_KINDS),
+    'ads': TableSchema(AD_FIELDS + PIPELINE_FIELDS, STRUCTURE_FIELD_KINDS),
+    **{table_name: INSIGHT_SCHEMAS[profile_name] for table_name, (_, profile_name) in INSIGHT_TABLE_PROFILES.items()},
+}
+
+# Nested structure fields (promoted_object, targeting, ...) are MERGEd into a persistent table, so without
+# typed schemas they are stored JSON-encoded too: the structs inferred from each load's keys would not match
+STRUCTURE_JSON_COLUMNS = {
+    table_name: [name for name, kind in TABLE_SCHEMAS[table_name].kinds.items() if kind == 'json']
+    for table_name in STRUCTURE_TABLES
+}
+
+AUDIT_LOG_TABLE = 'etl_audit_log'
+AUDIT_LOG_SCHEMA = [
+    SchemaField("run_timestamp", "TIMESTAMP", mode="REQUIRED"),
+    SchemaField("table_name", "STRING", mode="REQUIRED"),
+    SchemaField("ad_account_id", "STRING", mode="REQUIRED"), 
+    SchemaField("rows_processed", "INTEGER", mode="NULLABLE"),
+    SchemaField("status", "STRING", mode="REQUIRED"),
+    SchemaField("error_message", "STRING", mode="NULLABLE"),
+]
+
+_audit_writer = None
+_audit_writer_lock = threading.Lock()
+
 # --- Initialize Clients (Kept the same) ---
 
 def initialize_bigquery_client():
@@ -63,44 +260,45 @@ def initialize_bigquery_client():
     return client
 
 def initialize_meta_api():
-    """Initializes the Facebook Marketing API."""
-    FacebookAdsApi.init(
+    """Initializes the Facebook Marketing API with the header-driven rate limiter."""
+    # Ensure the Facebook library is present
+    try:
+        from rate_limiter import ThrottledFacebookAdsApi
+    except ImportError:
+        print("The 'facebook-business' library is not installed.")
+        sys.exit()
+    ThrottledFacebookAdsApi.init(
         META_CONFIG['app_id'],
         META_CONFIG['app_secret'],
         META_CONFIG['access_token']
     )
-    print("✓ Meta API initialized")
+    print("✓ Meta API initialized (adaptive rate limiting enabled)")
 
 # --- Audit and Table Creation (Kept the same) ---
 def create_bigquery_dataset(client):
-    """Checks if the dataset exists and creates it if it doesn't."""
+    """Checks if the dataset exists and creates it if it doesn't. Returns the dataset."""
     dataset_id = BQ_CONFIG['dataset_id']
     dataset_ref = client.dataset(dataset_id)
     try:
-        client.get_dataset(dataset_ref) 
+        dataset = client.get_dataset(dataset_ref) 
         print(f"✓ Dataset '{dataset_id}' exists.")
     except Exception as e:
         if 'Not found' in str(e) or '404' in str(e):
-            client.create_dataset(bigquery.Dataset(dataset_ref)) 
+            dataset = client.create_dataset(bigquery.Dataset(dataset_ref)) 
             print(f"✨ Created Dataset: {dataset_id}")
         else:
             raise e
+    return dataset
 
 def ensure_audit_log_table(client):
     """Ensures the audit log table exists with the correct (REQUIRED) schema."""
-    audit_table_name = 'etl_audit_log'
+    audit_table_name = AUDIT_LOG_TABLE
     full_audit_table_id = f"{BQ_CONFIG['project_id']}.{BQ_CONFIG['dataset_id']}.{audit_table_name}"
     
-    schema = [
-        SchemaField("run_timestamp", "TIMESTAMP", mode="REQUIRED"),
-        SchemaField("table_name", "STRING", mode="REQUIRED"),
-        SchemaField("ad_account_id", "STRING", mode="REQUIRED"), 
-        SchemaField("rows_processed", "INTEGER", mode="NULLABLE"),
-        SchemaField("status", "STRING", mode="REQUIRED"),
-        SchemaField("error_message", "STRING", mode="NULLABLE"),
-    ]
-    
-    table = Table(full_audit_table_id, schema=schema)
+    table = Table(full_audit_table_id, schema=AUDIT_LOG_SCHEMA)
+    if BOOTSTRAP.is_current(full_audit_table_id, AUDIT_LOG_SCHEMA):
+        print(f"✓ Audit Log Table '{audit_table_name}' is in the bootstrap manifest.")
+        return
     
     try:
         client.get_table(table)
@@ -113,21 +311,23 @@ def ensure_audit_log_table(client):
         else:
             print(f"🔴 ERROR during audit table check: {e}")
             raise 
+    BOOTSTRAP.record(full_audit_table_id, AUDIT_LOG_SCHEMA)
 
 # --- New Helper Function for Paging ---
-def fetch_paged_data_safely(fetch_method, fields, entity_name):
+def iter_paged_data(fetch_method, fields, entity_name, extra_params=None):
     """
-    Fetches data using pagination, sleeping between each page request to respect limits.
+    Fetches data using pagination, yielding one page (list of dicts) at a time.
+    Each page request is paced by the rate limit governor installed in
+    initialize_meta_api, so no fixed sleeps are needed here.
     
     Args:
         fetch_method (callable): e.g., ad_account.get_campaigns
         fields (list): Fields to request.
         entity_name (str): 'Campaigns', 'Adsets', or 'Ads' for logging.
+        extra_params (dict): Additional request params, e.g. an updated_time filter.
     """
-    all_data = []
-    
     # Initial parameters for the first request
-    params = {'fields': fields, 'limit': 100} # Set a reasonable limit per page
+    params = {'fields': fields, 'limit': 100, **(extra_params or {})} # Set a reasonable limit per page
     
     print(f"  -> Starting paged fetch for {entity_name}...")
     
@@ -138,320 +338,907 @@ def fetch_paged_data_safely(fetch_method, fields, entity_name):
         print(f"  🔴 Error starting {entity_name} fetch: {e}")
         raise
 
-    # Iterate through the pages
-    page_count = 0
+    from async_insights import iter_cursor_pages
+
+    # Iterate through the pages (the SDK requests the next page when the current one runs out)
     total_count = 0
-    for entity in iterator:
-        all_data.append(entity.export_all_data())
-        total_count += 1
-        
-        # Check if we've moved to a new page (SDK handles this internally, 
-        # but we use 'iterator.load_next_page()' logic if needed, 
-        # or simply check the cursor to determine when the page changes)
-        # For simplicity and maximum safety, we sleep after a batch of 100 entities (our limit)
-        if total_count % 100 == 0:
-            page_count += 1
-            print(f"  -> Fetched {total_count} {entity_name} across {page_count} pages. Sleeping for 2s...")
-            time.sleep(2) # 🌟 CRITICAL SAFEGUARD
+    for page_count, page in enumerate(iter_cursor_pages(iterator), start=1):
+        total_count += len(page)
+        print(f"  -> Fetched {total_count} {entity_name} across {page_count} pages...")
+        yield page
 
     print(f"  -> Completed fetch for {entity_name}. Total entities: {total_count}")
-    return all_data
+
+def fetch_paged_data_safely(fetch_method, fields, entity_name, extra_params=None):
+    """Fetches all pages of an entity into a single list of dicts (see iter_paged_data)."""
+    return [row for page in iter_paged_data(fetch_method, fields, entity_name, extra_params) for row in page]
+
+def iter_insights_for_level(ad_account, level, fields, since, until, params, windows=None, on_window_done=None):
+    """
+    Fetches one insights level for [since, until], yielding one page (list of dicts) at a time.
+
+    Uses sharded async report runs when RUN_CONFIG['insights_mode'] is 'async',
+    otherwise one synchronous get_insights call per window. windows restricts the
+    fetch to these (since, until) windows (e.g. those not checkpointed yet), and
+    on_window_done is called with each window once all of its pages were yielded.
+    """
+    from async_insights import fetch_insights_async, iter_cursor_pages
+
+    level_params = {**params, 'level': level, 'time_increment': 1}
+    if RUN_CONFIG['insights_mode'] == 'async':
+        yield from fetch_insights_async(ad_account, fields, level_params, since, until, label=f"{level} insights",
+                                        windows=windows, on_window_done=on_window_done)
+        return
+
+    for window in (windows if windows is not None else [(since, until)]):
+        time_range_params = {'time_range': {'since': window[0], 'until': window[1]}}
+        # Ensure the limit is present for insights as well, though the SDK handles insight paging
+        yield from iter_cursor_pages(ad_account.get_insights(
+            fields=fields,
+            params={**time_range_params, **level_params, 'limit': 1000}
+        ))
+        if on_window_done:
+            on_window_done(window)
+
+def insight_page_source(ad_account, table_name, date_range):
+    """Page source (see build_page_sources) of one insight table over a (since, until) range."""
+    level, _ = INSIGHT_TABLE_PROFILES[table_name]
+    return lambda windows=None, on_window_done=None: iter_insights_for_level(
+        ad_account, level, insight_fields(table_name), *date_range, {'breakdowns': INSIGHT_BREAKDOWNS},
+        windows, on_window_done
+    )
+
+def _fetch_with_global_slot(fetch):
+    """Runs one dataset fetch while holding a slot of the global Meta fetch cap."""
+    with _meta_fetch_slots:
+        return fetch()
+
+def run_fetch_tasks(fetch_tasks):
+    """
+    Runs an account's dataset fetches concurrently and returns {dataset: rows}.
+
+    At most RUN_CONFIG['max_fetches_per_account'] run at once for this account, and
+    all accounts together share RUN_CONFIG['max_concurrent_meta_fetches'] slots. The
+    first failure is re-raised so the account fails as a whole, as before.
+    """
+    pool = ThreadPoolExecutor(max_workers=RUN_CONFIG['max_fetches_per_account'])
+    try:
+        futures = {name: pool.submit(_fetch_with_global_slot, fetch) for name, fetch in fetch_tasks.items()}
+        return {name: future.result() for name, future in futures.items()}
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
 
 # --- Fetch Meta Data (MODIFIED: Implements Paging for Structure) ---
-def fetch_meta_data(ad_account_id, last_run_time_insight,run_timestamp_dt):
+def build_page_sources(ad_account_id, insight_ranges, structure_syncs, structure_fetcher=None, archive=None):
     """
-    Fetches structure and insights for a single ad_account_id, using safe paging 
-    for structure data and date-based incremental fetching for insights.
+    Describes the fetches for a single ad_account_id, using safe paging for structure
+    data and date-based incremental fetching for insights. insight_ranges maps each
+    insight table due this run (see EtlRun.due_insight_tables) to its (since, until)
+    range, or None if it is up to date;
+    structure_syncs maps each structure table to its StructureSync. If a
+    structure_fetcher (BatchedEdgeFetcher) is given, structure pages come from it.
+    If an archive (RawArchive) is given, every page is also written to it.
+
+    Returns {dataset: callable}; each callable starts the fetch and returns an iterator
+    of pages (lists of dicts). Nothing is requested from Meta until it is called.
+    Insight callables also take windows= and on_window_done= (see iter_insights_for_level).
     """
+    from facebook_business.adobjects.adaccount import AdAccount
+
     ad_account = AdAccount(ad_account_id)
-    data = {}
+    page_sources = {}
     
     # --- 1. Fetch Structure Data (Campaigns, Adsets, Ads) using safe paging ---
+    # Only objects updated since the last sync, except on a full reconcile (see structure_sync.py)
+    for table_name, sync in structure_syncs.items():
+        print(f"  {table_name} Sync: {sync.describe()}")
     
+    def structure_pages(table_name, fetch_method, entity_name):
+        sync = structure_syncs[table_name]
+        if structure_fetcher is not None:
+            # Requests are packed into Graph API batches with other entities and accounts
+            pages = structure_fetcher.iter_pages(ad_account_id, table_name)
+        else:
+            pages = iter_paged_data(fetch_method, STRUCTURE_FIELDS[table_name], entity_name, sync.fetch_params())
+        return sync.track(pages)
+
     # Campaigns
-    # campaign_fields = ['id', 'name', 'objective', 'status', 'start_time', 'stop_time']
-    campaign_fields = ['account_id', 'adlabels', 'advantage_state_info', 'bid_strategy', 'boosted_object_id', 'brand_lift_studies', 'budget_rebalance_flag', 'budget_remaining', 'buying_type', 'campaign_group_active_time', 'can_create_brand_lift_study', 'can_use_spend_cap', 'configured_status', 'created_time', 'daily_budget', 'effective_status', 'has_secondary_skadnetwork_reporting', 'id', 'is_adset_budget_sharing_enabled', 'is_budget_schedule_enabled', 'is_direct_send_campaign', 'is_message_campaign', 'is_skadnetwork_attribution', 'issues_info', 'last_budget_toggling_time', 'lifetime_budget', 'name', 'objective', 'pacing_type', 'primary_attribution', 'promoted_object', 'recommendations', 'smart_promotion_type', 'source_campaign', 'source_campaign_id', 'source_recommendation_type', 'special_ad_categories', 'special_ad_category', 'special_ad_category_country', 'spend_cap', 'start_time', 'status', 'stop_time', 'topline_id', 'updated_time', 'adbatch', 'budget_schedule_specs', 'execution_options', 'iterative_split_test_configs']
-    data['campaigns'] = fetch_paged_data_safely(ad_account.get_campaigns, campaign_fields, 'Campaigns')
+    page_sources['campaigns'] = lambda: structure_pages('campaigns', ad_account.get_campaigns, 'Campaigns')
     
     # Adsets
-    # adset_fields = ['id', 'name', 'campaign_id', 'status', 'targeting']
-    # adset_fields = ['account_id', 'adlabels', 'adset_schedule', 'asset_feed_id', 'attribution_spec', 'automatic_manual_state', 'bid_adjustments', 'bid_amount', 'bid_constraints', 'bid_info', 'bid_strategy', 'billing_event', 'brand_safety_config', 'budget_remaining', 'campaign', 'campaign_active_time', 'campaign_attribution', 'campaign_id', 'configured_status', 'created_time', 'creative_sequence', 'creative_sequence_repetition_pattern', 'daily_budget', 'daily_min_spend_target', 'daily_spend_cap', 'destination_type', 'dsa_beneficiary', 'dsa_payor', 'effective_status', 'end_time', 'existing_customer_budget_percentage', 'frequency_control_specs', 'full_funnel_exploration_mode', 'id', 'instagram_user_id', 'is_ba_skip_delayed_eligible', 'is_budget_schedule_enabled', 'is_dynamic_creative', 'is_incremental_attribution_enabled', 'issues_info', 'learning_stage_info', 'lifetime_budget', 'lifetime_imps', 'lifetime_min_spend_target', 'lifetime_spend_cap', 'max_budget_spend_percentage', 'min_budget_spend_percentage', 'multi_optimization_goal_weight', 'name', 'optimization_goal', 'optimization_sub_event', 'pacing_type', 'placement_soft_opt_out', 'promoted_object', 'recommendations', 'recurring_budget_semantics', 'regional_regulated_categories', 'regional_regulation_identities', 'review_feedback', 'rf_prediction_id', 'source_adset', 'source_adset_id', 'start_time', 'status', 'targeting', 'targeting_optimization_types', 'time_based_ad_rotation_id_blocks', 'time_based_ad_rotation_intervals', 'trending_topics_spec', 'updated_time', 'use_new_app_click', 'value_rule_set_id', 'value_rules_applied', 'budget_schedule_specs', 'budget_source', 'budget_split_set_id', 'campaign_spec', 'daily_imps', 'date_format', 'execution_options', 'is_sac_cfca_terms_certified', 'line_number', 'rb_prediction_id', 'time_start', 'time_stop', 'topline_id', 'tune_for_category']
-    adset_fields = ['id', 'name', 'campaign_id', 'account_id', 'status', 'effective_status', 'configured_status', 'created_time', 'updated_time', 'start_time', 'end_time', 'daily_budget', 'lifetime_budget', 'budget_remaining', 'bid_strategy', 'bid_amount', 'billing_event', 'pacing_type', 'optimization_goal', 'optimization_sub_event', 'learning_stage_info', 'destination_type', 'is_dynamic_creative', 'review_feedback']
-    data['adsets'] = fetch_paged_data_safely(ad_account.get_ad_sets, adset_fields, 'Adsets')
+    page_sources['adsets'] = lambda: structure_pages('adsets', ad_account.get_ad_sets, 'Adsets')
     
     # Ads
-    # ad_fields = ['id', 'name', 'adset_id', 'campaign_id', 'status', 'creative']
-    # ad_fields = ['account_id', 'ad_active_time', 'ad_review_feedback', 'ad_schedule_end_time', 'ad_schedule_start_time', 'adlabels', 'adset', 'adset_id', 'bid_amount', 'bid_info', 'bid_type', 'campaign', 'campaign_id', 'configured_status', 'conversion_domain', 'conversion_specs', 'created_time', 'creative', 'creative_asset_groups_spec', 'demolink_hash', 'display_sequence', 'effective_status', 'engagement_audience', 'failed_delivery_checks', 'id', 'issues_info', 'last_updated_by_app_id', 'name', 'placement', 'preview_shareable_link', 'priority', 'recommendations', 'source_ad', 'source_ad_id', 'status', 'targeting', 'tracking_and_conversion_with_defaults', 'tracking_specs', 'updated_time', 'adset_spec', 'audience_id', 'date_format', 'draft_adgroup_id', 'execution_options', 'include_demolink_hashes', 'filename']
-    ad_fields = ['id', 'name', 'adset_id', 'campaign_id', 'status', 'creative', 'account_id', 'effective_status', 'configured_status', 'created_time', 'updated_time', 'bid_amount', 'bid_type', 'call_to_action_type', 'conversion_domain','ad_review_feedback','targeting ','adlabels','issues_info']
-    data['ads'] = fetch_paged_data_safely(ad_account.get_ads, ad_fields, 'Ads')
+    page_sources['ads'] = lambda: structure_pages('ads', ad_account.get_ads, 'Ads')
 
+    # --- 2. Time Ranges for Incremental Insights (one per level, from the watermark store) ---
+    for table_name, date_range in insight_ranges.items():
+        if date_range is None:
+            print(f"  {table_name} is up-to-date. Skipping insight fetch.")
+        else:
+            print(f"  {table_name} Time Range: SINCE {date_range[0]} UNTIL {date_range[1]}")
 
-    # --- 2. Time Range for Incremental Insights (Logic is stable) ---
-    end_date_str = (run_timestamp_dt - timedelta(days=1)).strftime('%Y-%m-%d') 
-    
-    if last_run_time_insight is None:
-        start_date_dt = (run_timestamp_dt - timedelta(days=7))
-    else:
-        start_date_dt = last_run_time_insight.date() + timedelta(days=1)
-        
-    start_date_str = start_date_dt.strftime('%Y-%m-%d')
-    
-    if start_date_str > end_date_str:
-        print(f"  Insights are up-to-date. Range: {start_date_str} to {end_date_str}. Skipping insight fetch.")
-        data['ad_insights'] = []
-        data['adset_insights'] = []
-        data['campaign_insights'] = []
-        return data
-
-    print(f"  Insights Time Range: SINCE {start_date_str} UNTIL {end_date_str}")
-
-    time_range_params = {
-        'time_range': {
-            'since': start_date_str, 
-            'until': end_date_str
-        },
-        'time_increment': 1
-    }
-    # insight_fields = ['account_currency', 'account_id', 'account_name', 'action_values', 'actions', 'ad_click_actions', 'ad_id', 'ad_impression_actions', 'ad_name', 'adset_end', 'adset_id', 'adset_name', 'adset_start', 'age_targeting', 'attribution_setting', 'auction_bid', 'auction_competitiveness', 'auction_max_competitor_bid', 'average_purchases_conversion_value', 'buying_type', 'campaign_id', 'campaign_name', 'canvas_avg_view_percent', 'canvas_avg_view_time', 'catalog_segment_actions', 'catalog_segment_value', 'catalog_segment_value_mobile_purchase_roas', 'catalog_segment_value_omni_purchase_roas', 'catalog_segment_value_website_purchase_roas', 'clicks', 'conversion_lead_rate', 'conversion_leads', 'conversion_rate_ranking', 'conversion_values', 'conversions', 'converted_product_app_custom_event_fb_mobile_purchase', 'converted_product_app_custom_event_fb_mobile_purchase_value', 'converted_product_offline_purchase', 'converted_product_offline_purchase_value', 'converted_product_omni_purchase', 'converted_product_omni_purchase_values', 'converted_product_quantity', 'converted_product_value', 'converted_product_website_pixel_purchase', 'converted_product_website_pixel_purchase_value', 'converted_promoted_product_app_custom_event_fb_mobile_purchase', 'converted_promoted_product_app_custom_event_fb_mobile_purchase_value', 'converted_promoted_product_offline_purchase', 'converted_promoted_product_offline_purchase_value', 'converted_promoted_product_omni_purchase', 'converted_promoted_product_omni_purchase_values', 'converted_promoted_product_quantity', 'converted_promoted_product_value', 'converted_promoted_product_website_pixel_purchase', 'converted_promoted_product_website_pixel_purchase_value', 'cost_per_15_sec_video_view', 'cost_per_2_sec_continuous_video_view', 'cost_per_action_type', 'cost_per_ad_click', 'cost_per_conversion', 'cost_per_conversion_lead', 'cost_per_dda_countby_convs', 'cost_per_estimated_ad_recallers', 'cost_per_inline_link_click', 'cost_per_inline_post_engagement', 'cost_per_objective_result', 'cost_per_one_thousand_ad_impression', 'cost_per_outbound_click', 'cost_per_result', 'cost_per_thruplay', 'cost_per_unique_action_type', 'cost_per_unique_click', 'cost_per_unique_conversion', 'cost_per_unique_inline_link_click', 'cost_per_unique_outbound_click', 'cpc', 'cpm', 'cpp', 'created_time', 'creative_media_type', 'ctr', 'date_start', 'date_stop', 'dda_countby_convs', 'dda_results', 'engagement_rate_ranking', 'estimated_ad_recall_rate', 'estimated_ad_recall_rate_lower_bound', 'estimated_ad_recall_rate_upper_bound', 'estimated_ad_recallers', 'estimated_ad_recallers_lower_bound', 'estimated_ad_recallers_upper_bound', 'frequency', 'full_view_impressions', 'full_view_reach', 'gender_targeting', 'impressions', 'inline_link_click_ctr', 'inline_link_clicks', 'inline_post_engagement', 'instagram_upcoming_event_reminders_set', 'instant_experience_clicks_to_open', 'instant_experience_clicks_to_start', 'instant_experience_outbound_clicks', 'interactive_component_tap', 'labels', 'landing_page_view_actions_per_link_click', 'landing_page_view_per_link_click', 'landing_page_view_per_purchase_rate', 'link_clicks_per_results', 'location', 'marketing_messages_click_rate_benchmark', 'marketing_messages_cost_per_delivered', 'marketing_messages_cost_per_link_btn_click', 'marketing_messages_delivered', 'marketing_messages_delivery_rate', 'marketing_messages_link_btn_click', 'marketing_messages_link_btn_click_rate', 'marketing_messages_media_view_rate', 'marketing_messages_phone_call_btn_click_rate', 'marketing_messages_quick_reply_btn_click', 'marketing_messages_quick_reply_btn_click_rate', 'marketing_messages_read', 'marketing_messages_read_rate', 'marketing_messages_read_rate_benchmark', 'marketing_messages_sent', 'marketing_messages_spend', 'marketing_messages_spend_currency', 'marketing_messages_website_add_to_cart', 'marketing_messages_website_initiate_checkout', 'marketing_messages_website_purchase', 'marketing_messages_website_purchase_values', 'mobile_app_purchase_roas', 'objective', 'objective_result_rate', 'objective_results', 'onsite_conversion_messaging_detected_purchase_deduped', 'optimization_goal', 'outbound_clicks', 'outbound_clicks_ctr', 'place_page_name', 'product_group_retailer_id', 'product_retailer_id', 'product_views', 'purchase_per_landing_page_view', 'purchase_roas', 'purchases_per_link_click', 'qualifying_question_qualify_answer_rate', 'quality_ranking', 'reach', 'result_rate', 'result_values_performance_indicator', 'results', 'shops_assisted_purchases', 'social_spend', 'spend', 'total_card_view', 'total_postbacks', 'total_postbacks_detailed', 'total_postbacks_detailed_v4', 'unique_actions', 'unique_clicks', 'unique_conversions', 'unique_ctr', 'unique_inline_link_click_ctr', 'unique_inline_link_clicks', 'unique_link_clicks_ctr', 'unique_outbound_clicks', 'unique_outbound_clicks_ctr', 'unique_video_continuous_2_sec_watched_actions', 'unique_video_view_15_sec', 'updated_time', 'video_15_sec_watched_actions', 'video_30_sec_watched_actions', 'video_avg_time_watched_actions', 'video_continuous_2_sec_watched_actions', 'video_p100_watched_actions', 'video_p25_watched_actions', 'video_p50_watched_actions', 'video_p75_watched_actions', 'video_p95_watched_actions', 'video_play_actions', 'video_play_curve_actions', 'video_play_retention_0_to_15s_actions', 'video_play_retention_20_to_60s_actions', 'video_play_retention_graph_actions', 'video_thruplay_watched_actions', 'video_time_watched_actions', 'video_view_per_impression', 'website_ctr', 'website_purchase_roas', 'wish_bid']
-    # insight_fields = ['account_currency', 'account_id', 'account_name', 'action_values', 'actions','ad_click_actions', 'ad_id', 'ad_impression_actions', 'ad_name', 'adset_end','adset_id', 'adset_name', 'adset_start', 'attribution_setting', 'auction_bid','auction_competitiveness', 'auction_max_competitor_bid', 'average_purchases_conversion_value','buying_type', 'campaign_id', 'campaign_name', 'canvas_avg_view_percent','canvas_avg_view_time', 'catalog_segment_actions', 'catalog_segment_value','catalog_segment_value_mobile_purchase_roas', 'catalog_segment_value_omni_purchase_roas','catalog_segment_value_website_purchase_roas', 'clicks', 'conversion_lead_rate','conversion_leads', 'conversion_rate_ranking', 'conversion_values', 'conversions','cost_per_15_sec_video_view', 'cost_per_2_sec_continuous_video_view','cost_per_action_type', 'cost_per_ad_click', 'cost_per_conversion', 'cost_per_conversion_lead','cost_per_dda_countby_convs', 'cost_per_estimated_ad_recallers','cost_per_inline_link_click', 'cost_per_inline_post_engagement', 'cost_per_objective_result','cost_per_one_thousand_ad_impression', 'cost_per_outbound_click', 'cost_per_result','cost_per_thruplay', 'cost_per_unique_action_type', 'cost_per_unique_click','cost_per_unique_conversion', 'cost_per_unique_inline_link_click', 'cost_per_unique_outbound_click','cpc', 'cpm', 'cpp', 'created_time', 'creative_media_type', 'ctr', 'date_start','date_stop', 'dda_countby_convs', 'dda_results', 'engagement_rate_ranking','estimated_ad_recall_rate', 'estimated_ad_recallers', 'frequency', 'full_view_impressions','full_view_reach', 'impressions', 'inline_link_click_ctr', 'inline_link_clicks','inline_post_engagement', 'instagram_upcoming_event_reminders_set','instant_experience_clicks_to_open', 'instant_experience_clicks_to_start','instant_experience_outbound_clicks', 'interactive_component_tap','landing_page_view_actions_per_link_click', 'landing_page_view_per_link_click','landing_page_view_per_purchase_rate', 'link_clicks_per_results','marketing_messages_click_rate_benchmark', 'marketing_messages_cost_per_delivered','marketing_messages_cost_per_link_btn_click', 'marketing_messages_delivered','marketing_messages_delivery_rate', 'marketing_messages_link_btn_click','marketing_messages_link_btn_click_rate', 'marketing_messages_media_view_rate','marketing_messages_phone_call_btn_click_rate', 'marketing_messages_quick_reply_btn_click','marketing_messages_quick_reply_btn_click_rate', 'marketing_messages_read','marketing_messages_read_rate', 'marketing_messages_read_rate_benchmark','marketing_messages_sent', 'marketing_messages_spend', 'marketing_messages_spend_currency','marketing_messages_website_add_to_cart', 'marketing_messages_website_initiate_checkout','marketing_messages_website_purchase', 'marketing_messages_website_purchase_values','mobile_app_purchase_roas', 'objective', 'objective_result_rate', 'objective_results','onsite_conversion_messaging_detected_purchase_deduped', 'optimization_goal','outbound_clicks', 'outbound_clicks_ctr', 'place_page_name', 'product_group_retailer_id','product_retailer_id', 'product_views', 'purchase_per_landing_page_view', 'purchase_roas','purchases_per_link_click', 'qualifying_question_qualify_answer_rate', 'quality_ranking','reach', 'result_rate', 'result_values_performance_indicator', 'results','shops_assisted_purchases', 'social_spend', 'spend', 'total_card_view','unique_actions', 'unique_clicks', 'unique_conversions', 'unique_ctr','unique_inline_link_click_ctr', 'unique_inline_link_clicks', 'unique_link_clicks_ctr','unique_outbound_clicks', 'unique_outbound_clicks_ctr', 'unique_video_continuous_2_sec_watched_actions','unique_video_view_15_sec', 'updated_time', 'video_15_sec_watched_actions','video_30_sec_watched_actions', 'video_avg_time_watched_actions','video_continuous_2_sec_watched_actions', 'video_p100_watched_actions','video_p25_watched_actions', 'video_p50_watched_actions', 'video_p75_watched_actions','video_p95_watched_actions', 'video_play_actions', 'video_play_curve_actions','video_play_retention_0_to_15s_actions', 'video_play_retention_20_to_60s_actions','video_play_retention_graph_actions', 'video_thruplay_watched_actions','video_time_watched_actions', 'video_view_per_impression', 'website_ctr','website_purchase_roas', 'wish_bid']
-    insight_fields = [
-    'account_currency', 'account_id', 'account_name', 'ad_id', 'ad_name', 
-    'adset_id', 'adset_name', 'campaign_id', 'campaign_name', 'buying_type', 
-    'objective', 'date_start', 'date_stop', 
-    
-    # Core Metrics
-    'impressions', 'reach', 'frequency', 'spend', 'social_spend', 
-    
-    # Clicks & CTR
-    'clicks', 'cpc', 'cpm', 'ctr', 'unique_clicks', 'unique_ctr', 
-    'inline_link_clicks', 'inline_link_click_ctr', 'unique_inline_link_clicks', 
-    'unique_inline_link_click_ctr', 'outbound_clicks', 'outbound_clicks_ctr', 
-    'unique_outbound_clicks', 'unique_outbound_clicks_ctr',
-
-    # Post Engagement
-    'inline_post_engagement', 'cost_per_inline_post_engagement', 
-
-    # Results & Conversions (Summary fields)
-    'results', 'result_rate', 'cost_per_result', 'optimization_goal',
-    'conversions', 'conversion_values', 'cost_per_conversion', 
-    'actions', 'action_values', 'unique_actions', 'cost_per_action_type', 
-    'cost_per_unique_action_type',
-
-    # Video & Canvas 
-    'video_thruplay_watched_actions',
-    'canvas_avg_view_percent', 'canvas_avg_view_time',
-
-    # Quality and Times
-    'quality_ranking', 'conversion_rate_ranking', 'engagement_rate_ranking', 
-    'created_time', 'updated_time',]
-   
-    breakdown_params = {'breakdowns': ['publisher_platform', 'platform_position']}
-    # Ensure the limit is present for insights as well, though the SDK handles insight paging
-    limit_param = {'limit': 1000} 
-    
-    print("  -> Fetching Insights...")
-
-    # Fetch Insights (The SDK handles insight paging robustly, so we don't need the manual sleep loop here)
-    data['ad_insights'] = [i.export_all_data() for i in ad_account.get_insights(
-        fields=insight_fields + ['campaign_id', 'adset_id', 'ad_id'],
-        params={**time_range_params, 'level': 'ad', **breakdown_params, **limit_param}
-    )]
-    data['adset_insights'] = [i.export_all_data() for i in ad_account.get_insights(
-        fields=insight_fields + ['campaign_id', 'adset_id'],
-        params={**time_range_params, 'level': 'adset', **breakdown_params, **limit_param}
-    )]
-    data['campaign_insights'] = [i.export_all_data() for i in ad_account.get_insights(
-        fields=insight_fields + ['campaign_id'],
-        params={**time_range_params, 'level': 'campaign', **breakdown_params, **limit_param}
-    )]
+    # Fetch Insights (every request, sync or async, goes through the rate limit governor)
+    # Tables that are up to date get an empty source and are audited as SKIPPED; tables
+    # whose profile is not due this run are left out altogether
+    for table_name, date_range in insight_ranges.items():
+        if date_range is None:
+            page_sources[table_name] = lambda **kwargs: iter(())
+        else:
+            page_sources[table_name] = insight_page_source(ad_account, table_name, date_range)
+
+    if archive is not None:
+        page_sources = {name: archive.recording(ad_account_id, name, source) for name, source in page_sources.items()}
+
+    return page_sources
+
+def build_lookback_sources(ad_account_id, lookback_ranges, archive=None):
+    """Page sources re-fetching the lookback range of each insight table that has one (see lookback.py)."""
+    from facebook_business.adobjects.adaccount import AdAccount
+
+    ad_account = AdAccount(ad_account_id)
+    page_sources = {}
+    for table_name, date_range in lookback_ranges.items():
+        if date_range is None:
+            continue
+        print(f"  {table_name} Lookback: SINCE {date_range[0]} UNTIL {date_range[1]}")
+        page_sources[table_name] = insight_page_source(ad_account, table_name, date_range)
+        if archive is not None:
+            page_sources[table_name] = archive.recording(ad_account_id, table_name, page_sources[table_name])
+    return page_sources
+
+def with_retries(fn, label):
+    """Calls fn, retrying up to RUN_CONFIG['unit_retries'] times after a failure."""
+    for attempt in range(RUN_CONFIG['unit_retries'] + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= RUN_CONFIG['unit_retries']:
+                raise
+            print(f"🔁 Error fetching {label} ({e}). Retrying in {RUN_CONFIG['retry_backoff_seconds']}s "
+                  f"(attempt {attempt + 1})...")
+            METRICS.record(retries=1)
+            time.sleep(RUN_CONFIG['retry_backoff_seconds'])
+
+def fetch_dataset(name, page_source, ad_account_id):
+    """Fetches all pages of one dataset of an account into a list of dicts, as one 'fetch' stage."""
+    with METRICS.stage('fetch', ad_account_id, name) as stage:
+        rows = with_retries(lambda: [row for page in page_source() for row in page], f"{name} for {ad_account_id}")
+        stage.add(rows=len(rows))
+        return rows
+
+def fetch_meta_data(ad_account_id, insight_ranges, structure_syncs, structure_fetcher=None, archive=None):
+    """
+    Fetches structure and insights for a single ad_account_id into lists of dicts,
+    running the datasets concurrently (per-account and global caps).
+    """
+    page_sources = build_page_sources(ad_account_id, insight_ranges, structure_syncs, structure_fetcher, archive)
+
+    print("  -> Fetching Structure and Insights...")
+    data = run_fetch_tasks({
+        name: (lambda name=name, source=source: fetch_dataset(name, source, ad_account_id))
+        for name, source in page_sources.items()
+    })
     
-    total_insights = len(data['ad_insights']) + len(data['adset_insights']) + len(data['campaign_insights'])
+    total_insights = sum(len(data[table_name]) for table_name in insight_ranges)
 
     print(f"Fetched structure for {ad_account_id}: {len(data['campaigns'])} campaigns, {len(data['adsets'])} adsets, {len(data['ads'])} ads. Total Insights: {total_insights}")
     return data
 
 # --- BigQuery Load Function (Kept the same) ---
-def load_data_to_bigquery(client, df, table_name):
-    """Loads a pandas DataFrame into BigQuery."""
-    full_table_id = f"{client.project}.{BQ_CONFIG['dataset_id']}.{table_name}"
-    
-    is_insight_table = table_name in ['ad_insights', 'adset_insights', 'campaign_insights', 'insights']
+def build_load_job_config(table_name, append=False, staging=False):
+    """
+    Builds the load job config for a table.
+
+    append=True forces WRITE_APPEND, used for every chunk after the first when a table
+    is loaded in several chunks. Appends may add columns (e.g. new wide action columns).
+    staging=True is for insight rows loaded into their staging table to be MERGEd
+    (insight_merge.py): the staging table is replaced and not partitioned.
+    """
+    is_insight_table = table_name in INSIGHT_TABLES + ['insights'] and not staging
     
-    # Truncate structure tables, Append to insight tables (due to time partitioning)
+    # Truncate structure tables (their per-account staging tables), Append to insight tables (due to time partitioning)
     write_disp = bigquery.WriteDisposition.WRITE_TRUNCATE if not is_insight_table else bigquery.WriteDisposition.WRITE_APPEND
+    if append:
+        write_disp = bigquery.WriteDisposition.WRITE_APPEND
     
-    job_config = bigquery.LoadJobConfig(
+    return bigquery.LoadJobConfig(
         write_disposition=write_disp,
+        schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION]
+        if write_disp == bigquery.WriteDisposition.WRITE_APPEND else None,
         time_partitioning=bigquery.TimePartitioning(
             field="last_run_timestamp",
             type_=bigquery.TimePartitioningType.DAY
         ) if is_insight_table else None
     )
 
+def load_data_to_bigquery(client, df, table_name, full_table_id=None, staging=False):
+    """
+    Loads a pandas DataFrame into BigQuery (into full_table_id instead of table_name if given).
+    staging=True loads insight rows into their staging table (see build_load_job_config).
+    """
+    full_table_id = full_table_id or f"{client.project}.{BQ_CONFIG['dataset_id']}.{table_name}"
+    job_config = build_load_job_config(table_name, staging=staging)
+    if RUN_CONFIG['typed_schemas']:
+        # Explicit types instead of autodetection (columns outside the registry are still detected)
+        job_config.schema = TABLE_SCHEMAS[table_name].bigquery_schema
+
     print(f"🚀 Starting load job for table: {full_table_id}")
-    job = client.load_table_from_dataframe(df, full_table_id, job_config=job_config)
-    job.result()
+    with METRICS.stage('load_job', table_name=table_name, log=False):
+        job = client.load_table_from_dataframe(df, full_table_id, job_config=job_config)
+        job.result()
     print(f"🎉 Successfully loaded {len(df)} rows to BigQuery table: {full_table_id}")
 
-# --- Audit Log (Kept the same) ---
-def log_audit_entry(client, run_timestamp, ad_account_id, table_name, rows_processed, status, error_message=None):
-    """Loads a single log entry into the dedicated ETL Audit Log table using pandas-gbq."""
-    
-    audit_table_name = 'etl_audit_log'
-    full_table_id = f"{BQ_CONFIG['dataset_id']}.{audit_table_name}"
+# --- Audit Log (Buffered; flushed in batches by AuditLogWriter) ---
+def get_audit_writer(client):
+    """Returns the run's shared AuditLogWriter, creating it on first use."""
+    global _audit_writer
+    with _audit_writer_lock:
+        if _audit_writer is None:
+            full_table_id = f"{BQ_CONFIG['project_id']}.{BQ_CONFIG['dataset_id']}.{AUDIT_LOG_TABLE}"
+            _audit_writer = AuditLogWriter(client, full_table_id, AUDIT_LOG_SCHEMA)
+            _audit_writer.install_exit_handlers()
+        return _audit_writer
 
-    log_data = [{
+def log_audit_entry(client, run_timestamp, ad_account_id, table_name, rows_processed, status, error_message=None):
+    """Buffers a single log entry for the dedicated ETL Audit Log table (written in batches)."""
+    get_audit_writer(client).add({
         'run_timestamp': run_timestamp,  
         'table_name': table_name,
         'ad_account_id': ad_account_id, 
         'rows_processed': rows_processed,
         'status': status,
         'error_message': str(error_message) if error_message else None 
-    }]
-    
-    log_df = pd.DataFrame(log_data)
-    
-    log_schema = [
-        {'name': 'run_timestamp', 'data_type': 'TIMESTAMP'},
-        {'name': 'table_name', 'data_type': 'STRING'},
-        {'name': 'ad_account_id', 'data_type': 'STRING'},
-        {'name': 'rows_processed', 'data_type': 'INTEGER'},
-        {'name': 'status', 'data_type': 'STRING'},
-        {'name': 'error_message', 'data_type': 'STRING'},
-    ]
+    })
+
+def insight_merge_for(table_name, ad_account_id):
+    """The InsightMerge of an account's insight table in merge mode (None otherwise)."""
+    if RUN_CONFIG['insight_load_mode'] == 'merge' and table_name in INSIGHT_TABLES:
+        return InsightMerge(table_name, ad_account_id)
+    return None
+
+# --- Per-Account Pipeline ---
+class EtlRun(object):
+    """Shared state of one ETL run, handed to the per-account pipeline."""
+
+    def __init__(self, client, run_timestamp_dt, load_pool, watermarks, checkpoints, archive=None, hashes=None,
+                 leases=None):
+        self.client = client
+        self.run_timestamp_dt = run_timestamp_dt
+        self.load_pool = load_pool
+        self.watermarks = watermarks
+        self.checkpoints = checkpoints
+        self.archive = archive
+        self.hashes = hashes
+        self.leases = leases
+        self.lookback_since = (run_timestamp_dt - timedelta(days=LOOKBACK_CONFIG['days'])).strftime('%Y-%m-%d')
+        # Insight profiles are scheduled against the fetched_at watermark (UTC, like BigQuery timestamps)
+        self.started_at = datetime.now(timezone.utc)
+        self.structure_fetcher = None
+        self._batchable_accounts = set()
+        self._batched_accounts = set()
+        self._structure_syncs = {}
+        self._due_tables = {}
+        self._lock = threading.Lock()
+
+    def due_insight_tables(self, ad_account_id):
+        """
+        The insight tables of an account whose profile is due this run (decided once per run):
+        those never fetched, or last fetched at least the profile's every_hours ago.
+        """
+        with self._lock:
+            if ad_account_id in self._due_tables:
+                return self._due_tables[ad_account_id]
+        slack = timedelta(minutes=RUN_CONFIG['profile_schedule_slack_minutes'])
+        due_tables = []
+        for table_name, (_, profile_name) in INSIGHT_TABLE_PROFILES.items():
+            every = timedelta(hours=INSIGHT_PROFILES[profile_name]['every_hours'])
+            fetched_at = self.watermarks.get(ad_account_id, table_name, 'fetched_at')
+            if fetched_at is None or every <= slack or fetched_at + every - slack <= self.started_at:
+                due_tables.append(table_name)
+            else:
+                print(f"  {table_name} not due until {(fetched_at + every).strftime('%Y-%m-%d %H:%M')} UTC "
+                      f"({profile_name} profile). Skipping.")
+        with self._lock:
+            return self._due_tables.setdefault(ad_account_id, due_tables)
+
+    def insight_ranges(self, ad_account_id):
+        """Date range still to fetch for each due insight table of an account (None if up to date)."""
+        return {
+            table_name: insight_date_range(self.watermarks.get(ad_account_id, table_name), self.run_timestamp_dt)
+            for table_name in self.due_insight_tables(ad_account_id)
+        }
+
+    def lookback_ranges(self, ad_account_id):
+        """Already loaded date range to re-sync for each due insight table of an account (None if none)."""
+        return {
+            table_name: lookback_date_range(self.watermarks.get(ad_account_id, table_name), self.run_timestamp_dt,
+                                            LOOKBACK_CONFIG['days'])
+            for table_name in self.due_insight_tables(ad_account_id)
+        }
+
+    def insight_progress(self, ad_account_id, insight_ranges):
+        """Checkpointed progress through the date range of each insight table that has one."""
+        return {
+            table_name: WindowProgress(self.checkpoints, ad_account_id, table_name, *date_range)
+            for table_name, date_range in insight_ranges.items() if date_range is not None
+        }
+
+    def structure_syncs(self, ad_account_id):
+        """Incremental or full sync plan for each structure table of an account (planned once per run)."""
+        with self._lock:
+            if ad_account_id not in self._structure_syncs:
+                self._structure_syncs[ad_account_id] = {
+                    table_name: StructureSync(
+                        table_name, ad_account_id,
+                        self.watermarks.get(ad_account_id, table_name, 'updated_through'),
+                        self.watermarks.get(ad_account_id, table_name, 'full_sync_at'),
+                    )
+                    for table_name in STRUCTURE_TABLES
+                }
+            return self._structure_syncs[ad_account_id]
+
+    def start_structure_fetcher(self, ad_account_ids):
+        """Starts one BatchedEdgeFetcher for the structure fetches of ad_account_ids (see register_structure_fetches)."""
+        from batch_fetch import BatchedEdgeFetcher
+        from rate_limiter import ThrottledFacebookAdsApi
+
+        self.structure_fetcher = BatchedEdgeFetcher(ThrottledFacebookAdsApi.get_default_api())
+        self._batchable_accounts = set(ad_account_ids)
+        self.structure_fetcher.start()
+
+    def register_structure_fetches(self, ad_account_id):
+        """
+        Registers the account's structure fetches with the BatchedEdgeFetcher. Called once the
+        account is leased, so a task never fetches (or spends quota on) an account another task holds.
+        """
+        if self.structure_fetcher is None or ad_account_id not in self._batchable_accounts:
+            return
+        for table_name, sync in self.structure_syncs(ad_account_id).items():
+            self.structure_fetcher.register(ad_account_id, table_name, STRUCTURE_FIELDS[table_name],
+                                            sync.fetch_params())
+        with self._lock:
+            self._batched_accounts.add(ad_account_id)
+
+    def structure_fetcher_for(self, ad_account_id):
+        """The BatchedEdgeFetcher if it has the account's structure fetches (accounts taken over from other tasks don't)."""
+        return self.structure_fetcher if ad_account_id in self._batched_accounts else None
+
+    def on_loaded_callback(self, ad_account_id, table_name, insight_ranges, structure_syncs):
+        """Callback that advances the table's watermarks after a successful load (None if it has none)."""
+        if table_name in structure_syncs:
+            sync = structure_syncs[table_name]
+            return lambda: self.watermarks.advance(ad_account_id, table_name, **sync.watermarks())
+        if table_name not in insight_ranges:
+            return None
+        # A due insight table restarts its profile's schedule, even when it was up to date
+        date_range = insight_ranges[table_name]
+        loaded_through = datetime.strptime(date_range[1], '%Y-%m-%d').date() if date_range else None
+        return lambda: self.watermarks.advance(ad_account_id, table_name, loaded_through=loaded_through,
+                                               fetched_at=self.started_at)
 
+def build_dataframes(meta_data_py, ad_account_id, run_timestamp_dt):
+    """Turns the fetched Meta data for one account into the DataFrames to load, keyed by table."""
+    if RUN_CONFIG['typed_schemas']:
+        extra_columns = {'ad_account_id': ad_account_id, 'last_run_timestamp': run_timestamp_dt}
+        return {
+            table_name: TABLE_SCHEMAS[table_name].to_arrow(meta_data_py[table_name], extra_columns).to_pandas()
+            if meta_data_py[table_name] else pd.DataFrame()
+            for table_name in TABLE_SCHEMAS if table_name in meta_data_py
+        }
+
+    # Only the tables fetched this run (insight profiles that are not due are left out)
+    dataframes = {
+        table_name: pd.DataFrame(meta_data_py[table_name])
+        for table_name in TABLE_SCHEMAS if table_name in meta_data_py
+    }
+    for table_name, columns in STRUCTURE_JSON_COLUMNS.items():
+        df = dataframes.get(table_name)
+        for column in columns:
+            if df is not None and column in df.columns:
+                df[column] = df[column].map(encode_json, na_action='ignore')
+
+    # Add the ad_account_id and audit timestamp column to ALL DataFrames
+    for df in dataframes.values():
+        if not df.empty:
+            df['ad_account_id'] = ad_account_id
+            df['last_run_timestamp'] = run_timestamp_dt
+            
+    # Convert 'date_start' for insights to datetime objects
+    for table_name, df in dataframes.items():
+        if table_name in INSIGHT_TABLES and not df.empty and 'date_start' in df.columns:
+            df['date_start'] = pd.to_datetime(df['date_start'])
+            
+    return dataframes
+
+def load_table_with_audit(client, df, table_name, ad_account_id, run_timestamp_dt, on_loaded=None, structure_sync=None,
+                          insight_merge=None):
+    """
+    Loads one table for one account and records the outcome in the audit log.
+    on_loaded is called once the table is fully loaded (or was fetched empty).
+    Structure tables (structure_sync given) and insight tables in merge mode
+    (insight_merge given) are loaded into a staging table and MERGEd.
+    """
+    rows_processed = len(df)
+    
+    if rows_processed == 0:
+        try:
+            if structure_sync:
+                structure_sync.apply(client, BQ_CONFIG['dataset_id'], 0)
+        except Exception as e:
+            print(f"❌ An error occurred while syncing {table_name} for {ad_account_id} to BigQuery: {e}")
+            log_audit_entry(client, run_timestamp_dt, ad_account_id, table_name, 0, "FAILURE", str(e))
+            return
+        print(f"Skipping {table_name} for {ad_account_id}: DataFrame is empty.")
+        log_audit_entry(client, run_timestamp_dt, ad_account_id, table_name, 0, "SKIPPED")
+        if on_loaded:
+            on_loaded()
+        return
+        
     try:
-        pandas_gbq.to_gbq(
-           dataframe= log_df,
-            destination_table=full_table_id,
-            project_id=BQ_CONFIG['project_id'],
-            if_exists='append',
-            table_schema=log_schema
-        )
-        print(f"✅ Logged audit entry for {table_name} using pandas-gbq.")
+        with METRICS.stage('load', ad_account_id, table_name) as stage:
+            if structure_sync:
+                load_data_to_bigquery(client, df, table_name,
+                                      structure_sync.staging_table_id(client, BQ_CONFIG['dataset_id']))
+                structure_sync.apply(client, BQ_CONFIG['dataset_id'], rows_processed)
+            elif insight_merge:
+                load_data_to_bigquery(client, df, table_name,
+                                      insight_merge.staging_table_id(client, BQ_CONFIG['dataset_id']), staging=True)
+                insight_merge.apply(client, BQ_CONFIG['dataset_id'])
+            else:
+                load_data_to_bigquery(client, df, table_name)
+            stage.add(rows=rows_processed)
+        log_audit_entry(client, run_timestamp_dt, ad_account_id, table_name, rows_processed, "SUCCESS")
+        if on_loaded:
+            on_loaded()
+
     except Exception as e:
-        sys.stderr.write(f"🔴 FATAL ERROR: Failed to log audit entry for {table_name}. Error: {e}\n")
+        print(f"❌ An error occurred while loading {table_name} for {ad_account_id} to BigQuery: {e}")
+        log_audit_entry(client, run_timestamp_dt, ad_account_id, table_name, rows_processed, "FAILURE", str(e))
+
+def stream_table_to_bigquery(client, table_name, page_source, ad_account_id, run_timestamp_dt, on_loaded=None,
+                             structure_sync=None, progress=None, insight_merge=None, row_filter=None,
+                             audit_name=None):
+    """
+    Streams one dataset's pages into its BigQuery table in bounded chunks and audits it.
+
+    Each page becomes an Arrow record batch straight away, so at most one flush worth
+    of rows (STREAMING_CONFIG) is held in memory for the table. on_loaded is called
+    once every page has been loaded. Structure tables (structure_sync given) are
+    streamed into a staging table and MERGEd once complete.
+
+    Insight tables in merge mode (insight_merge given) stage every chunk and MERGE it
+    into the table as soon as it is flushed.
 
-# --- Last Run Time (Kept the same) ---
-def last_run_time_for_insight(client, ad_account_id):
-    """Finds the max run_timestamp for a specific ad_account_id."""
-    table_name = 'etl_audit_log'
+    Insight tables (progress given, a checkpoints.WindowProgress) only fetch the date
+    windows not checkpointed yet, and checkpoint each window once its rows are flushed
+    (and merged).
+    A failure is retried up to RUN_CONFIG['unit_retries'] times, resuming from the
+    last checkpointed window.
+
+    row_filter maps each fetched page to the rows to load (e.g. only those that
+    changed, see lookback.py). The table is audited as audit_name if given.
+    """
+    audit_name = audit_name or table_name
     full_table_id = f"{client.project}.{BQ_CONFIG['dataset_id']}.{table_name}"
+    if structure_sync:
+        full_table_id = structure_sync.staging_table_id(client, BQ_CONFIG['dataset_id'])
+    if insight_merge:
+        full_table_id = insight_merge.staging_table_id(client, BQ_CONFIG['dataset_id'])
+    extra_columns = {'ad_account_id': ad_account_id, 'last_run_timestamp': run_timestamp_dt}
+    timestamp_columns = ('date_start',) if table_name in INSIGHT_TABLES else ()
+    table_schema = TABLE_SCHEMAS[table_name] if RUN_CONFIG['typed_schemas'] else None
+
+    def on_flush():
+        # A chunk only counts as loaded (and checkpointed) once it is merged
+        if insight_merge:
+            insight_merge.apply(client, BQ_CONFIG['dataset_id'])
+        if progress:
+            progress.commit()
+
+    # Fetch, conversion and load time of the table (see run_metrics.py); chunk loads are nested stages
+    with METRICS.stage('stream', ad_account_id, table_name) as stage:
+        rows_processed = 0
+        for attempt in range(RUN_CONFIG['unit_retries'] + 1):
+            # A fresh loader per attempt: a structure retry restarts its staging table (and its count)
+            if structure_sync:
+                rows_processed = 0
+            loader = ArrowChunkLoader(
+                client, full_table_id,
+                lambda first_chunk: build_load_job_config(table_name, append=not first_chunk and not insight_merge,
+                                                          staging=bool(insight_merge)),
+                on_flush=on_flush,
+                # Appended rows cannot be taken back: only load date windows that were fetched completely
+                boundary_flushes=bool(progress) and not insight_merge,
+            )
+            try:
+                if progress:
+                    def window_done(window, loader=loader):
+                        progress.window_done(window)
+                        loader.mark_boundary()
+                    pages = page_source(windows=progress.remaining_windows(), on_window_done=window_done)
+                else:
+                    pages = page_source()
+                for page in pages:
+                    if row_filter:
+                        page = row_filter(page)
+                    with METRICS.stage('transform', log=False):
+                        batch = page_to_record_batch(page, extra_columns, timestamp_columns, table_schema,
+                                                     STRUCTURE_JSON_COLUMNS.get(table_name, ()))
+                    loader.add_batch(batch)
+                rows_processed += loader.close()
+                if progress:
+                    progress.commit()
+                if structure_sync:
+                    structure_sync.apply(client, BQ_CONFIG['dataset_id'], rows_processed)
+                break
+            except Exception as e:
+                # Windows fetched completely are still loaded (and checkpointed); the rest is refetched
+                try:
+                    loader.discard()
+                except Exception as load_error:
+                    print(f"⚠️ Could not load the completed windows of {table_name} for {ad_account_id}: {load_error}")
+                if not structure_sync:
+                    rows_processed += loader.rows_loaded
+                if progress:
+                    progress.discard_pending()
+                if attempt < RUN_CONFIG['unit_retries']:
+                    stage.add(retries=1)
+                    print(f"🔁 Error streaming {table_name} for {ad_account_id} ({e}). Retrying from the last checkpoint "
+                          f"in {RUN_CONFIG['retry_backoff_seconds']}s (attempt {attempt + 1})...")
+                    time.sleep(RUN_CONFIG['retry_backoff_seconds'])
+                    continue
+                stage.add(rows=rows_processed, errors=1)
+                print(f"❌ An error occurred while streaming {table_name} for {ad_account_id} to BigQuery: {e}")
+                if structure_sync:
+                    # Nothing was merged; don't leave the account's partial staging table behind
+                    try:
+                        client.delete_table(full_table_id, not_found_ok=True)
+                    except Exception as drop_error:
+                        print(f"⚠️ Could not drop the staging table {full_table_id}: {drop_error}")
+                log_audit_entry(client, run_timestamp_dt, ad_account_id, audit_name, rows_processed, "FAILURE", str(e))
+                return rows_processed
+        stage.add(rows=rows_processed)
+
+    if rows_processed == 0:
+        print(f"Skipping {table_name} for {ad_account_id}: no rows fetched.")
+        log_audit_entry(client, run_timestamp_dt, ad_account_id, audit_name, 0, "SKIPPED")
+    else:
+        print(f"🎉 Successfully streamed {rows_processed} rows to BigQuery table: {full_table_id} in {loader.chunks_loaded} chunks")
+        log_audit_entry(client, run_timestamp_dt, ad_account_id, audit_name, rows_processed, "SUCCESS")
+    if on_loaded:
+        on_loaded()
+    return rows_processed
+
+def resync_lookback(run, table_name, page_source, ad_account_id):
+    """Re-fetches the lookback range of an insight table and MERGEs only the rows that changed (lookback.py)."""
+    index = run.hashes.index(ad_account_id, table_name, run.lookback_since)
+    rows = stream_table_to_bigquery(
+        run.client, table_name, page_source, ad_account_id, run.run_timestamp_dt, on_loaded=index.commit,
+        insight_merge=insight_merge_for(table_name, ad_account_id), row_filter=index.changed,
+        audit_name=f"{table_name}_lookback",
+    )
+    print(f"🔎 Lookback {table_name} for {ad_account_id}: {index.rows_changed} of {index.rows_seen} rows changed.")
+    return rows
+
+def stream_account_to_bigquery(run, ad_account_id, insight_ranges, structure_syncs):
+    """Streams every dataset of one account into BigQuery, datasets running concurrently."""
+    page_sources = build_page_sources(ad_account_id, insight_ranges, structure_syncs,
+                                      run.structure_fetcher_for(ad_account_id), run.archive)
+    insight_progress = run.insight_progress(ad_account_id, insight_ranges)
+    lookback_sources = (
+        build_lookback_sources(ad_account_id, run.lookback_ranges(ad_account_id), run.archive) if run.hashes else {}
+    )
+
+    def stream(table_name, source):
+        on_loaded = run.on_loaded_callback(ad_account_id, table_name, insight_ranges, structure_syncs)
+        row_filter = None
+        if run.hashes and table_name in INSIGHT_TABLES:
+            # New days are hashed as they load, so their first lookback only reloads what changed
+            index = run.hashes.index(ad_account_id, table_name, run.lookback_since)
+            row_filter, watermark_callback = index.record, on_loaded
+
+            def on_loaded():
+                if watermark_callback:
+                    watermark_callback()
+                index.commit()
+
+        rows = stream_table_to_bigquery(
+            run.client, table_name, source, ad_account_id, run.run_timestamp_dt, on_loaded,
+            structure_syncs.get(table_name), insight_progress.get(table_name),
+            insight_merge_for(table_name, ad_account_id), row_filter,
+        )
+        if table_name in lookback_sources:
+            rows += resync_lookback(run, table_name, lookback_sources[table_name], ad_account_id)
+        return rows
+
+    rows = run_fetch_tasks({
+        table_name: (lambda table_name=table_name, source=source: stream(table_name, source))
+        for table_name, source in page_sources.items()
+    })
+    print(f"Streamed {ad_account_id}: " + ", ".join(f"{n} {t}" for t, n in rows.items()))
+
+def process_account(run, ad_account_id):
+    """
+    Fetches one account from Meta and hands its tables to the shared load pool.
+
+    Returns the load futures without waiting on them, so the account's BigQuery loads
+    overlap with the Meta fetches of the next accounts. A fetch failure is logged and
+    isolated to this account. In streaming mode the loads happen while fetching and
+    nothing is returned. In a sharded run the account is skipped unless its lease is taken.
+    """
+    if run.leases is not None and not run.leases.acquire(ad_account_id):
+        print(f"⏭️ {ad_account_id} is being (or was) processed by another task. Skipping.")
+        return []
+    run.register_structure_fetches(ad_account_id)
+    print(f"\n--- Starting ETL for Ad Account: {ad_account_id} ---")
+    client, run_timestamp_dt = run.client, run.run_timestamp_dt
     
+    insight_ranges = run.insight_ranges(ad_account_id)
+    structure_syncs = run.structure_syncs(ad_account_id)
+
+    if RUN_CONFIG['streaming']:
+        # Pages are loaded as they arrive; failures are isolated and audited per table
+        stream_account_to_bigquery(run, ad_account_id, insight_ranges, structure_syncs)
+        with METRICS.stage('watermarks_commit', ad_account_id):
+            run.watermarks.commit(ad_account_id)
+        return []
+
+    # 1. Fetch Data
     try:
-        query = f"""
-            SELECT MAX(run_timestamp) AS last_run_timestamp
-            FROM `{full_table_id}`
-            WHERE ad_account_id = @ad_account_id
-              AND table_name IN ('ad_insights', 'adset_insights', 'campaign_insights')
-              AND status = 'SUCCESS'
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("ad_account_id", "STRING", ad_account_id)
-            ]
-        )
-        query_job = client.query(query, job_config=job_config)
-        results = query_job.result()
-        for row in results:
-            return row.last_run_timestamp
+        meta_data = fetch_meta_data(ad_account_id, insight_ranges, structure_syncs,
+                                    run.structure_fetcher_for(ad_account_id), run.archive)
+        with METRICS.stage('json_roundtrip', ad_account_id):
+            meta_data_py = json.loads(json.dumps(meta_data))
+    
     except Exception as e:
-        print(f"Warning: Could not query audit log for last run time for {ad_account_id}. Assuming first run. Error: {e}")
-        return None
+        error_message = str(e)
+        log_audit_entry(client, run_timestamp_dt, ad_account_id, "FETCH_ALL", 0, "FATAL_FAILURE", error_message)
+        print(f"🔴 Fatal Error during data fetch for {ad_account_id}: {e}")
+        # Throttling is already backed off inside each call by the governor,
+        # using the wait time Meta reports, so other accounts carry on.
+        return []
 
-# --- Main Execution (Stricter Rate Limit Handling Maintained) ---
-def main():
-    bq_client = initialize_bigquery_client()
-    initialize_meta_api()
-    
-    # 1. Ensure BQ infrastructure is ready
-    create_bigquery_dataset(bq_client)
-    ensure_audit_log_table(bq_client)
+    # 2. Create and Prepare DataFrames
+    with METRICS.stage('transform', ad_account_id) as stage:
+        dataframes_to_load = build_dataframes(meta_data_py, ad_account_id, run_timestamp_dt)
+        stage.add(rows=sum(len(df) for df in dataframes_to_load.values()))
+
+    # 3. Queue the BigQuery loads (with audit logging) on the shared load pool
+    return [
+        run.load_pool.submit(load_table_with_audit, client, df, table_name, ad_account_id, run_timestamp_dt,
+                             run.on_loaded_callback(ad_account_id, table_name, insight_ranges, structure_syncs),
+                             structure_syncs.get(table_name), insight_merge_for(table_name, ad_account_id))
+        for table_name, df in dataframes_to_load.items()
+    ]
 
+# --- Main Execution (Concurrent accounts; rate limiting handled per call by the governor) ---
+def report_startup(run_started):
+    """Reports the imports and the time until the accounts start, and keeps them in etl_run_metrics."""
+    global _IMPORT_SECONDS
+    startup_seconds = _IMPORT_SECONDS + time.perf_counter() - run_started
+    METRICS.record_stage('imports', _IMPORT_SECONDS)
+    METRICS.record_stage('startup', startup_seconds)
+    print(f"⚡ Startup took {startup_seconds:.2f}s (imports {_IMPORT_SECONDS:.2f}s, "
+          f"{BOOTSTRAP.checks_skipped} table checks skipped).")
+    # Later runs in the same process import nothing
+    _IMPORT_SECONDS = 0.0
+
+def main():
+    run_started = time.perf_counter()
     run_timestamp_dt = datetime.now()
+    # Stage timings and counters of this run (etl_run_metrics), keyed by the audit run timestamp
+    METRICS.start_run(run_timestamp_dt.isoformat())
+
+    with METRICS.stage('bootstrap'):
+        bq_client = initialize_bigquery_client()
+        initialize_meta_api()
+
+        # 1. Ensure BQ infrastructure is ready (tables in the bootstrap manifest are not checked again)
+        BOOTSTRAP.start(create_bigquery_dataset(bq_client))
+        ensure_audit_log_table(bq_client)
+        audit_writer = get_audit_writer(bq_client)
+
+    # Every account's insight and structure watermarks in a single query, cached for the run
+    with METRICS.stage('watermarks_load'):
+        watermarks = WatermarkStore(bq_client, BQ_CONFIG['dataset_id'], AUDIT_LOG_TABLE, INSIGHT_TABLES,
+                                    META_CONFIG['ad_account_ids']).load()
+    # Insight date windows already loaded by an interrupted earlier attempt
+    with METRICS.stage('checkpoints_load'):
+        checkpoints = CheckpointStore(bq_client, BQ_CONFIG['dataset_id']).load()
+    # In a Cloud Run Job with several tasks, this task's share of the accounts (see sharding.py)
+    own_account_ids, other_account_ids, leases = META_CONFIG['ad_account_ids'], [], None
+    shard = Shard.from_env()
+    if shard.sharded:
+        with METRICS.stage('shard_plan'):
+            own_account_ids, other_account_ids = plan_accounts(bq_client, BQ_CONFIG['dataset_id'], shard,
+                                                               META_CONFIG['ad_account_ids'])
+            leases = AccountLeases(bq_client, BQ_CONFIG['dataset_id'], shard).prepare()
     
-    # 2. Outer loop for all Ad Accounts
-    for ad_account_id in META_CONFIG['ad_account_ids']:
-        print(f"\n--- Starting ETL for Ad Account: {ad_account_id} ---")
-        
-        last_run_time_insight = last_run_time_for_insight(bq_client, ad_account_id)
+    # 2. Process Ad Accounts concurrently. Fetches run on the account pool, loads on the
+    #    load pool, so run time tracks the slowest account rather than the sum of them.
+    account_pool = ThreadPoolExecutor(max_workers=RUN_CONFIG['max_concurrent_accounts'])
+    load_pool = ThreadPoolExecutor(max_workers=RUN_CONFIG['max_concurrent_loads'])
+    # With RAW_ARCHIVE_DIR set, raw pages are also kept on disk, so tables can be rebuilt without Meta
+    # (see replay_from_archive)
+    archive = RawArchive(run_timestamp_dt.isoformat()) if RAW_ARCHIVE_CONFIG['enabled'] else None
+    # Row hashes of the attribution lookback window, for re-syncing only changed rows
+    hashes = None
+    if LOOKBACK_CONFIG['enabled']:
+        if RUN_CONFIG['insight_load_mode'] == 'merge' and RUN_CONFIG['streaming']:
+            with METRICS.stage('hashes_prepare'):
+                hashes = HashStore(bq_client, BQ_CONFIG['dataset_id']).prepare()
+        else:
+            print("⚠️ Attribution lookback needs insight_load_mode 'merge' and streaming; skipping it this run.")
+    run = EtlRun(bq_client, run_timestamp_dt, load_pool, watermarks, checkpoints, archive, hashes, leases)
+    if RUN_CONFIG['batch_structure_fetch']:
+        # First pages of the accounts' campaigns/adsets/ads go out together in a few batch calls
+        run.start_structure_fetcher(own_account_ids)
+    report_startup(run_started)
+    with account_pool, load_pool:
+        load_futures = []
+        # Other tasks' accounts are only tried once this task is through its own (and leased if still unclaimed)
+        for ad_account_ids in (own_account_ids, other_account_ids):
+            account_futures = {
+                account_pool.submit(process_account, run, ad_account_id): ad_account_id
+                for ad_account_id in ad_account_ids
+            }
+            for future, ad_account_id in account_futures.items():
+                try:
+                    load_futures.extend(future.result())
+                except Exception as e:
+                    # Should not happen (process_account isolates failures), but never lose the other accounts
+                    print(f"🔴 Unexpected error processing {ad_account_id}: {e}")
+        wait(load_futures)
 
-        # 3. Fetch Data
-        try:
-            # THIS CALL NOW USES THE NEW PAGED FETCH LOGIC
-            meta_data = fetch_meta_data(ad_account_id, last_run_time_insight,run_timestamp_dt)
-            meta_data_py = json.loads(json.dumps(meta_data))
+    if run.structure_fetcher is not None:
+        run.structure_fetcher.close()
+        print(f"📦 Structure fetch: {run.structure_fetcher.requests_sent} requests in "
+              f"{run.structure_fetcher.batches_sent} batch calls.")
+    if archive is not None:
+        print(f"🗄️ Raw archive: {archive.pages_written} new objects ({archive.bytes_written / 1e6:.1f} MB) "
+              f"under {archive.root}")
+
+    # 3. Save the remaining watermarks and write the buffered audit entries in one batch
+    with METRICS.stage('watermarks_commit'):
+        watermarks.commit()
+    if leases is not None:
+        # Only now that their watermarks are saved may another execution take the accounts
+        leases.close()
+        print(f"🧩 Processed {len(leases.acquired)} accounts as {shard.describe()}.")
+    audit_writer.close()
+
+    from rate_limiter import ThrottledFacebookAdsApi
+    governor = ThrottledFacebookAdsApi.governor
+    print(f"\n⏱️ Rate limiter: {governor.total_sleep_seconds:.1f}s spent pacing, {governor.throttle_events} throttle events.")
+    METRICS.write(bq_client, BQ_CONFIG['dataset_id'])
+    BOOTSTRAP.save(bq_client)
         
-        except Exception as e:
-            error_message = str(e)
-            log_audit_entry(bq_client, run_timestamp_dt, ad_account_id, "FETCH_ALL", 0, "FATAL_FAILURE", error_message)
-            print(f"🔴 Fatal Error during data fetch for {ad_account_id}: {e}")
-            
-            # 🌟 REVISED FAILURE BACKOFF 🌟
-            if "User request limit reached" in error_message:
-                backoff_time = 180 
-                print(f"🛑 RATE LIMIT HIT. Resting for a long backoff of {backoff_time} seconds before the next account...")
-                time.sleep(backoff_time)
-            else:
-                backoff_time = 30
-                print(f"😴 Resting for {backoff_time} seconds after fatal error...")
-                time.sleep(backoff_time)
-            
-            continue # Skip to the next account
-            
+# --- Replay (rebuild tables from the raw archive, without calling Meta) ---
+def delete_insight_dates(client, table_name, ad_account_id, dates):
+    """Deletes an account's insight rows for the given dates, so they can be reloaded."""
+    table_id = f"{client.project}.{BQ_CONFIG['dataset_id']}.{table_name}"
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("ad_account_id", "STRING", ad_account_id),
+        bigquery.ArrayQueryParameter("dates", "DATE", dates),
+    ])
+    try:
+        # date_start is a TIMESTAMP in tables loaded without typed schemas
+        date_type = next((f.field_type for f in client.get_table(table_id).schema if f.name == 'date_start'), 'DATE')
+        client.query(
+            f"DELETE FROM `{table_id}` WHERE ad_account_id = @ad_account_id "
+            f"AND {date_expression('date_start', date_type)} IN UNNEST(@dates)",
+            job_config=job_config,
+        ).result()
+    except Exception as e:
+        # Nothing to delete before the table's first load
+        if 'Not found' not in str(e) and '404' not in str(e):
+            raise e
 
-        # 4. Create and Prepare DataFrames
-        campaigns = pd.DataFrame(meta_data_py.get('campaigns', []))
-        adsets = pd.DataFrame(meta_data_py.get('adsets', []))
-        ads = pd.DataFrame(meta_data_py.get('ads', []))
-        ad_insights = pd.DataFrame(meta_data_py.get('ad_insights', []))
-        adset_insights = pd.DataFrame(meta_data_py.get('adset_insights', []))
-        campaign_insights = pd.DataFrame(meta_data_py.get('campaign_insights', []))
-
-        # Add the ad_account_id and audit timestamp column to ALL DataFrames
-        all_dfs = [campaigns, adsets, ads, ad_insights, adset_insights, campaign_insights]
-        for df in all_dfs:
-            if not df.empty:
-                df['ad_account_id'] = ad_account_id
-                df['last_run_timestamp'] = run_timestamp_dt
-                
-        # Convert 'date_start' for insights to datetime objects
-        insight_dfs = [ad_insights, adset_insights, campaign_insights]
-        for df in insight_dfs:
-            if not df.empty and 'date_start' in df.columns:
-                df['date_start'] = pd.to_datetime(df['date_start'])
-                
-        # 5. Define tables to load
-        dataframes_to_load = {
-            'campaigns': campaigns,          
-            'adsets': adsets,                
-            'ads': ads,                      
-            'ad_insights': ad_insights,      
-            'adset_insights': adset_insights,  
-            'campaign_insights': campaign_insights 
-        }
+def replay_from_archive(table_names=None, ad_account_ids=None, since=None, until=None):
+    """
+    Rebuilds tables from the raw archive (raw_archive.py) with the current
+    transformations and schemas, without calling Meta.
 
-        # 6. Load DataFrames to BigQuery with Logging
-        for table_name, df in dataframes_to_load.items():
-            rows_processed = len(df)
-            
-            if rows_processed == 0:
-                print(f"Skipping {table_name} for {ad_account_id}: DataFrame is empty.")
-                log_audit_entry(bq_client, run_timestamp_dt, ad_account_id, table_name, 0, "SKIPPED")
+    Insight tables: the account's rows for every archived date in [since, until]
+    are deleted and reloaded from the latest fetch of that date. Structure tables:
+    every archived object is MERGEd in again (nothing is deleted). Watermarks and
+    checkpoints are left alone.
+    """
+    if not RAW_ARCHIVE_CONFIG['root']:
+        print("🔴 No raw archive to replay from: set RAW_ARCHIVE_DIR to the archive's directory.")
+        sys.exit(1)
+    run_timestamp_dt = datetime.now()
+    METRICS.start_run(run_timestamp_dt.isoformat())
+    with METRICS.stage('bootstrap'):
+        bq_client = initialize_bigquery_client()
+        BOOTSTRAP.start(create_bigquery_dataset(bq_client))
+        ensure_audit_log_table(bq_client)
+        audit_writer = get_audit_writer(bq_client)
+    archive = RawArchive()
+    print(f"⏪ Replaying from {archive.root}...")
+
+    for ad_account_id in ad_account_ids or META_CONFIG['ad_account_ids']:
+        for table_name in table_names or list(TABLE_SCHEMAS):
+            if table_name in STRUCTURE_TABLES:
+                stream_table_to_bigquery(
+                    bq_client, table_name, lambda a=ad_account_id, t=table_name: archive.iter_pages(a, t),
+                    ad_account_id, run_timestamp_dt, structure_sync=StructureSync.for_replay(table_name, ad_account_id),
+                )
                 continue
-                
-            try:
-                load_data_to_bigquery(bq_client, df, table_name) 
-                log_audit_entry(bq_client, run_timestamp_dt, ad_account_id, table_name, rows_processed, "SUCCESS")
+            dates = archive.dates(ad_account_id, table_name, since, until)
+            if not dates:
+                print(f"Nothing archived for {table_name} of {ad_account_id}.")
+                continue
+            with METRICS.stage('replay_delete', ad_account_id, table_name):
+                delete_insight_dates(bq_client, table_name, ad_account_id, dates)
+            stream_table_to_bigquery(
+                bq_client, table_name,
+                lambda a=ad_account_id, t=table_name: archive.iter_pages(a, t, since, until, latest_run_only=True),
+                ad_account_id, run_timestamp_dt, insight_merge=insight_merge_for(table_name, ad_account_id),
+            )
 
-            except Exception as e:
-                print(f"❌ An error occurred while loading {table_name} for {ad_account_id} to BigQuery: {e}")
-                log_audit_entry(bq_client, run_timestamp_dt, ad_account_id, table_name, rows_processed, "FAILURE", str(e))
+    audit_writer.close()
+    METRICS.write(bq_client, BQ_CONFIG['dataset_id'])
+    BOOTSTRAP.save(bq_client)
+
+def migrate_insight_tables():
+    """Rebuilds the insight tables for merge mode (see insight_merge.migrate_insight_table)."""
+    bq_client = initialize_bigquery_client()
+    for table_name in INSIGHT_TABLES:
+        migrate_insight_table(bq_client, BQ_CONFIG['dataset_id'], table_name)
+
+def migrate_structure_tables():
+    """Converts the nested columns of the structure tables to JSON strings (see structure_sync.migrate_structure_table)."""
+    bq_client = initialize_bigquery_client()
+    for table_name in STRUCTURE_TABLES:
+        migrate_structure_table(bq_client, BQ_CONFIG['dataset_id'], table_name, STRUCTURE_JSON_COLUMNS[table_name])
+
+def run_local_shards(task_count):
+    """
+    Runs one sharded execution as task_count local processes, with the variables a
+    Cloud Run Job sets for each of its tasks (see sharding.py).
+    """
+    execution_id = f"local-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    print(f"🧩 Starting {task_count} tasks of execution {execution_id}...")
+    processes = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__)], env={
+            **os.environ,
+            'CLOUD_RUN_TASK_INDEX': str(task_index),
+            'CLOUD_RUN_TASK_COUNT': str(task_count),
+            'CLOUD_RUN_EXECUTION': execution_id,
+        })
+        for task_index in range(task_count)
+    ]
+    failed = [task_index for task_index, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        print(f"🔴 Tasks {failed} of {execution_id} failed.")
+        sys.exit(1)
+    print(f"✓ All {task_count} tasks of {execution_id} finished.")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+    replay = subparsers.add_parser('replay', help='Rebuild tables from the raw archive without calling Meta')
+    replay.add_argument('--tables', nargs='+', choices=list(TABLE_SCHEMAS), help='Tables to rebuild (default: all)')
+    replay.add_argument('--accounts', nargs='+', help='Ad account ids (default: META_CONFIG)')
+    replay.add_argument('--since', help='First insight date to rebuild (YYYY-MM-DD)')
+    replay.add_argument('--until', help='Last insight date to rebuild (YYYY-MM-DD)')
+    subparsers.add_parser('migrate-insights', help="Partition the insight tables by date_start for insight_load_mode 'merge'")
+    subparsers.add_parser('migrate-structure', help='Convert nested structure columns loaded as RECORDs to JSON strings')
+    local_shards = subparsers.add_parser('local-shards', help='Run a sharded execution as several local processes')
+    local_shards.add_argument('--tasks', type=int, default=2, help='Number of tasks (processes)')
+    return parser.parse_args(argv)
 
-        # 7. Respect Meta API Rate Limits
-        success_rest_time = 30 # Increased standard rest time between successful accounts
-        print(f"😴 Resting for {success_rest_time} seconds to respect Meta API limits...")
-        time.sleep(success_rest_time)
-        
 if __name__ == "__main__":
-    main()
+    args = parse_args(sys.argv[1:])
+    if args.command == 'replay':
+        replay_from_archive(args.tables, args.accounts, args.since, args.until)
+    elif args.command == 'migrate-insights':
+        migrate_insight_tables()
+    elif args.command == 'migrate-structure':
+        migrate_structure_tables()
+    elif args.command == 'local-shards':
+        run_local_shards(args.tasks)
+    else:
+        main()
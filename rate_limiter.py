@@ -0,0 +1,335 @@
+"""
+Header-driven rate limiting for the Meta Marketing API.
+
+Every Graph API response carries throttle headers describing how close the
+app / ad account is to its limits:
+
+- X-Business-Use-Case-Usage: {"<business_id>": [{"type": "ads_management",
+  "call_count": 12, "total_cputime": 4, "total_time": 6,
+  "estimated_time_to_regain_access": 0}, ...]}
+- X-Ad-Account-Usage: {"acc_id_util_pct": 9.6, "reset_time_duration": 100}
+- X-FB-Ads-Insights-Throttle: {"app_id_util_pct": 0, "acc_id_util_pct": 12}
+
+The governor keeps a token bucket per (ad account, call type). Below the
+slowdown threshold calls are not paced at all. Above it the bucket's refill
+rate shrinks as the reported usage approaches 100%, and once
+Meta reports a block we wait for exactly the time it gives us
+(estimated_time_to_regain_access / reset_time_duration) instead of a fixed sleep.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from facebook_business.api import FacebookAdsApi
+from facebook_business.exceptions import FacebookRequestError
+
+from run_metrics import METRICS
+
+RATE_LIMIT_CONFIG = {
+    'slowdown_threshold_pct': 75,   # Usage below this is not paced at all
+    'bucket_capacity': 10,          # Calls that may go out in a burst once pacing starts
+    'refill_per_second': 5.0,       # Refill rate at the threshold, shrinking towards 100% usage
+    'min_refill_factor': 0.02,      # Refill rate floor as usage nears 100%
+    'default_backoff_seconds': 60,  # Used when Meta throttles without a wait time
+    'max_backoff_seconds': 900,
+    'max_throttle_retries': 5,
+}
+
+# Graph API error codes that mean "throttled", see
+# https://developers.facebook.com/docs/graph-api/overview/rate-limiting
+THROTTLE_ERROR_CODES = {4, 17, 32, 613} | set(range(80000, 80015))
+THROTTLE_ERROR_SUBCODES = {1487742, 2446079}
+
+CALL_TYPE_INSIGHTS = 'ads_insights'
+CALL_TYPE_MANAGEMENT = 'ads_management'
+
+_call_scope = threading.local()
+
+
+@contextmanager
+def account_scope(account_id, call_type=None):
+    """
+    Attributes calls made in this thread to an ad account (and optionally a call type).
+
+    Needed for calls whose path does not name the account, e.g. polling an
+    AdReportRun ('<report_run_id>') or reading its result pages.
+    """
+    previous = getattr(_call_scope, 'value', None)
+    _call_scope.value = (account_id, call_type)
+    try:
+        yield
+    finally:
+        _call_scope.value = previous
+
+
+def _normalize_headers(headers):
+    """Returns a lower-cased header dict from a requests mapping or a batch header list."""
+    if not headers:
+        return {}
+    if isinstance(headers, list):
+        return {h.get('name', '').lower(): h.get('value') for h in headers}
+    return {str(k).lower(): v for k, v in headers.items()}
+
+
+def _parse_json_header(value):
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_call(path):
+    """
+    Derives (ad_account_id, call_type) from a Graph API path.
+
+    The SDK passes either a tuple like ('act_123', 'insights') or a full URL.
+    """
+    if isinstance(path, str):
+        tokens = [t for t in path.split('?')[0].split('/') if t]
+    else:
+        tokens = [str(t) for t in path]
+
+    account_id = next((t for t in tokens if t.startswith('act_')), None)
+    call_type = CALL_TYPE_INSIGHTS if 'insights' in tokens else CALL_TYPE_MANAGEMENT
+
+    scope = getattr(_call_scope, 'value', None)
+    if account_id is None and scope is not None:
+        account_id, call_type = scope[0], scope[1] or call_type
+    return account_id, call_type
+
+
+def body_size(body):
+    """
+    Bytes of a response body. The SDK only keeps the decoded text, and parses error
+    bodies that are JSON into a dict (re-serialized compactly, as Meta sends it).
+    """
+    if not body:
+        return 0
+    if not isinstance(body, str):
+        body = json.dumps(body, separators=(',', ':'))
+    return len(body.encode('utf-8'))
+
+
+def is_throttle_error(error):
+    """True if a FacebookRequestError is one of Meta's rate-limit errors."""
+    if not isinstance(error, FacebookRequestError):
+        return False
+    return (error.api_error_code() in THROTTLE_ERROR_CODES
+            or error.api_error_subcode() in THROTTLE_ERROR_SUBCODES)
+
+
+class _Bucket(object):
+    """Token bucket for one (ad account, call type) pair."""
+
+    def __init__(self, capacity):
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.usage_pct = 0.0
+        self.blocked_until = 0.0
+
+
+class RateLimitGovernor(object):
+    """
+    Paces Meta API calls from the throttle headers of previous responses.
+
+    Thread-safe: buckets are guarded by a lock, sleeping happens outside it.
+    """
+
+    def __init__(self, config=None):
+        self.config = {**RATE_LIMIT_CONFIG, **(config or {})}
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.total_sleep_seconds = 0.0
+        self.throttle_events = 0
+
+    def _bucket(self, account_id, call_type):
+        key = (account_id, call_type)
+        if key not in self._buckets:
+            self._buckets[key] = _Bucket(self.config['bucket_capacity'])
+        return self._buckets[key]
+
+    def _refill_rate(self, usage_pct):
+        threshold = self.config['slowdown_threshold_pct']
+        # Linearly shrink the refill rate between the threshold and 100% usage
+        headroom = max(0.0, (100.0 - usage_pct) / (100.0 - threshold))
+        factor = max(self.config['min_refill_factor'], headroom)
+        return self.config['refill_per_second'] * factor
+
+    def _reserve(self, account_id, call_type):
+        """
+        Tries to take a token.
+
+        Returns (wait_seconds, reserved): while the bucket is blocked nothing is
+        reserved and the caller must retry after waiting; otherwise a token is taken
+        and the caller waits until it has refilled.
+        """
+        with self._lock:
+            bucket = self._bucket(account_id, call_type)
+            now = time.monotonic()
+
+            if bucket.blocked_until > now:
+                return bucket.blocked_until - now, False
+            if bucket.blocked_until:
+                # Meta has restored access; usage is re-learnt from the next response
+                bucket.blocked_until = 0.0
+                bucket.usage_pct = 0.0
+                bucket.tokens = max(bucket.tokens, 1.0)
+
+            capacity = self.config['bucket_capacity']
+            if bucket.usage_pct <= self.config['slowdown_threshold_pct']:
+                # Plenty of headroom: no pacing, keep the bucket full for when usage rises
+                bucket.tokens = float(capacity)
+                bucket.last_refill = now
+                return 0.0, True
+
+            rate = self._refill_rate(bucket.usage_pct)
+            bucket.tokens = min(capacity, bucket.tokens + (now - bucket.last_refill) * rate)
+            bucket.last_refill = now
+
+            bucket.tokens -= 1
+            if bucket.tokens >= 0:
+                return 0.0, True
+            return -bucket.tokens / rate, True
+
+    def acquire(self, account_id, call_type):
+        """Blocks until a call of this type may be sent for this account."""
+        while True:
+            wait, reserved = self._reserve(account_id, call_type)
+            if wait > 0:
+                self._sleep(wait)
+            if reserved:
+                return
+
+    def try_acquire(self, account_id, call_type):
+        """
+        Non-blocking acquire, for callers that schedule many accounts at once.
+
+        Returns 0 if a call may be sent now (a token is taken), otherwise the seconds
+        to wait before asking again (nothing is taken).
+        """
+        wait, reserved = self._reserve(account_id, call_type)
+        if reserved and wait > 0:
+            with self._lock:
+                self._bucket(account_id, call_type).tokens += 1
+        return wait
+
+    def _sleep(self, seconds):
+        with self._lock:
+            self.total_sleep_seconds += seconds
+        time.sleep(seconds)
+
+    def _block(self, bucket, seconds):
+        seconds = min(seconds, self.config['max_backoff_seconds'])
+        bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + seconds)
+        bucket.tokens = min(bucket.tokens, 0.0)
+        return seconds
+
+    def observe(self, account_id, call_type, headers):
+        """
+        Updates the budget from a response's throttle headers.
+
+        Returns the number of seconds Meta asked us to wait (0 if none).
+        """
+        headers = _normalize_headers(headers)
+        usage = []
+        block_seconds = 0.0
+
+        buc = _parse_json_header(headers.get('x-business-use-case-usage'))
+        if isinstance(buc, dict):
+            for entries in buc.values():
+                for entry in entries or []:
+                    if entry.get('type') not in (None, call_type):
+                        continue
+                    usage.extend(float(entry.get(k) or 0)
+                                 for k in ('call_count', 'total_cputime', 'total_time'))
+                    regain_minutes = float(entry.get('estimated_time_to_regain_access') or 0)
+                    block_seconds = max(block_seconds, regain_minutes * 60)
+
+        account_usage = _parse_json_header(headers.get('x-ad-account-usage'))
+        if isinstance(account_usage, dict):
+            pct = float(account_usage.get('acc_id_util_pct') or 0)
+            usage.append(pct)
+            if pct >= 100:
+                block_seconds = max(block_seconds, float(account_usage.get('reset_time_duration') or 0))
+
+        if call_type == CALL_TYPE_INSIGHTS:
+            insights_usage = _parse_json_header(headers.get('x-fb-ads-insights-throttle'))
+            if isinstance(insights_usage, dict):
+                usage.extend(float(insights_usage.get(k) or 0)
+                             for k in ('app_id_util_pct', 'acc_id_util_pct'))
+
+        with self._lock:
+            bucket = self._bucket(account_id, call_type)
+            if usage:
+                bucket.usage_pct = max(usage)
+            if block_seconds > 0:
+                block_seconds = self._block(bucket, block_seconds)
+        return block_seconds
+
+    def on_throttled(self, account_id, call_type, error, attempt):
+        """
+        Records a rate-limit error and returns how long to back off before retrying.
+
+        Uses the wait time Meta reports in the error's headers; only falls back to an
+        exponential default when none is given.
+        """
+        reported = self.observe(account_id, call_type, error.http_headers())
+        with self._lock:
+            self.throttle_events += 1
+            bucket = self._bucket(account_id, call_type)
+            if reported > 0:
+                return reported
+            fallback = self.config['default_backoff_seconds'] * (2 ** attempt)
+            return self._block(bucket, fallback)
+
+
+class ThrottledFacebookAdsApi(FacebookAdsApi):
+    """
+    FacebookAdsApi that runs every call through a RateLimitGovernor.
+
+    Install with ThrottledFacebookAdsApi.init(...); every SDK object (AdAccount,
+    Cursor paging, insights) then uses it as the default api.
+    """
+
+    governor = RateLimitGovernor()
+
+    @classmethod
+    def set_default_api(cls, api_instance):
+        # SDK objects look the default up on FacebookAdsApi itself, not on subclasses
+        FacebookAdsApi.set_default_api(api_instance)
+
+    def call(self, method, path, params=None, headers=None, files=None,
+             url_override=None, api_version=None):
+        # Batch calls (empty path) have no account and are paced in their own bucket
+        account_id, call_type = classify_call(path)
+        attempt = 0
+        while True:
+            # Time waiting here (pacing, or the back-off of a throttled attempt) is reported per stage
+            wait_started = time.monotonic()
+            self.governor.acquire(account_id, call_type)
+            call_started = time.monotonic()
+            try:
+                response = super(ThrottledFacebookAdsApi, self).call(
+                    method, path, params=params, headers=headers, files=files,
+                    url_override=url_override, api_version=api_version,
+                )
+            except FacebookRequestError as e:
+                retry = is_throttle_error(e) and attempt < self.governor.config['max_throttle_retries']
+                METRICS.record_api_call(account_id, time.monotonic() - call_started, body_size(e.body()),
+                                        call_started - wait_started, retries=int(retry))
+                if not retry:
+                    raise
+                wait = self.governor.on_throttled(account_id, call_type, e, attempt)
+                print(f"  🛑 Meta rate limit hit for {account_id or 'app'} ({call_type}). "
+                      f"Backing off {wait:.0f}s as reported (attempt {attempt + 1})...")
+                attempt += 1
+                continue
+
+            self.governor.observe(account_id, call_type, response.headers())
+            METRICS.record_api_call(account_id, time.monotonic() - call_started, body_size(response.body()),
+                                    call_started - wait_started)
+            return response
@@ -0,0 +1,131 @@
+"""
+Local archive of the raw pages returned by Meta, for replaying loads offline.
+
+Every page fetched (structure and insights) is written as zstd-compressed NDJSON,
+content-addressed by the SHA-256 of its rows, under
+
+    <root>/account=<ad_account_id>/entity=<table_name>/date=<YYYY-MM-DD>/<sha256>.ndjson.zst
+
+Insight rows are partitioned by their date_start, structure rows by the date they
+were fetched. Identical pages are stored once. Each partition keeps an
+_index.ndjson listing which objects every run fetched, so a replay can take the
+latest fetch of each insight date (metrics of a date change while its
+attribution window is open).
+
+The archive is only written when RAW_ARCHIVE_DIR is set. On Cloud Run point it
+at a mounted volume (e.g. a Cloud Storage FUSE mount): /tmp there is in-memory,
+so archiving to it would count every fetched page against the memory limit, and
+it is lost with the instance anyway.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+import pyarrow as pa
+
+RAW_ARCHIVE_CONFIG = {
+    'enabled': bool(os.environ.get('RAW_ARCHIVE_DIR')),
+    'root': os.environ.get('RAW_ARCHIVE_DIR'),
+    'compression_level': 3,     # zstd level; higher is smaller and slower
+}
+
+INDEX_FILE = '_index.ndjson'
+
+
+class RawArchive(object):
+    """Writes raw pages to, and reads them back from, the local archive."""
+
+    def __init__(self, run_id=None, config=None):
+        self.config = {**RAW_ARCHIVE_CONFIG, **(config or {})}
+        self.root = self.config['root']
+        self.run_id = run_id or datetime.now().isoformat()
+        self._codec = pa.Codec('zstd', compression_level=self.config['compression_level'])
+        self.pages_written = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+        self._warned = False
+
+    def _partition_dir(self, ad_account_id, table_name, date):
+        return os.path.join(self.root, f"account={ad_account_id}", f"entity={table_name}", f"date={date}")
+
+    # --- Writing ---
+
+    def recording(self, ad_account_id, table_name, page_source):
+        """Wraps a page source (see build_page_sources) so its pages are archived as they pass."""
+        return lambda *args, **kwargs: self.record(ad_account_id, table_name, page_source(*args, **kwargs))
+
+    def record(self, ad_account_id, table_name, pages):
+        """Passes pages through, archiving each one. Archive errors are reported, never raised."""
+        fetch_date = datetime.now().strftime('%Y-%m-%d')
+        for page in pages:
+            try:
+                self.write_page(ad_account_id, table_name, page, fetch_date)
+            except Exception as e:
+                with self._lock:
+                    warn, self._warned = not self._warned, True
+                if warn:
+                    print(f"⚠️ Could not archive raw pages ({e}); the load carries on without the archive.")
+            yield page
+
+    def write_page(self, ad_account_id, table_name, page, fetch_date):
+        partitions = {}
+        for row in page:
+            partitions.setdefault(row.get('date_start') or fetch_date, []).append(row)
+
+        for date, rows in partitions.items():
+            data = ''.join(json.dumps(row, sort_keys=True, separators=(',', ':')) + '\n' for row in rows).encode()
+            digest = hashlib.sha256(data).hexdigest()
+            directory = self._partition_dir(ad_account_id, table_name, date)
+            path = os.path.join(directory, f"{digest}.ndjson.zst")
+            os.makedirs(directory, exist_ok=True)
+
+            if not os.path.exists(path):
+                # A standard zstd frame, readable with `zstd -dc` as well
+                compressed = self._codec.compress(data, asbytes=True)
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(compressed)
+                os.replace(tmp_path, path)
+                with self._lock:
+                    self.pages_written += 1
+                    self.bytes_written += len(compressed)
+
+            entry = json.dumps({'object': digest, 'run_id': self.run_id, 'rows': len(rows)})
+            with self._lock, open(os.path.join(directory, INDEX_FILE), 'a') as f:
+                f.write(entry + '\n')
+
+    # --- Reading ---
+
+    def dates(self, ad_account_id, table_name, since=None, until=None):
+        """Archived dates ('YYYY-MM-DD') of an account's table, optionally within [since, until]."""
+        directory = os.path.join(self.root, f"account={ad_account_id}", f"entity={table_name}")
+        if not os.path.isdir(directory):
+            return []
+        dates = sorted(name[len('date='):] for name in os.listdir(directory) if name.startswith('date='))
+        return [d for d in dates if (since is None or d >= since) and (until is None or d <= until)]
+
+    def iter_pages(self, ad_account_id, table_name, since=None, until=None, latest_run_only=False):
+        """
+        Yields the archived pages (lists of dicts) of an account's table, date by date.
+
+        latest_run_only=True reads, for each date, only what the most recent run that
+        fetched it returned (for insights); otherwise every archived object is read once.
+        """
+        for date in self.dates(ad_account_id, table_name, since, until):
+            directory = self._partition_dir(ad_account_id, table_name, date)
+            index_path = os.path.join(directory, INDEX_FILE)
+            if not os.path.exists(index_path):
+                continue
+            with open(index_path) as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+            if latest_run_only and entries:
+                latest = max(e['run_id'] for e in entries)
+                entries = [e for e in entries if e['run_id'] == latest]
+
+            for digest in dict.fromkeys(e['object'] for e in entries):
+                with pa.input_stream(os.path.join(directory, f"{digest}.ndjson.zst"), compression='zstd') as f:
+                    data = f.read()
+                yield [json.loads(line) for line in data.decode().splitlines() if line]
@@ -0,0 +1,245 @@
+"""
+Per-stage timings and counters for one ETL run.
+
+Every stage of the run (state reads and writes, fetching a table from Meta,
+converting pages, BigQuery load jobs, audit writes) is timed with
+METRICS.stage(...). Meta calls made through ThrottledFacebookAdsApi are added to
+the stage running in the same thread, with the bytes received and the time spent
+waiting on the rate limiter; calls made outside any stage (e.g. the batched
+structure fetcher's thread) are counted under the 'meta_api' stage of their
+account.
+
+Each completed stage is logged as one JSON line in the structured format Cloud
+Logging parses (severity, message, the metrics as jsonPayload fields), and the
+run's totals per (stage, ad account, table) are written to the etl_run_metrics
+table once, at the end of the run.
+"""
+
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from google.cloud import bigquery
+from google.cloud.bigquery import SchemaField, Table
+
+from bootstrap import BOOTSTRAP
+
+RUN_METRICS_CONFIG = {
+    'structured_logs': True,        # One JSON log line per completed stage (Cloud Logging jsonPayload)
+    'table': 'etl_run_metrics',
+}
+
+# Counters every stage carries; they are summed per (stage, ad account, table)
+COUNTERS = {
+    'api_calls': 'INT64',               # Meta HTTP requests
+    'api_seconds': 'FLOAT64',           # Time spent in those requests
+    'bytes_received': 'INT64',          # Response bodies received from Meta
+    'rows': 'INT64',
+    'throttle_wait_seconds': 'FLOAT64', # Rate limiter pacing and throttle back-off
+    'poll_wait_seconds': 'FLOAT64',     # Sleeping between async report polls
+    'retries': 'INT64',                 # Throttle retries and unit retries
+    'errors': 'INT64',
+}
+
+RUN_METRICS_SCHEMA = [
+    SchemaField("run_id", "STRING", mode="REQUIRED"),
+    SchemaField("run_started_at", "TIMESTAMP", mode="REQUIRED"),
+    SchemaField("stage", "STRING", mode="REQUIRED"),
+    SchemaField("ad_account_id", "STRING"),
+    SchemaField("table_name", "STRING"),
+    SchemaField("invocations", "INT64"),
+    SchemaField("duration_seconds", "FLOAT64"),
+    SchemaField("max_duration_seconds", "FLOAT64"),
+] + [SchemaField(name, field_type) for name, field_type in COUNTERS.items()] + [
+    SchemaField("peak_rss_mb", "FLOAT64"),
+]
+
+
+def current_rss_mb():
+    """Current resident set size of this process in MB (peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, KB elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class _Stage(object):
+    """Counters of one running stage."""
+
+    def __init__(self, name, ad_account_id, table_name):
+        self.name = name
+        self.ad_account_id = ad_account_id
+        self.table_name = table_name
+        self.values = dict.fromkeys(COUNTERS, 0)
+
+    def add(self, **values):
+        for name, value in values.items():
+            self.values[name] += value
+
+
+class RunMetrics(object):
+    """
+    Thread-safe collector of stage metrics for one run.
+
+    Stages nest per thread: Meta calls, waits and retries go to the innermost
+    running stage only, so summing them over all stages never counts them twice.
+    """
+
+    def __init__(self, config=None):
+        self.config = {**RUN_METRICS_CONFIG, **(config or {})}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.start_run()
+
+    def start_run(self, run_id=None):
+        with self._lock:
+            self.run_id = run_id or datetime.now().isoformat()
+            self.started_at = datetime.now(timezone.utc)
+            self._started = time.perf_counter()
+            self._totals = {}
+
+    def _current(self):
+        return getattr(self._local, 'stage', None)
+
+    @contextmanager
+    def stage(self, name, ad_account_id=None, table_name=None, log=True):
+        """
+        Times a stage and collects its counters (see record()).
+
+        Account and table default to those of the enclosing stage. With log=False
+        the stage is only added to the run totals, e.g. for per-page or per-chunk
+        stages that would flood the logs.
+        """
+        parent = self._current()
+        stage = _Stage(
+            name,
+            ad_account_id or (parent.ad_account_id if parent else None),
+            table_name or (parent.table_name if parent else None),
+        )
+        self._local.stage = stage
+        started = time.perf_counter()
+        try:
+            yield stage
+        except BaseException:
+            stage.values['errors'] += 1
+            raise
+        finally:
+            self._local.stage = parent
+            self._finish(stage, time.perf_counter() - started, log)
+
+    def record(self, **values):
+        """Adds to the counters of the stage running in this thread (no-op outside a stage)."""
+        stage = self._current()
+        if stage is not None:
+            stage.add(**values)
+
+    def record_stage(self, name, duration, ad_account_id=None, table_name=None):
+        """Adds a stage timed outside stage(), e.g. the imports that ran before the run started."""
+        self._finish(_Stage(name, ad_account_id, table_name), duration, True)
+
+    def record_api_call(self, ad_account_id, seconds, bytes_received, throttle_wait_seconds=0.0, retries=0):
+        """Counts one Meta request, in the current stage or else under 'meta_api' for the account."""
+        values = {'api_calls': 1, 'api_seconds': seconds, 'bytes_received': bytes_received,
+                  'throttle_wait_seconds': throttle_wait_seconds, 'retries': retries}
+        stage = self._current()
+        if stage is not None:
+            stage.add(**values)
+            return
+        orphan = _Stage('meta_api', ad_account_id, None)
+        orphan.add(**values)
+        self._aggregate(orphan, 0.0, count=False)
+
+    def _aggregate(self, stage, duration, count=True):
+        key = (stage.name, stage.ad_account_id, stage.table_name)
+        with self._lock:
+            totals = self._totals.setdefault(key, {
+                'invocations': 0, 'duration_seconds': 0.0, 'max_duration_seconds': 0.0,
+                'peak_rss_mb': 0.0, **dict.fromkeys(COUNTERS, 0),
+            })
+            totals['invocations'] += 1 if count else 0
+            totals['duration_seconds'] += duration
+            totals['max_duration_seconds'] = max(totals['max_duration_seconds'], duration)
+            for name, value in stage.values.items():
+                totals[name] += value
+        return totals
+
+    def _finish(self, stage, duration, log):
+        rss = current_rss_mb()
+        totals = self._aggregate(stage, duration)
+        with self._lock:
+            totals['peak_rss_mb'] = max(totals['peak_rss_mb'], rss)
+        if log and self.config['structured_logs']:
+            self.log_stage(stage, duration, rss)
+
+    def log_stage(self, stage, duration, rss):
+        """Writes one structured (Cloud Logging) log line for a completed stage."""
+        where = ' '.join(filter(None, [stage.ad_account_id, stage.table_name]))
+        entry = {
+            'severity': 'ERROR' if stage.values['errors'] else 'INFO',
+            'message': f"stage {stage.name} {where} took {duration:.2f}s".replace('  ', ' '),
+            'run_id': self.run_id,
+            'stage': stage.name,
+            'ad_account_id': stage.ad_account_id,
+            'table_name': stage.table_name,
+            'duration_seconds': round(duration, 3),
+            **{name: round(value, 3) if isinstance(value, float) else value for name, value in stage.values.items()},
+            'rss_mb': round(rss, 1),
+            'logging.googleapis.com/labels': {'run_id': self.run_id},
+        }
+        sys.stdout.write(json.dumps(entry) + '\n')
+
+    def rows(self):
+        """The run totals as etl_run_metrics rows, plus one 'run' row for the whole run."""
+        with self._lock:
+            totals = {key: dict(values) for key, values in self._totals.items()}
+        run_row = {
+            'invocations': 1,
+            'duration_seconds': time.perf_counter() - self._started,
+            'peak_rss_mb': peak_rss_mb(),
+            **{name: sum(t[name] for t in totals.values()) for name in COUNTERS},
+        }
+        # Rows are counted by nested stages too (a stream and its chunk loads), so they don't add up
+        run_row['rows'] = None
+        run_row['max_duration_seconds'] = run_row['duration_seconds']
+        common = {'run_id': self.run_id, 'run_started_at': self.started_at.isoformat()}
+        return [
+            {**common, 'stage': stage, 'ad_account_id': ad_account_id, 'table_name': table_name, **values}
+            for (stage, ad_account_id, table_name), values in sorted(totals.items(), key=lambda kv: str(kv[0]))
+        ] + [{**common, 'stage': 'run', 'ad_account_id': None, 'table_name': None, **run_row}]
+
+    def write(self, client, dataset_id):
+        """Writes the run's metrics to the etl_run_metrics table with one load job."""
+        table_id = f"{client.project}.{dataset_id}.{self.config['table']}"
+        rows = self.rows()
+        try:
+            table = Table(table_id, schema=RUN_METRICS_SCHEMA)
+            table.time_partitioning = bigquery.TimePartitioning(
+                field="run_started_at", type_=bigquery.TimePartitioningType.DAY
+            )
+            BOOTSTRAP.ensure_table(client, table)
+            job_config = bigquery.LoadJobConfig(
+                schema=RUN_METRICS_SCHEMA, write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            )
+            client.load_table_from_json(rows, table_id, job_config=job_config).result()
+            print(f"📊 Wrote {len(rows)} run metrics rows to {table_id}.")
+        except Exception as e:
+            # Metrics must never fail the run
+            print(f"⚠️ Could not write run metrics to {table_id}: {e}")
+
+
+# The run's collector, shared by every module (like ThrottledFacebookAdsApi.governor)
+METRICS = RunMetrics()
@@ -0,0 +1,327 @@
+"""
+Typed schemas for the Meta tables and a vectorized page -> Arrow converter.
+
+Meta returns every metric as a string ("spend": "12.34"), action breakdowns as
+lists of {"action_type", "value"} dicts and structure settings as nested
+objects. Left to inference, that means object / string columns, schema
+autodetection on every load, and schemas that drift when a field is missing
+from one account's batch.
+
+FIELD_KINDS types every field we request. A TableSchema built from a table's
+field list gives its BigQuery schema and converts raw pages into a pyarrow
+table of exactly that schema in one pass: every column is built and cast as a
+whole (strings -> numbers / dates / timestamps, action and result lists ->
+REPEATED RECORD, other nested objects -> JSON strings), and fields missing from a
+page become typed null columns.
+
+With SCHEMA_CONFIG['pivot_action_lists'] the action lists are also pivoted into
+wide FLOAT64 columns, one per action_type (e.g. actions__link_click).
+"""
+
+import json
+import re
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from google.cloud.bigquery import SchemaField
+
+SCHEMA_CONFIG = {
+    'pivot_action_lists': False,   # Add wide <field>__<action_type> columns next to the action lists
+}
+
+ACTION_STATS_TYPE = pa.struct([('action_type', pa.string()), ('value', pa.float64())])
+# results / cost_per_result / result_rate: [{"indicator": ..., "values": [{"value": ..., "attribution_windows": [...]}]}]
+RESULT_VALUES_TYPE = pa.list_(pa.struct([('value', pa.float64()), ('attribution_windows', pa.list_(pa.string()))]))
+RESULT_TYPE = pa.struct([('indicator', pa.string()), ('values', RESULT_VALUES_TYPE)])
+
+# kind -> (BigQuery type, mode, Arrow type)
+KINDS = {
+    'string': ('STRING', 'NULLABLE', pa.string()),
+    'json': ('STRING', 'NULLABLE', pa.string()),          # Nested objects, stored JSON-encoded
+    'int': ('INT64', 'NULLABLE', pa.int64()),
+    'float': ('FLOAT64', 'NULLABLE', pa.float64()),
+    'bool': ('BOOL', 'NULLABLE', pa.bool_()),
+    'date': ('DATE', 'NULLABLE', pa.date32()),
+    'timestamp': ('TIMESTAMP', 'NULLABLE', pa.timestamp('us', tz='UTC')),
+    'datetime': ('DATETIME', 'NULLABLE', pa.timestamp('us')),
+    'strings': ('STRING', 'REPEATED', pa.list_(pa.string())),
+    'actions': ('RECORD', 'REPEATED', pa.list_(ACTION_STATS_TYPE)),
+    'results': ('RECORD', 'REPEATED', pa.list_(RESULT_TYPE)),
+}
+
+# Sub-fields of the RECORD kinds
+RECORD_FIELDS = {
+    'actions': (SchemaField('action_type', 'STRING'), SchemaField('value', 'FLOAT64')),
+    'results': (
+        SchemaField('indicator', 'STRING'),
+        SchemaField('values', 'RECORD', mode='REPEATED', fields=(
+            SchemaField('value', 'FLOAT64'),
+            SchemaField('attribution_windows', 'STRING', mode='REPEATED'),
+        )),
+    ),
+}
+
+_FIELDS_BY_KIND = {
+    'string': [
+        'id', 'name', 'account_id', 'campaign_id', 'adset_id', 'ad_id', 'ad_account_id',
+        'status', 'effective_status', 'configured_status', 'objective', 'buying_type', 'bid_strategy',
+        'boosted_object_id', 'primary_attribution', 'smart_promotion_type', 'source_campaign_id',
+        'source_recommendation_type', 'special_ad_category', 'topline_id', 'billing_event',
+        'optimization_goal', 'optimization_sub_event', 'destination_type', 'bid_type',
+        'call_to_action_type', 'conversion_domain', 'account_currency', 'account_name', 'ad_name',
+        'adset_name', 'campaign_name', 'quality_ranking', 'conversion_rate_ranking',
+        'engagement_rate_ranking', 'publisher_platform', 'platform_position',
+    ],
+    'json': [
+        'adlabels', 'advantage_state_info', 'brand_lift_studies', 'campaign_group_active_time',
+        'issues_info', 'promoted_object', 'recommendations', 'source_campaign', 'adbatch',
+        'budget_schedule_specs', 'execution_options', 'iterative_split_test_configs',
+        'learning_stage_info', 'review_feedback', 'creative', 'ad_review_feedback', 'targeting',
+    ],
+    'int': [
+        'daily_budget', 'lifetime_budget', 'budget_remaining', 'spend_cap', 'bid_amount',
+        'impressions', 'reach', 'clicks', 'unique_clicks', 'inline_link_clicks',
+        'unique_inline_link_clicks', 'inline_post_engagement',
+    ],
+    'float': [
+        'frequency', 'spend', 'social_spend', 'cpc', 'cpm', 'ctr', 'unique_ctr', 'inline_link_click_ctr',
+        'unique_inline_link_click_ctr', 'cost_per_inline_post_engagement', 'canvas_avg_view_percent',
+        'canvas_avg_view_time',
+    ],
+    'bool': [
+        'budget_rebalance_flag', 'can_create_brand_lift_study', 'can_use_spend_cap',
+        'has_secondary_skadnetwork_reporting', 'is_adset_budget_sharing_enabled',
+        'is_budget_schedule_enabled', 'is_direct_send_campaign', 'is_message_campaign',
+        'is_skadnetwork_attribution', 'is_dynamic_creative',
+    ],
+    'date': ['date_start', 'date_stop'],
+    'timestamp': ['start_time', 'stop_time', 'end_time', 'last_budget_toggling_time'],
+    'datetime': ['last_run_timestamp'],
+    'strings': ['special_ad_categories', 'special_ad_category_country', 'pacing_type'],
+    'actions': [
+        'actions', 'action_values', 'unique_actions', 'cost_per_action_type', 'cost_per_unique_action_type',
+        'conversions', 'conversion_values', 'cost_per_conversion', 'outbound_clicks', 'outbound_clicks_ctr',
+        'unique_outbound_clicks', 'unique_outbound_clicks_ctr', 'video_thruplay_watched_actions',
+    ],
+    'results': ['results', 'result_rate', 'cost_per_result'],
+}
+
+# Meta field name -> kind
+FIELD_KINDS = {name: kind for kind, names in _FIELDS_BY_KIND.items() for name in names}
+
+# created_time / updated_time are full timestamps on objects, but report dates on insights
+INSIGHT_FIELD_KINDS = {'created_time': 'date', 'updated_time': 'date'}
+STRUCTURE_FIELD_KINDS = {'created_time': 'timestamp', 'updated_time': 'timestamp'}
+
+META_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+
+
+def _sanitize_column_name(value):
+    return re.sub(r'[^0-9a-zA-Z_]', '_', str(value))
+
+
+def _to_string_array(values):
+    try:
+        return pa.array(values, type=pa.string())
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+
+def _blank_to_null(array):
+    """Meta sends '' for some unset numbers; treat it as null."""
+    return pc.if_else(pc.equal(array, ''), pa.scalar(None, pa.string()), array)
+
+
+def _to_number_array(values, arrow_type):
+    try:
+        array = pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        array = _to_string_array(values)
+    if pa.types.is_null(array.type):
+        return pa.nulls(len(values), arrow_type)
+    if pa.types.is_string(array.type):
+        array = _blank_to_null(array)
+    try:
+        return array.cast(arrow_type)
+    except pa.ArrowInvalid:
+        # e.g. '12.0' for an integer field
+        return array.cast(pa.float64()).cast(arrow_type, safe=False)
+
+
+def _to_bool_array(values):
+    try:
+        return pa.array(values, type=pa.bool_())
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return _blank_to_null(_to_string_array([None if v is None else str(v).lower() for v in values])).cast(pa.bool_())
+
+
+def _to_time_array(values, kind):
+    return _cast_column(_to_string_array(values), kind)
+
+
+def encode_json(value):
+    """How a json kind field is stored: JSON-encoded (strings and None as they are)."""
+    return value if value is None or isinstance(value, str) else json.dumps(value, sort_keys=True)
+
+
+def _to_json_array(values):
+    return pa.array([encode_json(v) for v in values], type=pa.string())
+
+
+def _column(values, kind):
+    if kind == 'string':
+        return _to_string_array(values)
+    if kind == 'json':
+        return _to_json_array(values)
+    if kind in ('int', 'float'):
+        return _to_number_array(values, KINDS[kind][2])
+    if kind == 'bool':
+        return _to_bool_array(values)
+    if kind in ('date', 'timestamp'):
+        return _to_time_array(values, kind)
+    if kind == 'datetime':
+        return pa.array(values, type=KINDS[kind][2])
+    if kind == 'strings':
+        return pa.array(values, type=KINDS[kind][2])
+    if kind in ('actions', 'results'):
+        return _cast_column(pa.array(values, type=RAW_TYPES[kind]), kind)
+    raise ValueError(f"Unknown field kind: {kind}")
+
+
+# How Meta sends each kind in the JSON response (json fields are encoded in Python)
+RAW_TYPES = {
+    'string': pa.string(),
+    'int': pa.string(),
+    'float': pa.string(),
+    'bool': pa.bool_(),
+    'date': pa.string(),
+    'timestamp': pa.string(),
+    'strings': pa.list_(pa.string()),
+    'actions': pa.list_(pa.struct([('action_type', pa.string()), ('value', pa.string())])),
+    'results': pa.list_(pa.struct([
+        ('indicator', pa.string()),
+        ('values', pa.list_(pa.struct([('value', pa.string()), ('attribution_windows', pa.list_(pa.string()))]))),
+    ])),
+}
+
+
+def _cast_column(array, kind):
+    """Casts a column read with its RAW_TYPES type to the kind's Arrow type."""
+    if kind in ('string', 'bool', 'strings'):
+        return array
+    if kind in ('int', 'float'):
+        array = _blank_to_null(array)
+        try:
+            return array.cast(KINDS[kind][2])
+        except pa.ArrowInvalid:
+            return array.cast(pa.float64()).cast(KINDS[kind][2], safe=False)
+    if kind == 'date':
+        return pc.strptime(_blank_to_null(array), format='%Y-%m-%d', unit='us').cast(pa.date32())
+    if kind == 'timestamp':
+        return pc.strptime(_blank_to_null(array), format=META_TIMESTAMP_FORMAT, unit='us')
+    if kind in ('actions', 'results'):
+        return array.cast(KINDS[kind][2])
+    raise ValueError(f"Unknown field kind: {kind}")
+
+
+def pivot_action_list(column, field_name):
+    """
+    Pivots one list<struct<action_type, value>> column into wide FLOAT64 columns.
+
+    Returns [(column_name, array)], one per action_type present, e.g.
+    ('actions__link_click', [3.0, null, ...]).
+    """
+    num_rows = len(column)
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    parents = pc.list_parent_indices(column).to_numpy()
+    entries = pc.list_flatten(column)
+    if len(entries) == 0:
+        return []
+    action_types = entries.field('action_type')
+    values = entries.field('value').to_numpy(zero_copy_only=False)
+
+    pivoted = []
+    for action_type in pc.unique(action_types).to_pylist():
+        if action_type is None:
+            continue
+        mask = pc.equal(action_types, action_type).to_numpy(zero_copy_only=False)
+        wide = np.full(num_rows, np.nan)
+        wide[parents[mask]] = values[mask]
+        pivoted.append((f"{field_name}__{_sanitize_column_name(action_type)}", pa.array(wide, from_pandas=True)))
+    return pivoted
+
+
+class TableSchema(object):
+    """
+    Registry entry for one table: its typed fields, BigQuery schema and converter.
+
+    Args:
+        fields (list): Meta fields requested for the table (plus pipeline columns).
+        field_kinds (dict): Per-table overrides of FIELD_KINDS.
+    """
+
+    def __init__(self, fields, field_kinds=None):
+        kinds = {**FIELD_KINDS, **(field_kinds or {})}
+        self.kinds = {}
+        for name in fields:
+            name = name.strip()
+            if name not in kinds:
+                raise ValueError(f"No type registered for Meta field '{name}' (add it to schemas.FIELD_KINDS)")
+            self.kinds.setdefault(name, kinds[name])
+
+    @property
+    def bigquery_schema(self):
+        return [SchemaField(name, KINDS[kind][0], mode=KINDS[kind][1], fields=RECORD_FIELDS.get(kind, ()))
+                for name, kind in self.kinds.items()]
+
+    @property
+    def arrow_schema(self):
+        return pa.schema([(name, KINDS[kind][2]) for name, kind in self.kinds.items()])
+
+    def to_arrow(self, rows, extra_columns=None, pivot_action_lists=None):
+        """
+        Converts one page of Meta rows (dicts) into a pyarrow table of this schema.
+
+        Fields a page lacks become typed null columns; fields the registry does not
+        know are appended with inferred types rather than dropped.
+        """
+        if pivot_action_lists is None:
+            pivot_action_lists = SCHEMA_CONFIG['pivot_action_lists']
+        extra_columns = extra_columns or {}
+
+        raw_fields = [(name, RAW_TYPES[kind]) for name, kind in self.kinds.items()
+                      if kind in RAW_TYPES and name not in extra_columns]
+        try:
+            # Fast path: one pass over the rows in C, as Meta sends the values (mostly strings)
+            raw = pa.Table.from_pylist(rows, schema=pa.schema(raw_fields))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # A value of an unexpected type (e.g. a number where Meta usually sends a string)
+            raw = None
+
+        names, arrays = [], []
+        for name, kind in self.kinds.items():
+            if name in extra_columns:
+                array = _column([extra_columns[name]] * len(rows), kind)
+            elif raw is not None and kind in RAW_TYPES:
+                array = _cast_column(raw[name], kind)
+            else:
+                array = _column([row.get(name) for row in rows], kind)
+            names.append(name)
+            arrays.append(array)
+
+        unknown = sorted(set().union(extra_columns, *rows) - set(self.kinds))
+        if unknown:
+            inferred = pa.Table.from_pylist([{k: extra_columns.get(k, row.get(k)) for k in unknown} for row in rows])
+            names.extend(inferred.column_names)
+            arrays.extend(inferred.columns)
+
+        if pivot_action_lists:
+            for name, kind in list(self.kinds.items()):
+                if kind == 'actions':
+                    for wide_name, wide in pivot_action_list(arrays[names.index(name)], name):
+                        names.append(wide_name)
+                        arrays.append(wide)
+
+        return pa.Table.from_arrays(arrays, names=names)
@@ -0,0 +1,314 @@
+"""
+Sharded execution across the tasks of a Cloud Run Job.
+
+With --tasks N, Cloud Run starts N copies of the container and tells each one
+which it is through CLOUD_RUN_TASK_INDEX / CLOUD_RUN_TASK_COUNT (and the
+execution through CLOUD_RUN_EXECUTION). Each task then processes only its share
+of META_CONFIG['ad_account_ids']:
+
+- The split is deterministic: accounts are weighted by their average runtime
+  over recent runs (the fetch / stream / load stages in etl_run_metrics, see
+  run_metrics.py) and handed out longest first, each to the task with the least
+  work so far. Accounts without history weigh the average, or 1 without any
+  history (a plain round robin).
+- Before processing an account a task takes its lease in etl_account_leases
+  with one MERGE, so two tasks (or an overlapping execution) never process the
+  same account. Leases are renewed while the task runs and released at its end;
+  a lease of a task that died expires after lease_minutes.
+- Once a task is through its own accounts it tries the others' (steal_unclaimed),
+  so an account is still processed this execution if its own task is slow,
+  failed, or computed a different split.
+
+Locally the same happens with `python main.py local-shards --tasks N`, which
+starts N processes with the Cloud Run variables set (backend='local' keeps the
+leases in a file instead of BigQuery).
+"""
+
+import fcntl
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import bigquery
+from google.cloud.bigquery import SchemaField, Table
+
+from bootstrap import BOOTSTRAP
+from dml import run_dml
+from run_metrics import RUN_METRICS_CONFIG
+
+SHARDING_CONFIG = {
+    'weighted': True,               # Weight accounts by their runtime in etl_run_metrics
+    'history_days': 14,             # Runs (before today) the weights are averaged over
+    'steal_unclaimed': True,        # Also process other tasks' accounts nobody has leased yet
+    'lease_minutes': 30,            # A lease not renewed for this long is free again
+    'backend': 'bigquery',          # 'bigquery': etl_account_leases table; 'local': JSON file at local_path
+    'local_path': os.path.join(os.environ.get('TMPDIR', '/tmp'), 'etl_account_leases.json'),
+}
+
+# Per-account stages that don't nest in each other (see main.py)
+ACCOUNT_STAGES = ['fetch', 'stream', 'load']
+
+LEASE_TABLE = 'etl_account_leases'
+LEASE_SCHEMA = [
+    SchemaField("ad_account_id", "STRING", mode="REQUIRED"),
+    SchemaField("execution_id", "STRING", mode="REQUIRED"),
+    SchemaField("task_index", "INT64", mode="REQUIRED"),
+    SchemaField("acquired_at", "TIMESTAMP", mode="REQUIRED"),
+    SchemaField("expires_at", "TIMESTAMP", mode="REQUIRED"),
+    SchemaField("released_at", "TIMESTAMP", mode="NULLABLE"),
+]
+
+
+class Shard(object):
+    """This task's place in the job execution (one task covering everything when not sharded)."""
+
+    def __init__(self, index=0, count=1, execution_id=None):
+        if not 0 <= index < count:
+            raise ValueError(f"Task index {index} is out of range for {count} tasks")
+        self.index = index
+        self.count = count
+        self.execution_id = execution_id
+
+    @classmethod
+    def from_env(cls, environ=None):
+        environ = os.environ if environ is None else environ
+        return cls(int(environ.get('CLOUD_RUN_TASK_INDEX', 0)), int(environ.get('CLOUD_RUN_TASK_COUNT', 1)),
+                   environ.get('CLOUD_RUN_EXECUTION'))
+
+    @property
+    def sharded(self):
+        return self.count > 1
+
+    def describe(self):
+        return f"task {self.index + 1}/{self.count}" + (f" of {self.execution_id}" if self.execution_id else "")
+
+
+def account_weights(client, dataset_id, ad_account_ids, history_days):
+    """{ad_account_id: average seconds per run} over the recent runs in etl_run_metrics."""
+    table_id = f"{client.project}.{dataset_id}.{RUN_METRICS_CONFIG['table']}"
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("ad_account_ids", "STRING", list(ad_account_ids)),
+        bigquery.ArrayQueryParameter("stages", "STRING", ACCOUNT_STAGES),
+        bigquery.ScalarQueryParameter("history_days", "INT64", history_days),
+    ])
+    try:
+        # Runs before today only, so every task of an execution reads the same history
+        rows = client.query(f"""
+            SELECT ad_account_id, AVG(seconds) AS seconds
+            FROM (
+              SELECT run_id, ad_account_id, SUM(duration_seconds) AS seconds
+              FROM `{table_id}`
+              WHERE run_started_at >= TIMESTAMP(DATE_SUB(CURRENT_DATE(), INTERVAL @history_days DAY))
+                AND run_started_at < TIMESTAMP(CURRENT_DATE())
+                AND stage IN UNNEST(@stages) AND ad_account_id IN UNNEST(@ad_account_ids)
+              GROUP BY run_id, ad_account_id
+            )
+            GROUP BY ad_account_id
+        """, job_config=job_config).result()
+        return {row.ad_account_id: row.seconds for row in rows if row.seconds}
+    except Exception as e:
+        if 'Not found' in str(e) or '404' in str(e):
+            return {}
+        print(f"⚠️ Could not read account runtimes from {table_id}; splitting accounts evenly. Error: {e}")
+        return {}
+
+
+def split_accounts(ad_account_ids, count, weights=None):
+    """
+    Splits the accounts into `count` lists, the same way in every task: longest
+    (by weight) first, each to the task with the least total weight so far.
+    """
+    weights = weights or {}
+    default = sum(weights.values()) / len(weights) if weights else 1.0
+    ordered = sorted(enumerate(ad_account_ids), key=lambda item: (-weights.get(item[1], default), item[0]))
+    shards = [[] for _ in range(count)]
+    totals = [0.0] * count
+    for _, ad_account_id in ordered:
+        task = min(range(count), key=lambda i: (totals[i], i))
+        shards[task].append(ad_account_id)
+        totals[task] += weights.get(ad_account_id, default)
+    return shards
+
+
+def plan_accounts(client, dataset_id, shard, ad_account_ids, config=None):
+    """
+    Returns (own, others): this task's share of the accounts, and (steal_unclaimed)
+    every other task's share, starting from the next task, to try once it is through.
+    """
+    config = {**SHARDING_CONFIG, **(config or {})}
+    weights = account_weights(client, dataset_id, ad_account_ids, config['history_days']) if config['weighted'] else {}
+    shards = split_accounts(ad_account_ids, shard.count, weights)
+    own = shards[shard.index]
+    total = sum(weights.values())
+    share = sum(weights.get(a, 0.0) for a in own)
+    print(f"🧩 Sharded run, {shard.describe()}: {len(own)} of {len(ad_account_ids)} accounts"
+          + (f" (~{share:.0f}s of {total:.0f}s recent runtime)." if total else "."))
+    if not config['steal_unclaimed'] or not shard.execution_id:
+        # Without an execution id a released lease can't be told apart from one of this execution
+        return own, []
+    return own, [a for i in range(1, shard.count) for a in shards[(shard.index + i) % shard.count]]
+
+
+class AccountLeases(object):
+    """
+    Leases of ad accounts for one task of an execution.
+
+    An account can be leased when nobody holds it, when its lease expired, or when
+    it was released by another execution. Once released by this execution it is
+    done and is not leased again by any of its tasks.
+    """
+
+    def __init__(self, client, dataset_id, shard, config=None):
+        self.client = client
+        self.shard = shard
+        self.config = {**SHARDING_CONFIG, **(config or {})}
+        self.table_id = f"{client.project}.{dataset_id}.{LEASE_TABLE}"
+        self.execution_id = shard.execution_id or f"task-{shard.index}-{datetime.now(timezone.utc).isoformat()}"
+        self.held = set()
+        self.acquired = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def prepare(self):
+        """Creates the lease table once per run and starts renewing the held leases."""
+        if self.config['backend'] != 'local':
+            BOOTSTRAP.ensure_table(self.client, Table(self.table_id, schema=LEASE_SCHEMA))
+        self._renewer = threading.Thread(target=self._renew_loop, name='lease-renewer', daemon=True)
+        self._renewer.start()
+        return self
+
+    def acquire(self, ad_account_id):
+        """Takes the account's lease; False if another task holds it or this execution already processed it."""
+        try:
+            if self.config['backend'] == 'local':
+                acquired = self._acquire_local(ad_account_id)
+            else:
+                acquired = self._acquire_bigquery(ad_account_id)
+        except Exception as e:
+            # Skipping is safe: the account is picked up from its watermarks next run
+            print(f"⚠️ Could not lease {ad_account_id}; skipping it. Error: {e}")
+            return False
+        if acquired:
+            with self._lock:
+                self.held.add(ad_account_id)
+                self.acquired.append(ad_account_id)
+        return acquired
+
+    def close(self):
+        """Stops renewing and releases every held lease (call once the accounts' watermarks are saved)."""
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+        with self._lock:
+            held, self.held = sorted(self.held), set()
+        if not held:
+            return
+        try:
+            if self.config['backend'] == 'local':
+                self._update_local(held, release=True)
+            else:
+                self._update_bigquery(held, release=True)
+        except Exception as e:
+            # The leases expire on their own after lease_minutes
+            print(f"⚠️ Could not release the leases of {len(held)} accounts: {e}")
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.config['lease_minutes'] * 60 / 3):
+            with self._lock:
+                held = sorted(self.held)
+            if not held:
+                continue
+            try:
+                if self.config['backend'] == 'local':
+                    self._update_local(held, release=False)
+                else:
+                    self._update_bigquery(held, release=False)
+            except Exception as e:
+                print(f"⚠️ Could not renew the leases of {len(held)} accounts: {e}")
+
+    # --- BigQuery backend ---
+    def _query(self, sql, params):
+        """Runs a DML statement, retrying when it collides with another task's lease update."""
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("execution_id", "STRING", self.execution_id),
+            bigquery.ScalarQueryParameter("task_index", "INT64", self.shard.index),
+            bigquery.ScalarQueryParameter("lease_minutes", "INT64", self.config['lease_minutes']),
+            *params,
+        ])
+        return run_dml(self.client, sql, job_config)
+
+    def _acquire_bigquery(self, ad_account_id):
+        job = self._query(f"""
+            MERGE `{self.table_id}` T
+            USING (SELECT @ad_account_id AS ad_account_id) S
+            ON T.ad_account_id = S.ad_account_id
+            WHEN MATCHED AND (
+              (T.released_at IS NULL AND T.expires_at < CURRENT_TIMESTAMP())
+              OR (T.released_at IS NOT NULL AND T.execution_id != @execution_id)
+            ) THEN
+              UPDATE SET execution_id = @execution_id, task_index = @task_index, acquired_at = CURRENT_TIMESTAMP(),
+                         expires_at = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @lease_minutes MINUTE),
+                         released_at = NULL
+            WHEN NOT MATCHED THEN
+              INSERT (ad_account_id, execution_id, task_index, acquired_at, expires_at, released_at)
+              VALUES (S.ad_account_id, @execution_id, @task_index, CURRENT_TIMESTAMP(),
+                      TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @lease_minutes MINUTE), NULL)
+        """, [bigquery.ScalarQueryParameter("ad_account_id", "STRING", ad_account_id)])
+        return job.num_dml_affected_rows == 1
+
+    def _update_bigquery(self, ad_account_ids, release):
+        change = "released_at = CURRENT_TIMESTAMP()" if release else \
+            "expires_at = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @lease_minutes MINUTE)"
+        self._query(f"""
+            UPDATE `{self.table_id}` SET {change}
+            WHERE ad_account_id IN UNNEST(@ad_account_ids) AND execution_id = @execution_id
+              AND task_index = @task_index AND released_at IS NULL
+        """, [bigquery.ArrayQueryParameter("ad_account_ids", "STRING", ad_account_ids)])
+
+    # --- Local backend (one JSON file, locked across processes) ---
+    def _with_local_leases(self, change):
+        with open(self.config['local_path'], 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                leases = json.loads(content) if content else {}
+                result = change(leases, datetime.now(timezone.utc))
+                f.seek(0)
+                f.truncate()
+                json.dump(leases, f)
+                # Written before the lock is released, not when the file is closed
+                f.flush()
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _acquire_local(self, ad_account_id):
+        def acquire(leases, now):
+            lease = leases.get(ad_account_id)
+            if lease is not None:
+                expired = lease['released_at'] is None and datetime.fromisoformat(lease['expires_at']) < now
+                released_elsewhere = lease['released_at'] is not None and lease['execution_id'] != self.execution_id
+                if not (expired or released_elsewhere):
+                    return False
+            leases[ad_account_id] = {
+                'execution_id': self.execution_id, 'task_index': self.shard.index, 'acquired_at': now.isoformat(),
+                'expires_at': (now + timedelta(minutes=self.config['lease_minutes'])).isoformat(), 'released_at': None,
+            }
+            return True
+        return self._with_local_leases(acquire)
+
+    def _update_local(self, ad_account_ids, release):
+        def update(leases, now):
+            for ad_account_id in ad_account_ids:
+                lease = leases.get(ad_account_id)
+                if (lease is None or lease['execution_id'] != self.execution_id
+                        or lease['task_index'] != self.shard.index or lease['released_at'] is not None):
+                    continue
+                if release:
+                    lease['released_at'] = now.isoformat()
+                else:
+                    lease['expires_at'] = (now + timedelta(minutes=self.config['lease_minutes'])).isoformat()
+        self._with_local_leases(update)
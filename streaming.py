@@ -0,0 +1,208 @@
+"""
+Streaming, bounded-memory loading of Meta pages into BigQuery.
+
+Instead of materialising a whole account as lists of dicts, round-tripping it
+through JSON and building one DataFrame per table, each fetched page is turned
+into an Arrow record batch as soon as it arrives. Batches are buffered per table
+and flushed to BigQuery as a Parquet load job every `flush_rows` rows or
+`flush_mb` MB, or earlier when the process RSS reaches `memory_ceiling_mb`.
+Peak memory is therefore bounded by the flush size, not by the account size.
+"""
+
+import io
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+
+from run_metrics import METRICS, current_rss_mb, peak_rss_mb  # noqa: F401 (re-exported)
+from schemas import encode_json
+
+STREAMING_CONFIG = {
+    'flush_rows': 50000,          # Flush a table's buffer once it holds this many rows
+    'flush_mb': 64,               # ... or this many MB of Arrow data
+    'memory_ceiling_mb': 1536,    # Flush early whenever process RSS reaches this
+}
+
+
+def page_to_record_batch(rows, extra_columns=None, timestamp_columns=(), table_schema=None, json_columns=()):
+    """
+    Converts one page of Meta rows (dicts) into an Arrow record batch.
+
+    Args:
+        rows (list): Page rows as returned by export_all_data().
+        extra_columns (dict): Constant columns to append (e.g. ad_account_id).
+        timestamp_columns (iterable): 'YYYY-MM-DD' string columns to cast to timestamps
+            (only used without table_schema).
+        table_schema (schemas.TableSchema): Typed schema to convert to, instead of inferring.
+        json_columns (iterable): Nested object columns to store JSON-encoded (only used without
+            table_schema); inferred structs differ from page to page with the keys Meta sends.
+    """
+    if table_schema is not None:
+        table = table_schema.to_arrow(rows, extra_columns)
+        return table.combine_chunks().to_batches()[0] if table.num_rows else None
+
+    json_columns = [name for name in json_columns if any(name in row for row in rows)]
+    if json_columns:
+        rows = [{**row, **{name: encode_json(row[name]) for name in json_columns if name in row}} for row in rows]
+    table = pa.Table.from_pylist(rows)
+    for name in timestamp_columns:
+        if name in table.column_names and pa.types.is_string(table.schema.field(name).type):
+            index = table.column_names.index(name)
+            parsed = pc.strptime(table[name], format='%Y-%m-%d', unit='us')
+            table = table.set_column(index, name, parsed)
+    for name, value in (extra_columns or {}).items():
+        table = table.append_column(name, pa.array([value] * table.num_rows))
+    return table.combine_chunks().to_batches()[0] if table.num_rows else None
+
+
+class ArrowChunkLoader(object):
+    """
+    Buffers record batches for one BigQuery table and loads them in bounded chunks.
+
+    job_config_factory(first_chunk) must return the bigquery.LoadJobConfig for a
+    chunk: the first chunk keeps the table's normal write disposition (e.g.
+    WRITE_TRUNCATE for structure tables), later chunks must append.
+
+    on_flush, if given, is called after every successful load job (e.g. to
+    checkpoint the work whose rows are now in BigQuery).
+
+    With boundary_flushes, chunks are only cut at mark_boundary() points: rows of a
+    unit of work (e.g. a date window) that is not complete yet are never loaded, so
+    a unit that fails half way can be fetched again without loading its rows twice
+    (needed for WRITE_APPEND insight loads). The buffer may then exceed the flush
+    size by up to one unit.
+    """
+
+    def __init__(self, client, table_id, job_config_factory, config=None, on_flush=None, boundary_flushes=False):
+        self.client = client
+        self.table_id = table_id
+        self.job_config_factory = job_config_factory
+        self.on_flush = on_flush
+        self.boundary_flushes = boundary_flushes
+        self.config = {**STREAMING_CONFIG, **(config or {})}
+        self._batches = []
+        self._schema = None
+        # Earlier batches whose schema the buffer could not take, loaded as chunks of their own
+        self._held = []
+        self._complete_held = 0
+        self._boundary = 0
+        self.rows_loaded = 0
+        self.chunks_loaded = 0
+
+    @property
+    def _buffered(self):
+        return [b for group in self._held + [self._batches] for b in group]
+
+    def _over_limits(self):
+        buffered = self._buffered
+        return (sum(b.num_rows for b in buffered) >= self.config['flush_rows']
+                or sum(b.nbytes for b in buffered) >= self.config['flush_mb'] * 1024 * 1024
+                or current_rss_mb() >= self.config['memory_ceiling_mb'])
+
+    def add_batch(self, batch):
+        """Adds a record batch, flushing first if its schema cannot be merged with the buffer."""
+        if batch is None or batch.num_rows == 0:
+            return
+        if self._schema is not None and batch.schema != self._schema:
+            try:
+                self._schema = pa.unify_schemas([self._schema, batch.schema], promote_options='permissive')
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                if not self.boundary_flushes:
+                    self.flush()
+                else:
+                    self.flush_complete()
+                    if self._batches:
+                        self._held.append(self._batches)
+                        self._batches = []
+                        self._schema = None
+        if self._schema is None:
+            self._schema = batch.schema
+
+        self._batches.append(batch)
+        if self._over_limits():
+            if self.boundary_flushes:
+                self.flush_complete()
+            else:
+                self.flush()
+
+    def _reset(self):
+        self._batches = []
+        self._schema = None
+        self._held = []
+        self._complete_held = 0
+        self._boundary = 0
+
+    def flush(self):
+        """Loads the buffered batches to BigQuery as one Parquet load job."""
+        groups = self._held + [self._batches]
+        self._reset()
+        for group in groups:
+            self._load(group)
+
+    def flush_complete(self):
+        """Loads the batches up to the last mark_boundary(), keeping the rest buffered."""
+        complete = self._held[:self._complete_held] + [self._batches[:self._boundary]]
+        if not any(complete):
+            return
+        held, rest = self._held[self._complete_held:], self._batches[self._boundary:]
+        self._reset()
+        for group in complete:
+            self._load(group)
+        self._held = held
+        for batch in rest:
+            self.add_batch(batch)
+
+    def _load(self, batches):
+        if not batches:
+            return
+
+        # Serializing the chunk and waiting for its load job
+        with METRICS.stage('load_chunk', log=False) as stage:
+            table = pa.concat_tables(
+                [pa.Table.from_batches([b]) for b in batches], promote_options='permissive'
+            )
+            nbytes = sum(b.nbytes for b in batches)
+
+            buffer = io.BytesIO()
+            pq.write_table(table, buffer, coerce_timestamps='us', allow_truncated_timestamps=True)
+            buffer.seek(0)
+
+            job_config = self.job_config_factory(self.chunks_loaded == 0)
+            job_config.source_format = bigquery.SourceFormat.PARQUET
+            parquet_options = bigquery.ParquetOptions()
+            parquet_options.enable_list_inference = True
+            job_config.parquet_options = parquet_options
+
+            print(f"  🚚 Flushing {table.num_rows} rows ({nbytes / 1e6:.1f} MB) to {self.table_id}...")
+            job = self.client.load_table_from_file(buffer, self.table_id, job_config=job_config)
+            job.result()
+            stage.add(rows=table.num_rows)
+
+        self.rows_loaded += table.num_rows
+        self.chunks_loaded += 1
+        if self.on_flush:
+            self.on_flush()
+
+    def mark_boundary(self):
+        """Marks the batches added so far as a complete unit of work (e.g. a date window)."""
+        self._boundary = len(self._batches)
+        self._complete_held = len(self._held)
+        if self.boundary_flushes and self._over_limits():
+            self.flush()
+
+    def discard(self):
+        """
+        Drops the buffered batches after a failed fetch, first loading those up to the
+        last mark_boundary() so completed units are not fetched again.
+        """
+        try:
+            self.flush_complete()
+        finally:
+            self._reset()
+
+    def close(self):
+        """Flushes whatever is left and returns the total number of rows loaded."""
+        self.flush()
+        return self.rows_loaded
@@ -0,0 +1,248 @@
+"""
+Incremental sync of the structure tables (campaigns, adsets, ads).
+
+Instead of downloading every object of every account on each run and
+WRITE_TRUNCATE-ing the table (which, done per account, also wiped the rows the
+previous account had just written), each account/table is synced like this:
+
+- Incremental (default): only objects with updated_time after the stored
+  watermark (etl_watermarks.updated_through) are fetched, using the Graph API
+  `filtering` param.
+- Full reconcile: on the first run, and at least every `full_reconcile_days`,
+  every object is fetched. Objects of the account that are no longer returned
+  (deleted in Meta) are removed from the table.
+
+Either way the fetched rows are loaded into a per-account staging table and
+MERGEd into the target table keyed on `id`, so other accounts' rows are never
+touched. Nested objects (promoted_object, targeting, ...) are stored JSON-encoded,
+since the target outlives the keys any one load happens to see; tables loaded
+before that are converted once with `python main.py migrate-structure`.
+"""
+
+import threading
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import bigquery
+from google.cloud.bigquery import Table
+
+from bootstrap import BOOTSTRAP
+from dml import run_dml
+from run_metrics import METRICS
+
+STRUCTURE_TABLES = ['campaigns', 'adsets', 'ads']
+
+STRUCTURE_SYNC_CONFIG = {
+    'mode': 'incremental',        # 'incremental': changed objects + periodic reconcile; 'full': reconcile every run
+    'full_reconcile_days': 7,     # Full fetch (which also removes deleted objects) at least this often
+    'overlap_minutes': 10,        # Re-fetch this far before the watermark, to absorb clock skew
+}
+
+UPDATED_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+
+
+def parse_updated_time(value):
+    """Parses Meta's '2024-01-31T12:00:00+0000' timestamps (None if missing or malformed)."""
+    try:
+        return datetime.strptime(value, UPDATED_TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+class StructureSync(object):
+    """
+    Sync plan and state for one structure table of one account.
+
+    Decides between an incremental fetch and a full reconcile from the table's
+    watermarks, tracks the highest updated_time fetched, and merges the staged
+    rows into the target table.
+    """
+
+    def __init__(self, table_name, ad_account_id, updated_through, full_sync_at, config=None):
+        self.config = {**STRUCTURE_SYNC_CONFIG, **(config or {})}
+        self.table_name = table_name
+        self.ad_account_id = ad_account_id
+        self.started_at = datetime.now(timezone.utc)
+        self.max_updated_time = updated_through
+        self._lock = threading.Lock()
+
+        reconcile_due = (
+            full_sync_at is None
+            or self.started_at - full_sync_at >= timedelta(days=self.config['full_reconcile_days'])
+        )
+        self.full = self.config['mode'] == 'full' or updated_through is None or reconcile_due
+        self.updated_since = None if self.full else updated_through - timedelta(minutes=self.config['overlap_minutes'])
+
+    @classmethod
+    def for_replay(cls, table_name, ad_account_id):
+        """A sync that only MERGEs (never deletes), for rows replayed from the raw archive."""
+        sync = cls(table_name, ad_account_id, None, None)
+        sync.full = False
+        return sync
+
+    def describe(self):
+        if self.full:
+            return "full reconcile"
+        return f"objects updated since {self.updated_since:%Y-%m-%d %H:%M:%S} UTC"
+
+    def fetch_params(self):
+        """Extra request params for the structure fetch (the updated_time filter when incremental)."""
+        if self.full:
+            return {}
+        return {'filtering': [{
+            'field': 'updated_time',
+            'operator': 'GREATER_THAN',
+            'value': int(self.updated_since.timestamp()),
+        }]}
+
+    def track(self, pages):
+        """Passes pages through, remembering the highest updated_time seen."""
+        for page in pages:
+            latest = max(filter(None, (parse_updated_time(row.get('updated_time')) for row in page)), default=None)
+            if latest is not None:
+                with self._lock:
+                    if self.max_updated_time is None or latest > self.max_updated_time:
+                        self.max_updated_time = latest
+            yield page
+
+    def watermarks(self):
+        """Watermark values to store once the sync has been merged (see WatermarkStore.advance)."""
+        return {
+            'updated_through': self.max_updated_time,
+            'full_sync_at': self.started_at if self.full else None,
+        }
+
+    def staging_table_id(self, client, dataset_id):
+        return f"{client.project}.{dataset_id}._staging_{self.table_name}_{self.ad_account_id}"
+
+    def apply(self, client, dataset_id, rows_staged):
+        """
+        MERGEs the staged rows into the target table and drops the staging table.
+
+        A full reconcile also deletes the account's rows that were not fetched; a
+        full reconcile that fetched nothing deletes all of the account's rows.
+        """
+        target_id = f"{client.project}.{dataset_id}.{self.table_name}"
+        staging_id = self.staging_table_id(client, dataset_id)
+        account_param = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("ad_account_id", "STRING", self.ad_account_id)
+        ])
+
+        if rows_staged == 0:
+            if self.full and table_exists(client, target_id):
+                run_dml(client, f"DELETE FROM `{target_id}` WHERE ad_account_id = @ad_account_id", account_param)
+            return
+
+        try:
+            staging = client.get_table(staging_id)
+            target = ensure_target_columns(client, target_id, staging.schema)
+            staging_types = {f.name: f.field_type for f in staging.schema}
+            records = [f.name for f in target.schema
+                       if f.field_type in ('RECORD', 'STRUCT') and staging_types.get(f.name) == 'STRING']
+            if records:
+                raise RuntimeError(
+                    f"{target_id} stores {', '.join(records)} as RECORDs, which are now loaded JSON-encoded; "
+                    f"convert them once with `python main.py migrate-structure`."
+                )
+            columns = [f.name for f in staging.schema if f.name in {t.name for t in target.schema}]
+
+            delete_clause = (
+                "WHEN NOT MATCHED BY SOURCE AND T.ad_account_id = @ad_account_id THEN DELETE"
+                if self.full else ""
+            )
+            with METRICS.stage('merge', self.ad_account_id, self.table_name, log=False):
+                # The same object can be fetched twice (overlap, objects moving between pages); other accounts
+                # and sharded tasks MERGE into the same table concurrently
+                run_dml(client, f"""
+                    MERGE `{target_id}` T
+                    USING (
+                      SELECT * FROM `{staging_id}`
+                      WHERE TRUE
+                      QUALIFY ROW_NUMBER() OVER (PARTITION BY id ORDER BY updated_time DESC) = 1
+                    ) S
+                    ON T.id = S.id
+                    WHEN MATCHED THEN
+                      UPDATE SET {', '.join(f'`{c}` = S.`{c}`' for c in columns if c != 'id')}
+                    WHEN NOT MATCHED THEN
+                      INSERT ({', '.join(f'`{c}`' for c in columns)})
+                      VALUES ({', '.join(f'S.`{c}`' for c in columns)})
+                    {delete_clause}
+                """, account_param)
+        finally:
+            client.delete_table(staging_id, not_found_ok=True)
+
+
+def migrate_structure_table(client, dataset_id, table_name, json_columns):
+    """
+    Converts the nested object columns a structure table has as RECORDs (from the
+    WRITE_TRUNCATE loads) to JSON-encoded STRINGs, as they are loaded now. The old
+    table is kept as <table>__records.
+    """
+    table_id = f"{client.project}.{dataset_id}.{table_name}"
+    if not table_exists(client, table_id):
+        print(f"Nothing to migrate for {table_id}: the table does not exist yet.")
+        return
+    table = client.get_table(table_id)
+    records = [f for f in table.schema if f.name in json_columns and f.field_type in ('RECORD', 'STRUCT')]
+    if not records:
+        print(f"✓ {table_id} has no nested columns left to convert.")
+        return
+
+    # A missing object is NULL (or an empty array), not the string 'null'
+    encoded = [
+        f"IF(ARRAY_LENGTH(`{f.name}`) = 0, NULL, TO_JSON_STRING(`{f.name}`)) AS `{f.name}`" if f.mode == 'REPEATED'
+        else f"IF(`{f.name}` IS NULL, NULL, TO_JSON_STRING(`{f.name}`)) AS `{f.name}`"
+        for f in records
+    ]
+    print(f"🛠️ Converting {', '.join(f.name for f in records)} of {table_id} to JSON strings...")
+    client.query(f"CREATE TABLE `{table_id}__records` COPY `{table_id}`").result()
+    client.query(f"""
+        CREATE OR REPLACE TABLE `{table_id}` AS
+        SELECT * REPLACE ({', '.join(encoded)})
+        FROM `{table_id}`
+    """).result()
+    print(f"✨ Migrated {table_id}; the previous table is kept as {table_name}__records.")
+
+
+def table_exists(client, table_id):
+    try:
+        client.get_table(table_id)
+        return True
+    except Exception as e:
+        if 'Not found' in str(e) or '404' in str(e):
+            return False
+        raise
+
+
+def ensure_target_columns(client, target_id, staging_schema, time_partitioning=None, clustering_fields=None):
+    """
+    Creates the target table from the staging schema, or adds the columns it is missing.
+
+    time_partitioning and clustering_fields only apply when the table is created.
+    A target the bootstrap manifest already has with these columns (and types) is not checked again.
+    """
+    if BOOTSTRAP.is_current(target_id, staging_schema, time_partitioning, clustering_fields):
+        return Table(target_id, schema=staging_schema)
+
+    if not table_exists(client, target_id):
+        table = Table(target_id, schema=staging_schema)
+        table.time_partitioning = time_partitioning
+        table.clustering_fields = clustering_fields
+        print(f"✨ Created table {target_id} for MERGE loads.")
+        target = client.create_table(table, exists_ok=True)
+        BOOTSTRAP.record(target_id, staging_schema, time_partitioning, clustering_fields)
+        return target
+
+    target = client.get_table(target_id)
+    existing = {f.name: f.field_type for f in target.schema}
+    new_fields = [f for f in staging_schema if f.name not in existing]
+    if new_fields:
+        target.schema = list(target.schema) + [
+            bigquery.SchemaField(f.name, f.field_type, mode="NULLABLE" if f.mode == "REQUIRED" else f.mode,
+                                 fields=f.fields)
+            for f in new_fields
+        ]
+        target = client.update_table(target, ["schema"])
+    # Skipping the check next time stands in for the target's schema, so only when its types match too
+    if all(existing.get(f.name, f.field_type) == f.field_type for f in staging_schema):
+        BOOTSTRAP.record(target_id, staging_schema, time_partitioning, clustering_fields)
+    return target
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The ETL modules live at the repository root (see Dockerfile)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+from facebook_business.exceptions import FacebookRequestError
+
+import async_insights
+from async_insights import JOB_COMPLETED, fetch_insights_async, is_too_much_data_error, is_transient_error
+
+
+def _error(code, subcode=None, message='An unknown error occurred'):
+    body = {'error': {'code': code, 'message': message, **({'error_subcode': subcode} if subcode else {})}}
+    return FacebookRequestError(message, {}, 500, {}, json.dumps(body))
+
+
+class _ReportRun(dict):
+    def __init__(self, window):
+        super().__init__()
+        self.window = window
+        self.fetched = False
+
+    def api_get(self, fields=None):
+        self['async_status'] = JOB_COMPLETED
+
+    def get_result(self, params=None):
+        self.fetched = True
+        return []
+
+
+class _AdAccount(object):
+    """Raises the queued errors on submission, then accepts every window."""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.submitted = []
+        self.runs = []
+
+    def get_id(self):
+        return 'act_1'
+
+    def get_insights(self, fields=None, params=None, is_async=False):
+        window = (params['time_range']['since'], params['time_range']['until'])
+        self.submitted.append(window)
+        if self.errors:
+            raise self.errors.pop(0)
+        self.runs.append(_ReportRun(window))
+        return self.runs[-1]
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(async_insights.time, 'sleep', lambda seconds: None)
+
+
+def _fetch(account, since='2026-01-01', until='2026-01-04'):
+    config = {'shard_days': 30, 'poll_initial_seconds': 0}
+    list(fetch_insights_async(account, ['spend'], {}, since, until, config=config))
+    return [run.window for run in account.runs if run.fetched]
+
+
+def test_generic_errors_are_transient_not_too_much_data():
+    for code in (1, 2):
+        assert is_transient_error(_error(code))
+        assert not is_too_much_data_error(_error(code))
+    assert is_too_much_data_error(_error(1, subcode=1487534))
+    assert is_too_much_data_error(_error(100, message='Please reduce the amount of data you are asking for'))
+
+
+def test_transient_errors_resubmit_the_same_window():
+    account = _AdAccount([_error(2), _error(1)])
+    assert _fetch(account) == [('2026-01-01', '2026-01-04')]
+    assert account.submitted == [('2026-01-01', '2026-01-04')] * 3
+
+
+def test_too_much_data_splits_the_window():
+    account = _AdAccount([_error(1, subcode=1504018)])
+    assert sorted(_fetch(account)) == [('2026-01-01', '2026-01-02'), ('2026-01-03', '2026-01-04')]
+
+
+def test_transient_retries_are_bounded():
+    account = _AdAccount([_error(2)] * 10)
+    with pytest.raises(FacebookRequestError):
+        _fetch(account)
+    assert len(account.submitted) == async_insights.ASYNC_INSIGHTS_CONFIG['transient_retries'] + 1
@@ -0,0 +1,52 @@
+from datetime import date
+
+from checkpoints import CheckpointStore, WindowProgress, subtract_windows
+
+
+class _Client(object):
+    project = 'p'
+
+
+def d(value):
+    return date.fromisoformat(value)
+
+
+def test_nothing_completed_leaves_the_whole_range():
+    assert subtract_windows('2026-01-01', '2026-01-31', []) == [('2026-01-01', '2026-01-31')]
+
+
+def test_completed_windows_are_cut_out():
+    completed = [(d('2026-01-08'), d('2026-01-14')), (d('2026-01-01'), d('2026-01-03'))]
+    assert subtract_windows('2026-01-01', '2026-01-20', completed) == [
+        ('2026-01-04', '2026-01-07'), ('2026-01-15', '2026-01-20'),
+    ]
+
+
+def test_overlapping_and_outside_windows():
+    completed = [(d('2025-12-01'), d('2025-12-31')), (d('2026-01-02'), d('2026-01-05')),
+                 (d('2026-01-04'), d('2026-01-06')), (d('2026-02-01'), d('2026-02-05'))]
+    assert subtract_windows('2026-01-01', '2026-01-10', completed) == [
+        ('2026-01-01', '2026-01-01'), ('2026-01-07', '2026-01-10'),
+    ]
+
+
+def test_fully_covered_range_has_no_gaps():
+    assert subtract_windows('2026-01-05', '2026-01-06', [(d('2026-01-01'), d('2026-01-31'))]) == []
+
+
+def test_windows_are_only_recorded_on_commit(tmp_path):
+    store = CheckpointStore(_Client(), 'ds', {'backend': 'local', 'local_path': str(tmp_path / 'checkpoints.ndjson')})
+    progress = WindowProgress(store, 'act_1', 'ad_insights', '2026-01-01', '2026-01-10')
+    progress.window_done(('2026-01-01', '2026-01-05'))
+    assert progress.remaining_windows() == [('2026-01-01', '2026-01-10')]
+    progress.commit()
+    assert progress.remaining_windows() == [('2026-01-06', '2026-01-10')]
+
+    # A failed load forgets the windows it held
+    progress.window_done(('2026-01-06', '2026-01-10'))
+    progress.discard_pending()
+    progress.commit()
+    reloaded = CheckpointStore(_Client(), 'ds', store.config).load()
+    assert reloaded.remaining_windows('act_1', 'ad_insights', '2026-01-01', '2026-01-10') == [
+        ('2026-01-06', '2026-01-10'),
+    ]
@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+import rate_limiter
+from rate_limiter import CALL_TYPE_INSIGHTS, CALL_TYPE_MANAGEMENT, RateLimitGovernor, account_scope, classify_call
+
+
+class Clock(object):
+    """Fake monotonic clock; the governor's sleeps advance it and are recorded."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(rate_limiter.time, 'sleep', clock.sleep)
+    return clock
+
+
+def _usage(pct, reset_time_duration=0):
+    return {'X-Ad-Account-Usage': json.dumps({'acc_id_util_pct': pct, 'reset_time_duration': reset_time_duration})}
+
+
+def _governor(**config):
+    return RateLimitGovernor({'bucket_capacity': 3, 'refill_per_second': 2.0, 'slowdown_threshold_pct': 75, **config})
+
+
+def test_no_pacing_below_the_slowdown_threshold(clock):
+    governor = _governor()
+    governor.observe('act_1', CALL_TYPE_MANAGEMENT, _usage(60))
+    for _ in range(50):
+        governor.acquire('act_1', CALL_TYPE_MANAGEMENT)
+    assert clock.sleeps == []
+
+
+def test_bursts_up_to_capacity_then_paces_at_the_refill_rate(clock):
+    governor = _governor()
+    governor.observe('act_1', CALL_TYPE_MANAGEMENT, _usage(80))
+    for _ in range(5):
+        governor.acquire('act_1', CALL_TYPE_MANAGEMENT)
+    # Refill at 80%: 2/s * (100 - 80) / (100 - 75) = 1.6 tokens/s
+    assert clock.sleeps == [pytest.approx(1 / 1.6), pytest.approx(1 / 1.6)]
+    assert governor.total_sleep_seconds == pytest.approx(2 / 1.6)
+
+
+def test_refill_rate_shrinks_towards_full_usage():
+    governor = _governor(min_refill_factor=0.1)
+    assert governor._refill_rate(75) == pytest.approx(2.0)
+    assert governor._refill_rate(87.5) == pytest.approx(1.0)
+    assert governor._refill_rate(99.9) == pytest.approx(0.2)
+
+
+def test_buckets_are_per_account_and_call_type(clock):
+    governor = _governor()
+    governor.observe('act_1', CALL_TYPE_INSIGHTS, _usage(95))
+    for _ in range(3):
+        governor.acquire('act_1', CALL_TYPE_INSIGHTS)
+    governor.acquire('act_2', CALL_TYPE_INSIGHTS)
+    governor.acquire('act_1', CALL_TYPE_MANAGEMENT)
+    assert clock.sleeps == []
+    governor.acquire('act_1', CALL_TYPE_INSIGHTS)
+    assert len(clock.sleeps) == 1
+
+
+def test_blocks_for_the_time_meta_reports(clock):
+    governor = _governor()
+    assert governor.observe('act_1', CALL_TYPE_MANAGEMENT, _usage(100, reset_time_duration=30)) == 30
+    governor.acquire('act_1', CALL_TYPE_MANAGEMENT)
+    assert clock.sleeps == [pytest.approx(30)]
+    # Access restored: usage is re-learnt from the next response
+    governor.acquire('act_1', CALL_TYPE_MANAGEMENT)
+    assert len(clock.sleeps) == 1
+
+
+def test_throttle_without_a_wait_time_backs_off_exponentially(clock):
+    class Error(object):
+        def http_headers(self):
+            return {}
+
+    governor = _governor(default_backoff_seconds=10, max_backoff_seconds=25)
+    assert governor.on_throttled('act_1', CALL_TYPE_MANAGEMENT, Error(), 0) == 10
+    assert governor.on_throttled('act_1', CALL_TYPE_MANAGEMENT, Error(), 1) == 20
+    assert governor.on_throttled('act_1', CALL_TYPE_MANAGEMENT, Error(), 2) == 25
+    assert governor.throttle_events == 3
+
+
+def test_waiting_try_acquire_takes_no_token(clock):
+    governor = _governor()
+    governor.observe('act_1', CALL_TYPE_MANAGEMENT, _usage(80))
+    for _ in range(3):
+        governor.try_acquire('act_1', CALL_TYPE_MANAGEMENT)
+    first = governor.try_acquire('act_1', CALL_TYPE_MANAGEMENT)
+    assert governor.try_acquire('act_1', CALL_TYPE_MANAGEMENT) == pytest.approx(first)
+
+
+def test_calls_are_attributed_by_path_or_scope():
+    assert classify_call(('act_1', 'insights')) == ('act_1', CALL_TYPE_INSIGHTS)
+    assert classify_call('https://graph.facebook.com/v20.0/act_1/campaigns') == ('act_1', CALL_TYPE_MANAGEMENT)
+    # A report run's polls and result pages don't name the account
+    with account_scope('act_2', CALL_TYPE_INSIGHTS):
+        assert classify_call(('123456789',)) == ('act_2', CALL_TYPE_INSIGHTS)
+    assert classify_call(('123456789',)) == (None, CALL_TYPE_MANAGEMENT)
+
+
+def test_body_size_counts_utf8_bytes():
+    assert rate_limiter.body_size(None) == 0
+    assert rate_limiter.body_size('{"name":"Café"}') == 16
+    # Error bodies come parsed from the SDK
+    assert rate_limiter.body_size({'error': {'code': 1}}) == len(b'{"error":{"code":1}}')
@@ -0,0 +1,101 @@
+import pytest
+
+import dml
+from sharding import AccountLeases, Shard, plan_accounts, split_accounts
+
+
+class _Client(object):
+    project = 'p'
+
+
+def test_split_is_longest_first_to_the_least_loaded_task():
+    weights = {'a': 10.0, 'b': 6.0, 'c': 5.0, 'd': 1.0}
+    assert split_accounts(['a', 'b', 'c', 'd'], 2, weights) == [['a', 'd'], ['b', 'c']]
+
+
+def test_split_without_weights_is_round_robin():
+    assert split_accounts(['a', 'b', 'c', 'd', 'e'], 2) == [['a', 'c', 'e'], ['b', 'd']]
+
+
+def test_accounts_without_history_weigh_the_average():
+    # 'new' weighs (9 + 3) / 2 = 6, so it goes before 'small'
+    assert split_accounts(['small', 'big', 'new'], 2, {'big': 9.0, 'small': 3.0}) == [['big'], ['new', 'small']]
+
+
+def test_every_account_is_in_exactly_one_shard():
+    accounts = [f'act_{i}' for i in range(11)]
+    shards = split_accounts(accounts, 3, {a: float(i % 4) for i, a in enumerate(accounts)})
+    assert sorted(a for shard in shards for a in shard) == sorted(accounts)
+
+
+def test_plan_tries_the_other_shards_from_the_next_task():
+    accounts = ['a', 'b', 'c', 'd', 'e', 'f']
+    own, others = plan_accounts(_Client(), 'ds', Shard(1, 3, 'exec-1'), accounts, {'weighted': False})
+    assert own == ['b', 'e']
+    assert others == ['c', 'f', 'a', 'd']
+
+
+def test_plan_without_execution_id_steals_nothing():
+    own, others = plan_accounts(_Client(), 'ds', Shard(0, 2), ['a', 'b'], {'weighted': False})
+    assert (own, others) == (['a'], [])
+
+
+def test_shard_index_must_be_in_range():
+    with pytest.raises(ValueError):
+        Shard(2, 2)
+
+
+def _leases(tmp_path, index, execution_id='exec-1'):
+    config = {'backend': 'local', 'local_path': str(tmp_path / 'leases.json')}
+    return AccountLeases(_Client(), 'ds', Shard(index, 2, execution_id), config)
+
+
+def test_a_held_lease_is_not_taken_by_another_task(tmp_path):
+    first, second = _leases(tmp_path, 0), _leases(tmp_path, 1)
+    assert first.acquire('act_1')
+    assert not second.acquire('act_1')
+
+
+def test_a_released_lease_is_done_for_the_execution(tmp_path):
+    first, second = _leases(tmp_path, 0), _leases(tmp_path, 1)
+    assert first.acquire('act_1')
+    first.close()
+    assert not second.acquire('act_1')
+    # ... but free again for the next execution
+    assert _leases(tmp_path, 0, 'exec-2').acquire('act_1')
+
+
+def test_an_expired_lease_can_be_taken_over(tmp_path):
+    first = _leases(tmp_path, 0)
+    first.config['lease_minutes'] = -1
+    assert first.acquire('act_1')
+    assert _leases(tmp_path, 1).acquire('act_1')
+
+
+def test_run_dml_retries_concurrent_updates_only(monkeypatch):
+    monkeypatch.setattr(dml.time, 'sleep', lambda seconds: None)
+
+    class Job(object):
+        def result(self):
+            return []
+
+    class Client(object):
+        def __init__(self, errors):
+            self.errors = list(errors)
+            self.calls = 0
+
+        def query(self, sql, job_config=None):
+            self.calls += 1
+            if self.errors:
+                raise self.errors.pop(0)
+            return Job()
+
+    conflict = RuntimeError('Could not serialize access to table t due to concurrent update')
+    client = Client([conflict, conflict])
+    dml.run_dml(client, 'MERGE ...')
+    assert client.calls == 3
+
+    with pytest.raises(RuntimeError, match='Syntax error'):
+        dml.run_dml(Client([RuntimeError('Syntax error')]), 'MERGE ...')
+    with pytest.raises(RuntimeError, match='concurrent update'):
+        dml.run_dml(Client([conflict] * 3), 'MERGE ...', retries=2)
@@ -0,0 +1,87 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+
+from streaming import ArrowChunkLoader
+
+
+class _Job(object):
+    def result(self):
+        return None
+
+
+class FakeClient(object):
+    """Keeps the rows of every load job, one list per chunk."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def load_table_from_file(self, buffer, table_id, job_config=None):
+        self.chunks.append(pq.read_table(buffer).to_pylist())
+        return _Job()
+
+
+def _batch(column, values):
+    return pa.RecordBatch.from_pylist([{column: v} for v in values])
+
+
+def _loader(client, **kwargs):
+    config = {'flush_rows': 4, 'flush_mb': 1024, 'memory_ceiling_mb': 1e9}
+    return ArrowChunkLoader(client, 'p.ds.t', lambda first_chunk: bigquery.LoadJobConfig(), config, **kwargs)
+
+
+def test_flushes_once_the_buffer_holds_flush_rows():
+    client = FakeClient()
+    loader = _loader(client)
+    for n in range(3):
+        loader.add_batch(_batch('x', [n, n]))
+    assert [len(chunk) for chunk in client.chunks] == [4]
+    assert loader.close() == 6
+    assert [len(chunk) for chunk in client.chunks] == [4, 2]
+
+
+def test_boundary_flushes_never_load_an_incomplete_window():
+    client = FakeClient()
+    loader = _loader(client, boundary_flushes=True)
+    loader.add_batch(_batch('x', [1, 2]))
+    loader.mark_boundary()
+    loader.add_batch(_batch('x', [3, 4, 5]))
+    # Over flush_rows: only the first window goes out
+    assert client.chunks == [[{'x': 1}, {'x': 2}]]
+    loader.add_batch(_batch('x', [6]))
+    loader.mark_boundary()
+    assert client.chunks[1] == [{'x': 3}, {'x': 4}, {'x': 5}, {'x': 6}]
+
+
+def test_discard_loads_completed_windows_only():
+    client = FakeClient()
+    loader = _loader(client, boundary_flushes=True)
+    loader.add_batch(_batch('x', [1]))
+    loader.mark_boundary()
+    loader.add_batch(_batch('x', [2]))
+    loader.discard()
+    assert client.chunks == [[{'x': 1}]]
+    assert loader.close() == 1
+
+
+def test_incompatible_schemas_are_held_as_separate_chunks():
+    client = FakeClient()
+    loader = _loader(client, boundary_flushes=True)
+    loader.add_batch(_batch('x', [1]))
+    # Not mergeable with x: int64, and the window is not complete: held, not loaded
+    loader.add_batch(pa.RecordBatch.from_pylist([{'x': [1, 2]}]))
+    assert client.chunks == []
+    loader.mark_boundary()
+    assert loader.close() == 2
+    assert client.chunks == [[{'x': 1}], [{'x': [1, 2]}]]
+
+
+def test_held_groups_of_a_failed_window_are_dropped():
+    client = FakeClient()
+    loader = _loader(client, boundary_flushes=True)
+    loader.add_batch(_batch('x', [1]))
+    loader.mark_boundary()
+    loader.add_batch(_batch('x', [2]))
+    loader.add_batch(pa.RecordBatch.from_pylist([{'x': [3]}]))
+    loader.discard()
+    assert client.chunks == [[{'x': 1}]]
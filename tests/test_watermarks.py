@@ -0,0 +1,121 @@
+from datetime import date, datetime, timezone
+
+from google.cloud.bigquery import Row
+
+import bootstrap
+from watermarks import WATERMARK_FIELDS, WatermarkStore
+
+
+class _Job(object):
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+
+    def result(self):
+        return self.rows
+
+
+class FakeClient(object):
+    """Answers the state table and audit log queries of WatermarkStore.load(), recording every query."""
+
+    project = 'p'
+
+    def __init__(self, state_rows=(), audit_rows=()):
+        self.state_rows = state_rows
+        self.audit_rows = audit_rows
+        self.queries = []
+
+    def create_table(self, table, exists_ok=False):
+        return table
+
+    def query(self, sql, job_config=None):
+        self.queries.append((sql, job_config))
+        if 'etl_audit_log' in sql:
+            return _Job(self.audit_rows)
+        if sql.strip().startswith('SELECT'):
+            return _Job(self.state_rows)
+        return _Job()
+
+    def merges(self):
+        return [(sql, job_config) for sql, job_config in self.queries if 'MERGE' in sql]
+
+
+def _row(ad_account_id, table_name, **values):
+    fields = ['ad_account_id', 'table_name'] + list(WATERMARK_FIELDS)
+    return Row([ad_account_id, table_name] + [values.get(f) for f in WATERMARK_FIELDS],
+               {name: i for i, name in enumerate(fields)})
+
+
+def _audit_row(ad_account_id, table_name, loaded_through):
+    return Row([ad_account_id, table_name, loaded_through],
+               {'ad_account_id': 0, 'table_name': 1, 'loaded_through': 2})
+
+
+def _merged_values(job_config):
+    """{(account, table): {field: value}} of a commit()'s MERGE parameters."""
+    structs = job_config.query_parameters[0].values
+    return {
+        (s.struct_values['ad_account_id'], s.struct_values['table_name']):
+            {f: s.struct_values[f] for f in WATERMARK_FIELDS}
+        for s in structs
+    }
+
+
+def _store(client, accounts=('act_1',), tables=('ad_insights',)):
+    bootstrap.BOOTSTRAP.start(type('Dataset', (), {'labels': {}})())
+    return WatermarkStore(client, 'ds', 'etl_audit_log', tables, accounts)
+
+
+def test_missing_watermarks_are_seeded_and_saved():
+    client = FakeClient(
+        state_rows=[_row('act_1', 'ad_insights', fetched_at=datetime(2026, 1, 5, tzinfo=timezone.utc))],
+        audit_rows=[_audit_row('act_1', 'ad_insights', date(2026, 1, 3)),
+                    _audit_row('act_2', 'ad_insights', date(2026, 1, 4))],
+    )
+    store = _store(client, accounts=('act_1', 'act_2')).load()
+
+    assert store.get('act_1', 'ad_insights') == date(2026, 1, 3)
+    assert store.get('act_2', 'ad_insights') == date(2026, 1, 4)
+    [(_, job_config)] = client.merges()
+    saved = _merged_values(job_config)
+    assert saved[('act_1', 'ad_insights')]['loaded_through'] == date(2026, 1, 3)
+    # The row's other watermarks are written back as they are, not as NULL
+    assert saved[('act_1', 'ad_insights')]['fetched_at'] == datetime(2026, 1, 5, tzinfo=timezone.utc)
+
+
+def test_no_audit_query_when_every_watermark_is_known():
+    client = FakeClient(state_rows=[_row('act_1', 'ad_insights', loaded_through=date(2026, 1, 3))])
+    _store(client).load()
+    assert not any('etl_audit_log' in sql for sql, _ in client.queries)
+    assert client.merges() == []
+
+
+def test_watermarks_only_move_forward():
+    store = _store(FakeClient())
+    store.advance('act_1', 'ad_insights', loaded_through=date(2026, 1, 5))
+    store.advance('act_1', 'ad_insights', loaded_through=date(2026, 1, 2))
+    store.advance('act_1', 'ad_insights', loaded_through=None)
+    assert store.get('act_1', 'ad_insights') == date(2026, 1, 5)
+
+
+def test_commit_writes_the_known_loaded_through_with_a_new_field():
+    client = FakeClient(state_rows=[_row('act_1', 'ad_insights', loaded_through=date(2026, 1, 3))])
+    store = _store(client).load()
+    store.advance('act_1', 'ad_insights', fetched_at=datetime(2026, 1, 6, tzinfo=timezone.utc))
+    store.commit('act_1')
+
+    [(sql, job_config)] = client.merges()
+    values = _merged_values(job_config)[('act_1', 'ad_insights')]
+    assert values['loaded_through'] == date(2026, 1, 3)
+    assert 'GREATEST(S.loaded_through, T.loaded_through)' in sql
+
+
+def test_failed_commit_keeps_the_updates_pending():
+    client = FakeClient()
+    store = _store(client)
+    store.advance('act_1', 'ad_insights', loaded_through=date(2026, 1, 5))
+
+    def fail(sql, job_config=None):
+        raise RuntimeError('boom')
+    client.query = fail
+    store.commit()
+    assert store._pending == {('act_1', 'ad_insights'): {'loaded_through': date(2026, 1, 5)}}
@@ -0,0 +1,201 @@
+"""
+Watermark store for incremental insight windows and structure syncs.
+
+Keeps, per (ad account, table), how far the table has been loaded in a small
+dedicated state table, etl_watermarks:
+
+- loaded_through: last reporting date loaded (insight tables).
+- updated_through: highest updated_time merged (campaigns / adsets / ads).
+- full_sync_at: time of the last full reconcile (campaigns / adsets / ads).
+- fetched_at: start of the last run that fetched the table (insight profiles).
+
+All watermarks are read with a single query at the start of the run and cached
+for the run; successful loads are recorded in memory and written back with one
+atomic MERGE per account.
+
+Insight tables of the run's accounts that have no loaded_through yet are seeded
+from etl_audit_log with one grouped query, and the seeds are written to the state
+table straight away, so existing deployments keep their history even for the
+accounts and tables a run does not load. The MERGE only ever moves a watermark
+forward, so tasks committing the same keys concurrently cannot move it back.
+"""
+
+import threading
+from datetime import timedelta
+
+from google.cloud import bigquery
+from google.cloud.bigquery import SchemaField, Table
+
+from bootstrap import BOOTSTRAP
+from dml import run_dml
+
+WATERMARK_TABLE = 'etl_watermarks'
+WATERMARK_SCHEMA = [
+    SchemaField("ad_account_id", "STRING", mode="REQUIRED"),
+    SchemaField("table_name", "STRING", mode="REQUIRED"),
+    SchemaField("loaded_through", "DATE", mode="NULLABLE"),
+    SchemaField("updated_at", "TIMESTAMP", mode="REQUIRED"),
+    SchemaField("updated_through", "TIMESTAMP", mode="NULLABLE"),
+    SchemaField("full_sync_at", "TIMESTAMP", mode="NULLABLE"),
+    SchemaField("fetched_at", "TIMESTAMP", mode="NULLABLE"),
+]
+# Watermark columns and their query parameter types
+WATERMARK_FIELDS = {
+    'loaded_through': 'DATE',
+    'updated_through': 'TIMESTAMP',
+    'full_sync_at': 'TIMESTAMP',
+    'fetched_at': 'TIMESTAMP',
+}
+
+
+class WatermarkStore(object):
+    """Run-local cache of insight watermarks backed by the etl_watermarks table."""
+
+    def __init__(self, client, dataset_id, audit_table, tables, ad_account_ids=()):
+        self.client = client
+        self.table_id = f"{client.project}.{dataset_id}.{WATERMARK_TABLE}"
+        self.audit_table_id = f"{client.project}.{dataset_id}.{audit_table}"
+        self.tables = list(tables)
+        self.ad_account_ids = list(ad_account_ids)
+        self._watermarks = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Loads every account's watermarks in one query (seeding missing insight watermarks from the audit log)."""
+        # None: already verified with this schema (see bootstrap.py)
+        table = BOOTSTRAP.ensure_table(self.client, Table(self.table_id, schema=WATERMARK_SCHEMA))
+        if table is not None and [f.name for f in table.schema] != [f.name for f in WATERMARK_SCHEMA]:
+            # Created by an older version: add the new (NULLABLE) watermark columns
+            table.schema = WATERMARK_SCHEMA
+            self.client.update_table(table, ["schema"])
+
+        rows = list(self.client.query(
+            f"SELECT ad_account_id, table_name, {', '.join(WATERMARK_FIELDS)} FROM `{self.table_id}`"
+        ).result())
+
+        with self._lock:
+            self._watermarks = {
+                (r.ad_account_id, r.table_name): {field: r.get(field) for field in WATERMARK_FIELDS}
+                for r in rows
+            }
+        print(f"✓ Loaded {len(self._watermarks)} insight watermarks from {WATERMARK_TABLE}.")
+
+        missing = [
+            (account, table) for account in self.ad_account_ids for table in self.tables
+            if self.get(account, table) is None
+        ]
+        if missing:
+            seeds = self._seed_from_audit_log(sorted({account for account, _ in missing}))
+            for row in seeds:
+                if (row.ad_account_id, row.table_name) in missing:
+                    self.advance(row.ad_account_id, row.table_name, loaded_through=row.loaded_through)
+            # Saved now: a seed only lives in memory until the table has a row for it
+            self.commit()
+        return self
+
+    def _seed_from_audit_log(self, ad_account_ids):
+        """Derives watermarks from the last successful load per account and table in the audit log."""
+        try:
+            job_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ArrayQueryParameter("tables", "STRING", self.tables),
+                bigquery.ArrayQueryParameter("ad_account_ids", "STRING", ad_account_ids),
+            ])
+            # A run at run_timestamp loads insights up to the day before it
+            rows = list(self.client.query(f"""
+                SELECT ad_account_id, table_name,
+                       DATE_SUB(DATE(MAX(run_timestamp)), INTERVAL 1 DAY) AS loaded_through
+                FROM `{self.audit_table_id}`
+                WHERE status = 'SUCCESS' AND table_name IN UNNEST(@tables)
+                  AND ad_account_id IN UNNEST(@ad_account_ids)
+                GROUP BY ad_account_id, table_name
+            """, job_config=job_config).result())
+            if rows:
+                print(f"🌱 Seeded {len(rows)} insight watermarks from the audit log.")
+            return rows
+        except Exception as e:
+            print(f"Warning: Could not seed watermarks from the audit log. Assuming first run. Error: {e}")
+            return []
+
+    def get(self, ad_account_id, table_name, field='loaded_through'):
+        """Returns one watermark of a table (see WATERMARK_FIELDS), or None if there is none yet."""
+        with self._lock:
+            return self._watermarks.get((ad_account_id, table_name), {}).get(field)
+
+    def advance(self, ad_account_id, table_name, **values):
+        """
+        Records new watermarks for a table, e.g. advance(account, 'ad_insights', loaded_through=day).
+        Watermarks only move forward; None values are ignored. Persisted by commit().
+        """
+        key = (ad_account_id, table_name)
+        with self._lock:
+            current = self._watermarks.setdefault(key, {})
+            for field, value in values.items():
+                if field not in WATERMARK_FIELDS:
+                    raise ValueError(f"Unknown watermark field: {field}")
+                if value is None or (current.get(field) is not None and current[field] >= value):
+                    continue
+                current[field] = value
+                self._pending.setdefault(key, {})[field] = value
+
+    def commit(self, ad_account_id=None):
+        """Writes the pending watermarks (of one account, or all) with one atomic MERGE."""
+        with self._lock:
+            keys = [k for k in self._pending if ad_account_id is None or k[0] == ad_account_id]
+            updates = {k: self._pending.pop(k) for k in keys}
+            # Every known watermark of the key, so a new row doesn't start with NULLs for the rest
+            current = {k: dict(self._watermarks.get(k, {})) for k in keys}
+        if not updates:
+            return
+
+        update_params = [
+            bigquery.StructQueryParameter(
+                None,
+                bigquery.ScalarQueryParameter("ad_account_id", "STRING", account),
+                bigquery.ScalarQueryParameter("table_name", "STRING", table),
+                *[bigquery.ScalarQueryParameter(field, field_type, current[(account, table)].get(field))
+                  for field, field_type in WATERMARK_FIELDS.items()],
+            )
+            for account, table in updates
+        ]
+        # Watermarks only move forward, also when several tasks commit the same key
+        set_clause = ", ".join(f"{f} = COALESCE(GREATEST(S.{f}, T.{f}), S.{f}, T.{f})" for f in WATERMARK_FIELDS)
+        columns = ", ".join(WATERMARK_FIELDS)
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("updates", "STRUCT", update_params)]
+        )
+        try:
+            # Sharded tasks commit their accounts' watermarks into this table at the same time
+            run_dml(self.client, f"""
+                MERGE `{self.table_id}` T
+                USING (SELECT * FROM UNNEST(@updates)) S
+                ON T.ad_account_id = S.ad_account_id AND T.table_name = S.table_name
+                WHEN MATCHED THEN
+                  UPDATE SET {set_clause}, updated_at = CURRENT_TIMESTAMP()
+                WHEN NOT MATCHED THEN
+                  INSERT (ad_account_id, table_name, {columns}, updated_at)
+                  VALUES (S.ad_account_id, S.table_name, {', '.join(f'S.{f}' for f in WATERMARK_FIELDS)}, CURRENT_TIMESTAMP())
+            """, job_config=job_config)
+        except Exception as e:
+            # Put them back so a later commit (e.g. the final one in main) retries them
+            with self._lock:
+                for key, values in updates.items():
+                    pending = self._pending.setdefault(key, {})
+                    for field, value in values.items():
+                        pending.setdefault(field, value)
+            print(f"🔴 ERROR: Failed to save {len(updates)} watermarks. Error: {e}")
+
+
+def insight_date_range(loaded_through, run_timestamp_dt, default_days=7):
+    """
+    Returns the ('YYYY-MM-DD', 'YYYY-MM-DD') range still to fetch for an insight table,
+    or None if it is up to date. Insights are fetched up to the day before the run.
+    """
+    end_date = (run_timestamp_dt - timedelta(days=1)).date()
+    if loaded_through is None:
+        start_date = (run_timestamp_dt - timedelta(days=default_days)).date()
+    else:
+        start_date = loaded_through + timedelta(days=1)
+    if start_date > end_date:
+        return None
+    return start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')